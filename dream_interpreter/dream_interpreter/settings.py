@@ -1,29 +1,67 @@
 import os
 from pathlib import Path
-from decouple import config
-import time
-import requests
-
-# Принудительная загрузка модели при старте
-try:
-    print("Загрузка модели qwen2:7b...")
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "model": "qwen2:7b",
-            "prompt": "Привет!",
-            "stream": False,
-            "options": {"temperature": 0.7}
-        },
-        timeout=60
-    )
-    print("Модель загружена.")
-except Exception as e:
-    print(f"⚠️ Не удалось загрузить модель: {e}")
-
-
-
-
+from decouple import Csv, config
+
+# --- LLM (Ollama) ---
+OLLAMA_URL = config('OLLAMA_URL', default='http://localhost:11434')
+# Несколько серверов: "http://gpu1:11434 weight=3 models=qwen2:7b; http://cpu1:11434" (см. dreambot/backends.py).
+# Пусто — один OLLAMA_URL
+OLLAMA_BACKENDS = config('OLLAMA_BACKENDS', default='')
+OLLAMA_HEALTH_INTERVAL = config('OLLAMA_HEALTH_INTERVAL', default=10, cast=float)  # сек, 0 — без активных проверок
+OLLAMA_HEALTH_TIMEOUT = config('OLLAMA_HEALTH_TIMEOUT', default=2, cast=float)
+OLLAMA_MODEL = config('OLLAMA_MODEL', default='qwen2:7b')
+OLLAMA_TIMEOUT = config('OLLAMA_TIMEOUT', default=60, cast=int)
+OLLAMA_TEMPERATURE = config('OLLAMA_TEMPERATURE', default=0.7, cast=float)
+# Сколько модель (и KV-кэш общего системного промпта) живёт в памяти Ollama после запроса: '30m', '-1' — всегда
+OLLAMA_KEEP_ALIVE = config('OLLAMA_KEEP_ALIVE', default='30m')
+# Маршрутизация по размеру сна и тарифу (dreambot/routing.py)
+LLM_ROUTING = config('LLM_ROUTING', default=True, cast=bool)
+LLM_SMALL_MODEL = config('LLM_SMALL_MODEL', default='llama3.2:3b')
+LLM_SHORT_DREAM_CHARS = config('LLM_SHORT_DREAM_CHARS', default=160, cast=int)  # короче — малая модель
+LLM_SMALL_ROUTE_REMAINING = config('LLM_SMALL_ROUTE_REMAINING', default=1, cast=int)  # осталось снов у бесплатного
+LLM_SMALL_NUM_PREDICT = config('LLM_SMALL_NUM_PREDICT', default=300, cast=int)
+LLM_SMALL_NUM_CTX = config('LLM_SMALL_NUM_CTX', default=2048, cast=int)
+LLM_LARGE_NUM_PREDICT = config('LLM_LARGE_NUM_PREDICT', default=450, cast=int)
+LLM_LARGE_NUM_CTX = config('LLM_LARGE_NUM_CTX', default=4096, cast=int)
+LLM_STOP = config('LLM_STOP', default='Новый сон:|Пользователь:', cast=Csv(delimiter='|'))
+FREE_DREAMS_PER_DAY = config('FREE_DREAMS_PER_DAY', default=5, cast=int)
+# Трассы запросов (dreambot/instrumentation.py): спаны, SQL, счётчики Ollama
+PERF_INSTRUMENTATION = config('PERF_INSTRUMENTATION', default=True, cast=bool)
+PERF_SLOW_REQUEST_MS = config('PERF_SLOW_REQUEST_MS', default=5000, cast=float)  # дольше — всегда в лог dreambot.perf
+PERF_SAMPLE_RATE = config('PERF_SAMPLE_RATE', default=0.0, cast=float)  # доля остальных запросов в логе
+PERF_SERVER_TIMING = config('PERF_SERVER_TIMING', default=True, cast=bool)  # заголовок Server-Timing
+LLM_POOL_SIZE = config('LLM_POOL_SIZE', default=10, cast=int)  # keep-alive соединений на процесс
+LLM_MAX_RETRIES = config('LLM_MAX_RETRIES', default=2, cast=int)
+LLM_RETRY_BACKOFF = config('LLM_RETRY_BACKOFF', default=0.5, cast=float)  # секунды, база экспоненты
+LLM_BREAKER_THRESHOLD = config('LLM_BREAKER_THRESHOLD', default=3, cast=int)  # неудач подряд до размыкания
+LLM_BREAKER_RESET_TIMEOUT = config('LLM_BREAKER_RESET_TIMEOUT', default=30, cast=int)  # секунды до пробного запроса
+# Очередь к LLM (dreambot/scheduler.py)
+LLM_MAX_CONCURRENCY = config('LLM_MAX_CONCURRENCY', default=2, cast=int)  # одновременных генераций
+LLM_QUEUE_SLA = config('LLM_QUEUE_SLA', default=90, cast=int)  # макс. ожидаемое ожидание в очереди, секунды
+LLM_EXPECTED_DURATION = config('LLM_EXPECTED_DURATION', default=20, cast=float)  # начальная оценка длительности генерации
+# Фоновые интерпретации (dreambot/jobs.py)
+JOB_WORKERS = config('JOB_WORKERS', default=4, cast=int)
+JOB_STALE_AFTER = config('JOB_STALE_AFTER', default=300, cast=int)  # running дольше — считаем процесс умершим
+JOB_LONG_POLL_MAX = config('JOB_LONG_POLL_MAX', default=25, cast=int)  # макс. ?wait= для /api/jobs/<id>/
+INTERPRETATION_CACHE_SIZE = config('INTERPRETATION_CACHE_SIZE', default=1000, cast=int)
+INTERPRETATION_CACHE_TTL = config('INTERPRETATION_CACHE_TTL', default=900, cast=float)  # сек
+SUMMARIES_ENABLED = config('SUMMARIES_ENABLED', default=True, cast=bool)  # фоновые краткие содержания сессий
+SUMMARY_MAX_CHARS = config('SUMMARY_MAX_CHARS', default=600, cast=int)
+SUMMARY_NUM_PREDICT = config('SUMMARY_NUM_PREDICT', default=220, cast=int)  # токенов на краткое содержание (~SUMMARY_MAX_CHARS)
+# Похожие прошлые сны в промпте (dreambot/dream_index.py)
+DREAM_RETRIEVAL = config('DREAM_RETRIEVAL', default=True, cast=bool)
+DREAM_EMBED_MODEL = config('DREAM_EMBED_MODEL', default='')  # модель эмбеддингов Ollama; пусто — хеширование
+DREAM_EMBED_TIMEOUT = config('DREAM_EMBED_TIMEOUT', default=5, cast=float)  # сек, дольше — хеширование
+DREAM_EMBED_QUERY_TIMEOUT = config('DREAM_EMBED_QUERY_TIMEOUT', default=0.5, cast=float)  # сек на эмбеддинг запроса при сборке промпта
+DREAM_RETRIEVAL_K = config('DREAM_RETRIEVAL_K', default=3, cast=int)
+DREAM_RETRIEVAL_CHARS = config('DREAM_RETRIEVAL_CHARS', default=600, cast=int)  # бюджет похожих снов в промпте
+DREAM_RETRIEVAL_MIN_SCORE = config('DREAM_RETRIEVAL_MIN_SCORE', default=0.3, cast=float)  # косинусная близость
+DREAM_INDEX_USERS = config('DREAM_INDEX_USERS', default=200, cast=int)  # индексов пользователей в памяти процесса
+# Поиск по истории (dreambot/search.py): путь к классу бэкенда; пусто — FTS5 на SQLite, иначе icontains
+SEARCH_BACKEND = config('SEARCH_BACKEND', default='')
+HISTORY_PAGE_SIZE = config('HISTORY_PAGE_SIZE', default=30, cast=int)  # снов на странице истории
+# Прогрев моделей в фоне после старта сервера (dreambot/warmup.py); вручную — manage.py warm_up_llm
+LLM_WARMUP = config('LLM_WARMUP', default=True, cast=bool)
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -39,6 +77,29 @@ ALLOWED_HOSTS = [
 
 OPENROUTER_API_KEY = config('OPENROUTER_API_KEY', default='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')
 TELEGRAM_BOT_TOKEN = config('TELEGRAM_BOT_TOKEN', default='8210635345:AAGKRadzTWU83Mtq6alWa2pwz8hRacLPYNE')
+TELEGRAM_MAX_CONCURRENT_UPDATES = config('TELEGRAM_MAX_CONCURRENT_UPDATES', default=32, cast=int)  # чатов одновременно
+TELEGRAM_WEBHOOK_SECRET = config('TELEGRAM_WEBHOOK_SECRET', default='')  # пусто — webhook выключен
+TELEGRAM_EDIT_INTERVAL = config('TELEGRAM_EDIT_INTERVAL', default=1.5, cast=float)  # сек между правками потокового ответа
+TELEGRAM_USER_CACHE_SIZE = config('TELEGRAM_USER_CACHE_SIZE', default=10000, cast=int)
+TELEGRAM_USER_CACHE_TTL = config('TELEGRAM_USER_CACHE_TTL', default=300, cast=float)  # сек
+TELEGRAM_PERSISTENCE_FILE = config('TELEGRAM_PERSISTENCE_FILE', default=str(BASE_DIR / 'telegram_state.pickle'))  # пусто — без сохранения
+
+# Кэш истории (dreambot/history.py). Веб и бот — разные процессы, нужен общий бэкенд: по умолчанию файловый
+HISTORY_CACHE_BACKEND = config('HISTORY_CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache')
+HISTORY_CACHE_LOCATION = config('HISTORY_CACHE_LOCATION', default=str(BASE_DIR / 'cache' / 'history'))
+HISTORY_CACHE_TTL = config('HISTORY_CACHE_TTL', default=7 * 24 * 3600, cast=int)  # сек
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'history': {'BACKEND': HISTORY_CACHE_BACKEND, 'LOCATION': HISTORY_CACHE_LOCATION, 'TIMEOUT': HISTORY_CACHE_TTL},
+}
+
+# Метрики Prometheus на /metrics (dreambot/metrics.py)
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+# Каталог, через который процессы (воркеры, бот) складывают метрики; пусто — только процесс, отвечающий на /metrics
+METRICS_DIR = config('METRICS_DIR', default=str(BASE_DIR / 'cache' / 'metrics'))
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=5, cast=float)  # сек между записями файла процесса
+METRICS_TOKEN = config('METRICS_TOKEN', default='')  # Authorization: Bearer <токен> — доступ с любого адреса
+METRICS_ALLOWED_IPS = config('METRICS_ALLOWED_IPS', default='127.0.0.1,::1', cast=Csv())  # доступ без токена
 
 ROBOKASSA_LOGIN = config('ROBOKASSA_LOGIN', default='')
 ROBOKASSA_PASS1 = config('ROBOKASSA_PASS1', default='')
@@ -55,6 +116,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первым: время запроса целиком, включая остальные middleware
+    'dreambot.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,10 +153,36 @@ STATICFILES_FINDERS = [
     'django.contrib.staticfiles.finders.AppDirectoriesFinder',
 ]
 
+# --- SQLite: сайт и бот пишут в один файл ---
+# WAL: читатели не ждут писателя; synchronous=NORMAL в WAL не теряет целостность, только
+# последние транзакции при отключении питания
+SQLITE_JOURNAL_MODE = config('SQLITE_JOURNAL_MODE', default='WAL')
+SQLITE_SYNCHRONOUS = config('SQLITE_SYNCHRONOUS', default='NORMAL')
+SQLITE_TIMEOUT = config('SQLITE_TIMEOUT', default=20, cast=float)  # сек ожидания блокировки записи
+SQLITE_CACHE_SIZE_KB = config('SQLITE_CACHE_SIZE_KB', default=65536, cast=int)  # кэш страниц на соединение
+SQLITE_MMAP_SIZE = config('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int)  # байт, 0 — без mmap
+DB_CONN_MAX_AGE = config('DB_CONN_MAX_AGE', default=60, cast=int)  # сек, 0 — соединение на запрос
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': SQLITE_TIMEOUT,
+            # Транзакция сразу берёт блокировку записи: при DEFERRED два писателя, начавшие
+            # с чтения, получают «database is locked» без ожидания timeout
+            'transaction_mode': 'IMMEDIATE',
+            # Выполняется на каждом новом соединении
+            'init_command': (
+                f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE};'
+                f'PRAGMA synchronous={SQLITE_SYNCHRONOUS};'
+                f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB};'
+                f'PRAGMA mmap_size={SQLITE_MMAP_SIZE};'
+                'PRAGMA temp_store=MEMORY'
+            ),
+        },
     }
 }
 
@@ -111,3 +200,11 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Трассы медленных и выборочных запросов — JSON-строкой в stderr
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {'dreambot.perf': {'handlers': ['console'], 'level': 'INFO', 'propagate': False}},
+}
@@ -4,8 +4,11 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from telegram_bot.webhook import telegram_webhook
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('telegram/webhook/', telegram_webhook, name='telegram_webhook'),
     path('', include('dreambot.urls')),
 ]
 
@@ -1,6 +1,20 @@
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class DreambotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dreambot'
+
+    def ready(self):
+        from . import summaries  # noqa: F401 — подключает сигнал обновления кратких содержаний
+        from . import dream_index  # noqa: F401 — подключает сигнал индексации снов
+        from . import history  # noqa: F401 — подключает сброс кэша истории
+        from .instrumentation import install
+        install()
+        from .warmup import is_server_process, start_background_warmup
+        # Прогрев только в серверных процессах и в фоне: импорт и команды manage.py не ждут Ollama
+        if settings.LLM_WARMUP and is_server_process(sys.argv):
+            start_background_warmup()
@@ -0,0 +1,161 @@
+# dreambot/backends.py
+"""
+Пул из нескольких серверов Ollama.
+
+OLLAMA_BACKENDS — список через «;», у каждого адрес и необязательные вес и модели:
+
+    OLLAMA_BACKENDS="http://gpu1:11434 weight=3 models=qwen2:7b,llama3.2:3b; http://cpu1:11434"
+
+Пустой список — один сервер OLLAMA_URL, как раньше. Маршрутизация:
+- запрос идёт на сервер с наименьшим числом незавершённых запросов с учётом
+  веса ((outstanding + 1) / weight), среди тех, что обслуживают нужную модель;
+- пассивное исключение: у каждого сервера свой CircuitBreaker (llm.py) —
+  после серии ошибок сервер выпадает из ротации, после reset_timeout
+  получает один пробный запрос;
+- активная проверка: HealthChecker раз в OLLAMA_HEALTH_INTERVAL секунд
+  запрашивает /api/tags. Неответивший сервер исключается сразу, ответивший —
+  возвращается (breaker замыкается) и сообщает список своих моделей,
+  если модели не заданы в настройках.
+"""
+import logging
+import random
+import threading
+
+import requests
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+
+def parse_backends(value):
+    """'url [weight=N] [models=a,b]; ...' → список dict(url, weight, models)."""
+    backends = []
+    for item in value.split(';'):
+        parts = item.split()
+        if not parts:
+            continue
+        backend = {'url': parts[0].rstrip('/'), 'weight': 1.0, 'models': None}
+        for option in parts[1:]:
+            key, _, val = option.partition('=')
+            if key == 'weight':
+                try:
+                    backend['weight'] = float(val)
+                except ValueError:
+                    raise ImproperlyConfigured(f"OLLAMA_BACKENDS: bad weight {val!r} for {parts[0]}")
+                if backend['weight'] <= 0:
+                    raise ImproperlyConfigured(f"OLLAMA_BACKENDS: weight must be positive for {parts[0]}")
+            elif key == 'models':
+                backend['models'] = [m for m in val.split(',') if m]
+            else:
+                raise ImproperlyConfigured(f"OLLAMA_BACKENDS: unknown option {option!r} for {parts[0]}")
+        backends.append(backend)
+    return backends
+
+
+def canonical_model_name(name):
+    # Ollama считает «llama3.2» и «llama3.2:latest» одной моделью
+    return name if ':' in name else f"{name}:latest"
+
+
+class Backend:
+    def __init__(self, url, breaker, weight=1.0, models=None):
+        self.url = url.rstrip('/')
+        self.breaker = breaker
+        self.weight = weight
+        self.models = {canonical_model_name(m) for m in models} if models else None
+        self.discovered_models = None  # из /api/tags, если models не заданы
+        self.healthy = True
+        self.outstanding = 0
+        self.served = 0
+
+    def serves(self, model):
+        models = self.models if self.models is not None else self.discovered_models
+        return models is None or canonical_model_name(model) in models
+
+    def __repr__(self):
+        return f"<Backend {self.url}>"
+
+
+class BackendPool:
+    """Потокобезопасный выбор сервера; acquire() и release() всегда парами."""
+
+    def __init__(self, backends, rng=random):
+        if not backends:
+            raise ImproperlyConfigured("Ollama backend pool is empty")
+        self.backends = list(backends)
+        self._rng = rng
+        self._lock = threading.Lock()
+
+    def acquire(self, model):
+        """Сервер с наименьшей взвешенной загрузкой или None, если подходящих нет."""
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and b.serves(model)]
+            # Случайный порядок до сортировки — равные по загрузке серверы чередуются
+            self._rng.shuffle(candidates)
+            candidates.sort(key=lambda b: (b.outstanding + 1) / b.weight)
+            for backend in candidates:
+                # allow() у разомкнутого breaker'а откажет, у полуоткрытого — выдаст пробный запрос
+                if backend.breaker.allow():
+                    backend.outstanding += 1
+                    backend.served += 1
+                    return backend
+        return None
+
+    def release(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def check_health(self, timeout=2.0):
+        """Один проход активной проверки по всем серверам."""
+        for backend in self.backends:
+            try:
+                response = requests.get(f"{backend.url}/api/tags", timeout=timeout)
+                response.raise_for_status()
+                models = {canonical_model_name(m['name']) for m in response.json().get('models', [])}
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+                if backend.healthy:
+                    logger.warning(f"Ollama backend {backend.url} failed health check, ejecting: {e}")
+                backend.healthy = False
+                continue
+            if not backend.healthy:
+                logger.info(f"Ollama backend {backend.url} is healthy again, re-admitting")
+            backend.discovered_models = models
+            backend.healthy = True
+            # Сервер отвечает — не ждём reset_timeout разомкнутого breaker'а
+            backend.breaker.record_success()
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {
+                    'url': b.url, 'weight': b.weight, 'healthy': b.healthy, 'breaker': b.breaker.state,
+                    'outstanding': b.outstanding, 'served': b.served,
+                    'models': sorted(b.models if b.models is not None else b.discovered_models or []),
+                }
+                for b in self.backends
+            ]
+
+
+class HealthChecker:
+    """Фоновый поток, периодически вызывающий pool.check_health()."""
+
+    def __init__(self, pool, interval, timeout):
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ollama-health', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.pool.check_health(self.timeout)
+            except Exception as e:
+                logger.error(f"Ollama health check crashed: {e}", exc_info=True)
@@ -0,0 +1,199 @@
+# dreambot/context.py
+"""
+Сборка контекста промпта: системный промпт, профиль пользователя, последние
+сообщения текущей сессии и первые сны предыдущих сессий.
+
+Бюджет — два запроса к БД при любой длине истории: окно последних сообщений
+сессии (LIMIT) и предыдущие сессии с денормализованным DreamSession.first_dream
+(его поддерживает Message.save), без отдельного запроса на каждую сессию.
+
+Промпт уходит в /api/chat списком сообщений (messages_with_dream): общий для
+всех SYSTEM_PROMPT отдельным системным сообщением, дальше профиль и история.
+
+Если есть скользящие краткие содержания (dreambot/summaries.py), вместо уже
+покрытых ими отрывков в промпт идут DreamSession.summary и User.dream_summary.
+summaries=False — прежний промпт из одних отрывков (для отчёта prompt_budget).
+
+Последним разделом идут прошлые сны, похожие на новый (dreambot/dream_index.py),
+в пределах DREAM_RETRIEVAL_CHARS символов: ещё один запрос к БД. Раздел зависит
+от самого сна, поэтому стоит после всего, что общее у соседних запросов.
+"""
+from datetime import date
+
+from django.conf import settings
+
+from .dream_index import similar_dreams
+from .instrumentation import span
+from .interpretations import normalize_dream_text
+from .models import FIRST_DREAM_EXCERPT, DreamSession, Message
+
+# Системный промпт — психологический уклон
+SYSTEM_PROMPT = """
+Ты — эмпатичный психолог-сонник. Твоя задача — помочь пользователю глубже понять свои сны как отражение его подсознания.
+
+Следуй этим правилам:
+1. Никогда не используй эзотерику, гадания, символизм вроде «птица — к удаче».
+2. Не предсказывай будущее. Сны — не пророчества, а зеркало настоящего.
+3. Сосредоточься на:
+   - эмоциях, которые вызвал сон (страх, радость, смущение и т.д.)
+   - внутренних конфликтах (желание vs обязанность, свобода vs безопасность)
+   - недавних событиях или переживаниях в реальной жизни
+   - скрытых потребностях или подавленных чувствах
+4. Говори мягко, тепло, поддерживающе. Не осуждай и не интерпретируй агрессивно.
+5. Обращайся по имени, если оно известно.
+6. Отвечай одним связным абзацем (3–5 предложений). Не задавай уточняющих вопросов.
+7. Избегай клише вроде «возможно, это связано с...». Говори уверенно, но деликатно.
+8. Будь эмпатичным: чувствуй эмоциональное состояние пользователя и отражай его в ответе.
+9. Если видишь повторяющиеся темы или паттерны в нескольких снах — обязательно отметь это и помоги увидеть глубинные связи.
+
+Пример хорошего ответа:
+«Анна, в твоём сне о падении я чувствую сильный страх потери контроля. Это может отражать текущую ситуацию на работе, где ты чувствуешь давление и неуверенность. Падение — не предупреждение, а признак того, что ты уже давно держишься из последних сил. Твоё подсознание напоминает: позволить себе остановиться — не слабость, а забота о себе».
+
+Теперь проанализируй сон пользователя.
+"""
+
+# Сколько сообщений текущей сессии (2 пары) и снов из прошлых сессий попадает в промпт
+CURRENT_SESSION_MESSAGES = 4
+PREVIOUS_SESSIONS = 4
+
+HISTORY_HINT = "ВАЖНО: Учитывай предыдущие сны из разных дней при анализе нового сна. Ищи связи, закономерности и эмоциональные паттерны между снами. Если видишь повторяющиеся темы, символы или эмоции — обязательно отметь это и помоги увидеть глубинные связи. Анализируй динамику эмоционального состояния пользователя через несколько дней."
+SESSION_HINT = "ВАЖНО: Учитывай предыдущие сны и интерпретации при анализе нового сна. Ищи связи, закономерности и эмоциональные паттерны."
+
+
+def _without_repeats(messages, user_message):
+    """
+    Убирает из контекста прошлые отправки этого же сна и ответы на них:
+    двойной клик или повтор Telegram должны давать тот же контекст (и ключ кэша).
+    """
+    text = normalize_dream_text(user_message)
+    result = []
+    skip_reply = False
+    for msg in messages:
+        if msg.is_user and normalize_dream_text(msg.content) == text:
+            skip_reply = True
+            continue
+        if not msg.is_user and skip_reply:
+            skip_reply = False
+            continue
+        skip_reply = False
+        result.append(msg)
+    return result
+
+
+def current_session_lines(session, user_message, summaries=True):
+    """Последние сообщения сессии, кроме самого нового сна (он — последнее сообщение). Один запрос."""
+    messages = Message.objects.filter(session=session)
+    if summaries and session.summarized_at is not None:
+        # Покрытое кратким содержанием не повторяем
+        messages = messages.filter(created_at__gt=session.summarized_at)
+    # С запасом на повторы этого же сна, которые отфильтруются
+    recent = list(
+        messages.order_by('-created_at', '-id')
+        .only('is_user', 'content')[:CURRENT_SESSION_MESSAGES * 2 + 1]
+    )
+    recent.reverse()
+    lines = []
+    for msg in _without_repeats(recent[:-1], user_message)[-CURRENT_SESSION_MESSAGES:]:
+        if msg.is_user:
+            lines.append(f"[Сегодня] Пользователь: {msg.content[:200]}")  # Ограничиваем длину
+        else:
+            lines.append(f"[Сегодня] Сонник: {msg.content[:200]}")
+    return lines
+
+
+def previous_dreams(user, session, summaries=True):
+    """(created_at, first_dream) последних сессий пользователя (обычно это основной сон дня). Один запрос."""
+    sessions = DreamSession.objects.filter(user=user).exclude(id=session.id).exclude(first_dream='')
+    if summaries:
+        # Сессии, уже вошедшие в User.dream_summary, не повторяем
+        sessions = sessions.filter(summary_folded=False)
+    return list(sessions.order_by('-created_at').values_list('created_at', 'first_dream')[:PREVIOUS_SESSIONS])
+
+
+def _previous_dream_line(created_at, first_dream):
+    return f"[{created_at.strftime('%d.%m')}] Сон: {first_dream}..."
+
+
+def previous_dream_lines(user, session, summaries=True):
+    return [_previous_dream_line(*row) for row in previous_dreams(user, session, summaries)]
+
+
+def similar_dream_lines(user, session, user_message, shown=()):
+    """Похожие прошлые сны вне текущей сессии, кроме уже показанных первых снов (shown), в бюджете символов."""
+    lines = []
+    used = 0
+    for created_at, excerpt in similar_dreams(user, user_message, session=session):
+        if excerpt[:FIRST_DREAM_EXCERPT] in shown:
+            continue
+        line = f"[{created_at.strftime('%d.%m.%Y')}] Сон: {excerpt}"
+        if used + len(line) > settings.DREAM_RETRIEVAL_CHARS:
+            break
+        lines.append(line)
+        used += len(line)
+    return lines
+
+
+def user_profile_lines(user):
+    lines = []
+    if user.name:
+        lines.append(f"Имя пользователя: {user.name}")
+    if user.birth_date:
+        today = date.today()
+        age = today.year - user.birth_date.year - ((today.month, today.day) < (user.birth_date.month, user.birth_date.day))
+        lines.append(f"Возраст пользователя: {age} лет")
+    return lines
+
+
+def build_llm_context(user, user_message, session=None, summaries=True):
+    """
+    Всё о пользователе, кроме самого сна: профиль и история. Входит в ключ кэша интерпретаций.
+    Порядок — от редко меняющегося к часто меняющемуся, чтобы у соседних запросов
+    одного пользователя совпадал как можно более длинный префикс.
+    """
+    current_session_messages = current_session_lines(session, user_message, summaries) if session else []
+    previous = previous_dreams(user, session, summaries) if session else []
+    previous_sessions_dreams = [_previous_dream_line(*row) for row in previous]
+    similar = []
+    if session and summaries and settings.DREAM_RETRIEVAL:
+        similar = similar_dream_lines(user, session, user_message, shown={first_dream for _, first_dream in previous})
+    session_summary = session.summary if summaries and session else ''
+    user_summary = user.dream_summary if summaries else ''
+
+    context_parts = []
+    profile = user_profile_lines(user)
+    if profile:
+        context_parts.append("\n".join(profile))
+    if user_summary:
+        context_parts.append("Что известно о прошлых снах пользователя:\n" + user_summary)
+    if previous_sessions_dreams:
+        context_parts.append("Предыдущие сны пользователя:\n" + "\n".join(previous_sessions_dreams))
+    if session_summary:
+        context_parts.append("Кратко о текущем диалоге:\n" + session_summary)
+    if current_session_messages:
+        context_parts.append("Контекст текущего диалога:\n" + "\n".join(current_session_messages))
+    if similar:
+        context_parts.append("Похожие сны из прошлого:\n" + "\n".join(similar))
+    if previous_sessions_dreams or user_summary or similar:
+        context_parts.append(HISTORY_HINT)
+    elif current_session_messages or session_summary:
+        context_parts.append(SESSION_HINT)
+    return "\n\n".join(context_parts)
+
+
+def messages_with_dream(context, user_message):
+    """
+    Сообщения для /api/chat. Первое — SYSTEM_PROMPT, одинаковый для всех пользователей:
+    Ollama держит его разобранным в KV-кэше и не пересчитывает для каждого запроса.
+    Всё персональное идёт после него.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if context:
+        messages.append({"role": "system", "content": context})
+    messages.append({"role": "user", "content": f"Новый сон:\n{user_message}"})
+    return messages
+
+
+@span('context')
+def build_llm_messages(user, user_message, session=None, summaries=True):
+    """Собирает сообщения для Ollama: общий системный промпт, профиль и контекст, сон."""
+    return messages_with_dream(build_llm_context(user, user_message, session, summaries), user_message)
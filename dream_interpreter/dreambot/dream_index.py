@@ -0,0 +1,303 @@
+# dreambot/dream_index.py
+"""
+Поиск похожих прошлых снов пользователя.
+
+В промпт и так попадают первые сны последних сессий, но повторяющаяся тема
+трёхмесячной давности (правило 9 SYSTEM_PROMPT) туда не доходила. Теперь:
+- каждый сон (Message с is_user) после коммита получает вектор в DreamEmbedding:
+  всегда — хеширование символьных триграмм (локально, без Ollama), и, если задана
+  DREAM_EMBED_MODEL, — эмбеддинг Ollama (/api/embed). Векторы нормированы
+  и хранятся в float16;
+- индекс пользователя (DreamIndex) живёт в памяти процесса (LRU на
+  DREAM_INDEX_USERS пользователей) и при каждом поиске дочитывает только
+  новые строки (id больше last_id) — один запрос по индексу (user, embedder, id);
+- поиск — скалярное произведение с матрицей NumPy и argpartition: доли
+  миллисекунды даже для тысяч снов. Эмбеддинг запроса стоит на пути ответа,
+  поэтому Ollama спрашивается, только если сервер не занят генерацией, и не дольше
+  DREAM_EMBED_QUERY_TIMEOUT; иначе поиск идёт по векторам хеширования;
+- у эмбеддингов свой пул с собственными breaker'ами: их таймауты под нагрузкой
+  не размыкают breaker генерации.
+
+Сны, записанные до появления индекса: python manage.py build_dream_index
+"""
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models.functions import Left
+from django.db.models.signals import post_save
+
+from .backends import Backend, BackendPool
+from .llm import CircuitBreaker, LLMClient, LLMError, get_pool
+from .models import DreamEmbedding, Message
+
+logger = logging.getLogger(__name__)
+
+HASH_DIM = 512
+HASHING = f'hashing-{HASH_DIM}'
+# Сколько символов сна хранится в индексе и может попасть в промпт
+EXCERPT_CHARS = 300
+# Почти совпадающий вектор — повтор того же сна, в промпте он ничего не добавит
+DUPLICATE_SCORE = 0.98
+
+WORD_RE = re.compile(r'\w+')
+STOP_WORDS = frozenset(
+    'что как это был была было были меня мне мой моя мое мои его она они оно там тут '
+    'где когда потом тоже очень еще уже только просто будто словно который которая'.split()
+)
+
+
+@lru_cache(maxsize=65536)
+def _trigram_slot(trigram):
+    digest = int.from_bytes(hashlib.blake2b(trigram.encode(), digest_size=8).digest(), 'little')
+    return digest % HASH_DIM, 1.0 if digest >> 63 else -1.0
+
+
+def _normalized(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def hashing_vector(text):
+    """
+    Триграммы символов слов, разложенные хешем по HASH_DIM координатам со знаком.
+    Триграммы, а не слова: «падал», «падение» и «упала» получают общие признаки.
+    """
+    slots, signs = [], []
+    for word in WORD_RE.findall(text.lower().replace('ё', 'е')):
+        if len(word) < 3 or word in STOP_WORDS:
+            continue
+        padded = f' {word} '
+        for i in range(len(padded) - 2):
+            slot, sign = _trigram_slot(padded[i:i + 3])
+            slots.append(slot)
+            signs.append(sign)
+    vector = np.zeros(HASH_DIM, dtype=np.float32)
+    np.add.at(vector, slots, signs)
+    return _normalized(vector)
+
+
+def ollama_embedder():
+    return f'ollama:{settings.DREAM_EMBED_MODEL}' if settings.DREAM_EMBED_MODEL else ''
+
+
+_pool = None
+_pool_source = None
+_clients = {}  # timeout -> LLMClient
+_client_lock = threading.Lock()
+
+
+def _embed_pool():
+    """
+    Те же серверы, что у генерации, но со своими breaker'ами: пока Ollama занята
+    генерацией, эмбеддинги упираются в таймаут, и с общим breaker'ом после
+    LLM_BREAKER_THRESHOLD таких отказов падали бы и интерпретации.
+    """
+    global _pool, _pool_source
+    source = get_pool()
+    with _client_lock:
+        if _pool_source is not source:
+            _pool = BackendPool([
+                Backend(b.url, weight=b.weight, models=b.models, breaker=CircuitBreaker(
+                    failure_threshold=settings.LLM_BREAKER_THRESHOLD,
+                    reset_timeout=settings.LLM_BREAKER_RESET_TIMEOUT,
+                ))
+                for b in source.backends
+            ])
+            _pool_source = source
+            _clients.clear()
+        return _pool
+
+
+def _embed_client(timeout):
+    # Свой клиент на каждый таймаут и без повторов: отказ эмбеддинга — это просто хеширование
+    pool = _embed_pool()
+    with _client_lock:
+        client = _clients.get(timeout)
+        if client is None:
+            client = _clients[timeout] = LLMClient(pool=pool, timeout=timeout, max_retries=0)
+        return client
+
+
+def generation_busy(model):
+    """Все серверы, которые могут дать эмбеддинг model, сейчас заняты запросами генерации."""
+    return all(b.outstanding for b in get_pool().backends if b.healthy and b.serves(model))
+
+
+def ollama_vectors(texts, timeout=None):
+    """Эмбеддинги DREAM_EMBED_MODEL; None — модель не задана или Ollama не ответила."""
+    if not settings.DREAM_EMBED_MODEL:
+        return None
+    try:
+        client = _embed_client(timeout if timeout is not None else settings.DREAM_EMBED_TIMEOUT)
+        vectors = client.embed(texts, settings.DREAM_EMBED_MODEL)
+    except LLMError as e:
+        logger.warning(f"Dream embedding via {settings.DREAM_EMBED_MODEL} failed: {e}")
+        return None
+    return [_normalized(np.asarray(v, dtype=np.float32)) for v in vectors]
+
+
+def embed_query(text):
+    """
+    (embedder, вектор) для поиска: эмбеддинг Ollama, если он укладывается в
+    DREAM_EMBED_QUERY_TIMEOUT и сервер не занят генерацией, иначе хеширование.
+    """
+    if settings.DREAM_EMBED_MODEL and not generation_busy(settings.DREAM_EMBED_MODEL):
+        vectors = ollama_vectors([text], timeout=settings.DREAM_EMBED_QUERY_TIMEOUT)
+        if vectors:
+            return ollama_embedder(), vectors[0]
+    return HASHING, hashing_vector(text)
+
+
+class DreamIndex:
+    """Векторы снов одного пользователя (одного embedder) в памяти; строки matrix нормированы."""
+
+    def __init__(self):
+        self.last_id = 0
+        self.matrix = None
+        self.session_ids = np.zeros(0, dtype=np.int64)
+        self.dates = []
+        self.excerpts = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.excerpts)
+
+    def extend(self, rows):
+        """rows — (id, session_id, created_at, excerpt, vector) по возрастанию id."""
+        if not rows:
+            return
+        vectors = np.frombuffer(b''.join(bytes(row[4]) for row in rows), dtype=np.float16)
+        vectors = vectors.reshape(len(rows), -1).astype(np.float32)
+        self.matrix = vectors if self.matrix is None else np.vstack([self.matrix, vectors])
+        self.session_ids = np.concatenate([self.session_ids, [row[1] for row in rows]])
+        self.dates.extend(row[2] for row in rows)
+        self.excerpts.extend(row[3] for row in rows)
+        self.last_id = rows[-1][0]
+
+    def search(self, query, k, exclude_session=None):
+        """До k пар (номер строки, косинусная близость) по убыванию близости."""
+        if self.matrix is None or k <= 0 or query.shape[0] != self.matrix.shape[1]:
+            return []
+        scores = self.matrix @ query
+        if exclude_session is not None:
+            scores[self.session_ids == exclude_session] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(int(i), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def load_index(user_id, embedder):
+    """Индекс из кэша процесса, дополненный строками, появившимися с прошлого раза. Один запрос."""
+    key = (user_id, embedder)
+    with _indexes_lock:
+        index = _indexes.pop(key, None) or DreamIndex()
+        _indexes[key] = index
+        while len(_indexes) > settings.DREAM_INDEX_USERS:
+            _indexes.popitem(last=False)
+    with index.lock:
+        rows = list(
+            DreamEmbedding.objects.filter(user_id=user_id, embedder=embedder, id__gt=index.last_id)
+            .annotate(excerpt=Left('message__content', EXCERPT_CHARS))
+            .order_by('id')
+            .values_list('id', 'message__session_id', 'message__created_at', 'excerpt', 'vector')
+        )
+        index.extend(rows)
+    return index
+
+
+def reset_dream_index():
+    global _pool, _pool_source
+    with _indexes_lock:
+        _indexes.clear()
+    with _client_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _pool = _pool_source = None
+
+
+def similar_dreams(user, text, session=None, k=None):
+    """До k (DREAM_RETRIEVAL_K) прошлых снов, похожих на text, вне сессии session: [(created_at, excerpt)]."""
+    k = k or settings.DREAM_RETRIEVAL_K
+    embedder, query = embed_query(text)
+    index = load_index(user.id, embedder)
+    result = []
+    with index.lock:
+        # С запасом на повторы этого же сна
+        for i, score in index.search(query, k * 2, exclude_session=session.id if session else None):
+            if score < settings.DREAM_RETRIEVAL_MIN_SCORE or len(result) == k:
+                break
+            if score < DUPLICATE_SCORE:
+                result.append((index.dates[i], index.excerpts[i]))
+    return result
+
+
+def index_messages(message_ids):
+    """Считает недостающие векторы снов message_ids; возвращает число новых строк DreamEmbedding."""
+    dreams = list(
+        Message.objects.filter(id__in=message_ids, is_user=True).values_list('id', 'session__user_id', 'content')
+    )
+    if not dreams:
+        return 0
+    existing = set(
+        DreamEmbedding.objects.filter(message_id__in=[d[0] for d in dreams]).values_list('message_id', 'embedder')
+    )
+    embeddings = [
+        DreamEmbedding(message_id=message_id, user_id=user_id, embedder=HASHING,
+                       vector=hashing_vector(content).astype(np.float16).tobytes())
+        for message_id, user_id, content in dreams if (message_id, HASHING) not in existing
+    ]
+    embedder = ollama_embedder()
+    missing = [d for d in dreams if embedder and (d[0], embedder) not in existing]
+    vectors = ollama_vectors([content for _, _, content in missing]) if missing else None
+    for (message_id, user_id, _), vector in zip(missing, vectors or []):
+        embeddings.append(DreamEmbedding(message_id=message_id, user_id=user_id, embedder=embedder,
+                                         vector=vector.astype(np.float16).tobytes()))
+    DreamEmbedding.objects.bulk_create(embeddings, ignore_conflicts=True)
+    return len(embeddings)
+
+
+def _index_in_background(message_id):
+    close_old_connections()
+    try:
+        index_messages([message_id])
+    except Exception as e:
+        logger.error(f"Indexing dream {message_id} failed: {e}", exc_info=True)
+    finally:
+        close_old_connections()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def schedule_indexing(message_id):
+    global _executor
+    if not settings.DREAM_RETRIEVAL:
+        return
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dream-index')
+    _executor.submit(_index_in_background, message_id)
+
+
+def _on_message_saved(sender, instance, created, **kwargs):
+    if created and instance.is_user:
+        message_id = instance.id
+        transaction.on_commit(lambda: schedule_indexing(message_id))
+
+
+post_save.connect(_on_message_saved, sender=Message, dispatch_uid='dreambot_dream_index')
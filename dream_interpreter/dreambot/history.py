@@ -0,0 +1,224 @@
+# dreambot/history.py
+"""
+История снов постранично.
+
+Раньше /history/ загружал все сессии и сообщения пользователя и раскладывал их
+по дням в Python — память и время росли с историей. Теперь:
+- страница — HISTORY_PAGE_SIZE последних снов старше курсора (keyset по
+  (created_at, id), без OFFSET): одна выборка снов, ответ на каждый сон
+  подтягивается подзапросом — это следующее сообщение той же сессии, если
+  оно от сонника. Сны без ответа в историю не попадают, как и раньше;
+- дни не разрезаются между страницами: если последний день продолжается за
+  границей страницы, он целиком переносится на следующую, а день длиннее
+  страницы дочитывается до конца;
+- курсор — непрозрачная строка с (created_at, id) самого старого сна страницы.
+
+Кэш (cached_history_page, кэш 'history' из CACHES):
+- версия пользователя — метка времени в наносекундах; меняется при каждом
+  новом сообщении и очистке чата. Страницы (сами данные) кэшируются под
+  ключом с этой версией, по ней же строятся ETag и Last-Modified;
+- у каждого дня своя версия; новое сообщение меняет только версию своего дня
+  (для ответа сонника — дня сна, к которому он относится). Отрисованный HTML
+  дня кэшируется с версией дня, поэтому прошлые дни не перерисовываются,
+  даже когда версия пользователя уже сменилась.
+Старые ключи не удаляются — просто перестают читаться и истекают по TTL.
+"""
+import base64
+import time as time_module
+from datetime import datetime, time, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.signals import post_delete, post_save
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .metrics import count_cache
+from .models import DreamSession, Message
+
+
+def encode_cursor(created_at, message_id):
+    raw = f"{created_at.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(created_at, id) из курсора; ValueError — курсор испорчен."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Bad history cursor: {e}")
+
+
+def _older_than(created_at, message_id):
+    return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+
+
+def _answered_dreams(user):
+    """Сны пользователя, новые первыми, с текстом ответа сонника (reply) или None."""
+    following = Message.objects.filter(
+        # Лишнее с виду created_at__gte даёт поиск диапазона по индексу (session, created_at): OR его не даёт
+        session=OuterRef('session'), created_at__gte=OuterRef('created_at'),
+    ).filter(
+        Q(created_at__gt=OuterRef('created_at')) | Q(created_at=OuterRef('created_at'), id__gt=OuterRef('id'))
+    ).order_by('created_at', 'id')
+    return (
+        Message.objects.filter(session__user=user, is_user=True)
+        .annotate(
+            reply_is_user=Subquery(following.values('is_user')[:1]),
+            reply=Subquery(following.values('content')[:1]),
+        )
+        .order_by('-created_at', '-id')
+        .only('id', 'content', 'created_at')
+    )
+
+
+def history_page(user, cursor=None, page_size=None):
+    """
+    ([(дата, [{'dream', 'interpretation', 'time'}, ...]), ...], next_cursor):
+    дни — новые первыми, сны внутри дня — по порядку. next_cursor None — это последняя страница.
+    """
+    page_size = page_size or settings.HISTORY_PAGE_SIZE
+    dreams = _answered_dreams(user)
+    if cursor:
+        dreams = dreams.filter(_older_than(*decode_cursor(cursor)))
+    rows = list(dreams[:page_size + 1])
+    has_more = len(rows) > page_size
+    # Первый сон следующей страницы показывает, не продолжается ли последний день за границей
+    rows, following = rows[:page_size], rows[page_size:]
+    if has_more and following[0].created_at.date() == rows[-1].created_at.date():
+        last_day = rows[-1].created_at.date()
+        if rows[0].created_at.date() != last_day:
+            # Последний день продолжается за границей страницы — он целиком уйдёт на следующую
+            rows = [row for row in rows if row.created_at.date() != last_day]
+        else:
+            # Один день длиннее страницы — дочитываем его до конца
+            day_start = datetime.combine(last_day, time.min, tzinfo=dt_timezone.utc)
+            rows += list(dreams.filter(_older_than(rows[-1].created_at, rows[-1].id), created_at__gte=day_start))
+            has_more = dreams.filter(created_at__lt=day_start).exists()
+
+    days = []
+    for row in rows:
+        if row.reply is None or row.reply_is_user:
+            continue
+        day = row.created_at.date()
+        if not days or days[-1][0] != day:
+            days.append((day, []))
+        days[-1][1].append({
+            'dream': row.content,
+            'interpretation': row.reply,
+            'time': row.created_at.strftime('%H:%M'),
+        })
+    for _, items in days:
+        items.reverse()
+    next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id) if has_more and rows else None
+    return days, next_cursor
+
+
+def history_cache():
+    return caches['history']
+
+
+def _version(key):
+    cache = history_cache()
+    version = cache.get(key)
+    if version is None:
+        # add(): из двух одновременных инициализаций побеждает одна
+        cache.add(key, time_module.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(key):
+    cache = history_cache()
+    cache.set(key, max(time_module.time_ns(), (cache.get(key) or 0) + 1), None)
+
+
+def history_version(user_id):
+    return _version(f'history:{user_id}:version')
+
+
+def history_last_modified(user_id):
+    return datetime.fromtimestamp(history_version(user_id) / 1e9, tz=dt_timezone.utc)
+
+
+def invalidate_history(user_id, days=()):
+    """Новая версия истории пользователя и перечисленных дней (date)."""
+    for day in days:
+        _bump(f'history:{user_id}:day:{day.isoformat()}:version')
+    _bump(f'history:{user_id}:version')
+
+
+def cached_history_page(user, cursor=None):
+    """
+    Как history_page, но дни — [(дата, HTML дня)]; данные страницы и HTML дней берутся из кэша.
+    Курсор проверяется до обращения к кэшу: испорченный — ValueError.
+    """
+    if cursor:
+        decode_cursor(cursor)
+    cache = history_cache()
+    page_key = f"history:{user.id}:{history_version(user.id)}:page:{cursor or ''}"
+    page = cache.get(page_key)
+    count_cache('history', page is not None)
+    if page is None:
+        page = history_page(user, cursor=cursor)
+        cache.set(page_key, page)
+    days, next_cursor = page
+
+    versions = cache.get_many([f'history:{user.id}:day:{day.isoformat()}:version' for day, _ in days])
+    keys = {}
+    for day, _ in days:
+        version_key = f'history:{user.id}:day:{day.isoformat()}:version'
+        version = versions.get(version_key) or _version(version_key)
+        keys[day] = f'history:{user.id}:day:{day.isoformat()}:{version}:html'
+    fragments = cache.get_many(list(keys.values()))
+    missing = {}
+    for day, dreams in days:
+        if keys[day] not in fragments:
+            missing[keys[day]] = render_to_string('dreambot/history_day.html', {'date': day, 'dreams': dreams})
+    if missing:
+        cache.set_many(missing)
+        fragments.update(missing)
+    return [(day, mark_safe(fragments[keys[day]])) for day, _ in days], next_cursor
+
+
+def _invalidate_for_message(message_id, session_id, created_at, is_user, user_id=None):
+    days = {created_at.date()}
+    if is_user:
+        if user_id is None:
+            user_id = DreamSession.objects.filter(id=session_id).values_list('user_id', flat=True).first()
+    else:
+        # Ответ показывается в дне сна, на который отвечает, — это предыдущее сообщение сессии
+        previous = (
+            Message.objects.filter(session_id=session_id, id__lt=message_id)
+            .order_by('-id').values_list('created_at', 'session__user_id').first()
+        )
+        if previous is not None:
+            days.add(previous[0].date())
+            user_id = previous[1]
+        elif user_id is None:
+            user_id = DreamSession.objects.filter(id=session_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        invalidate_history(user_id, days)
+
+
+def _on_message_saved(sender, instance, created, **kwargs):
+    if not created:
+        return
+    # Сессия обычно уже загружена (Message.objects.create(session=...)) — тогда без запроса
+    user_id = instance.session.user_id if Message.session.is_cached(instance) else None
+    args = (instance.id, instance.session_id, instance.created_at, instance.is_user, user_id)
+    transaction.on_commit(lambda: _invalidate_for_message(*args))
+
+
+def _on_message_deleted(sender, instance, **kwargs):
+    args = (instance.id, instance.session_id, instance.created_at, instance.is_user, None)
+    transaction.on_commit(lambda: _invalidate_for_message(*args))
+
+
+post_save.connect(_on_message_saved, sender=Message, dispatch_uid='dreambot_history_cache_save')
+post_delete.connect(_on_message_deleted, sender=Message, dispatch_uid='dreambot_history_cache_delete')
@@ -0,0 +1,259 @@
+# dreambot/instrumentation.py
+"""
+Куда уходит время запроса: база, сборка промпта или Ollama.
+
+Трасса (Trace) живёт в contextvar на время одного HTTP-запроса
+(InstrumentationMiddleware) или апдейта Telegram (traced_handler) и видна
+в потоках sync_to_async. В неё пишут:
+- span('context'), span('llm') — участки кода, суммарное время и число входов;
+- все SQL-запросы — через execute_wrapper каждого соединения: число и время,
+  отдельно чтение (db.read) и запись (db.write);
+- record_llm() — счётчики из ответа Ollama: eval_count, eval_duration,
+  prompt_eval_count, prompt_eval_duration (в мс).
+
+В конце запроса трасса уходит в заголовок Server-Timing (видно в DevTools)
+и в лог dreambot.perf одной JSON-строкой: запросы дольше PERF_SLOW_REQUEST_MS —
+всегда (warning), остальные — с вероятностью PERF_SAMPLE_RATE (info).
+Без активной трассы все хуки ничего не делают.
+"""
+import contextvars
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import ContextDecorator
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger('dreambot.perf')
+
+# Поля ответа Ollama; *_duration — наносекунды
+LLM_COUNTERS = ('prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration', 'total_duration')
+
+_current = contextvars.ContextVar('dreambot_trace', default=None)
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = {}  # имя -> [секунды, входы]
+        self.queries = 0
+        self.query_time = 0.0
+        self.llm_calls = []
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            span = self.spans.setdefault(name, [0.0, 0])
+            span[0] += seconds
+            span[1] += 1
+
+    def add_query(self, sql, seconds):
+        write = not sql.lstrip()[:6].upper().startswith(('SELECT', 'PRAGMA', 'EXPLAI'))
+        with self._lock:
+            self.queries += 1
+            self.query_time += seconds
+        self.add_span('db.write' if write else 'db.read', seconds)
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.started
+        return self
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'ms': round((self.duration or 0) * 1000, 1),
+            'queries': self.queries,
+            'query_ms': round(self.query_time * 1000, 1),
+            'spans': {name: {'ms': round(s * 1000, 1), 'count': n} for name, (s, n) in self.spans.items()},
+            'llm': self.llm_calls,
+            **self.tags,
+        }
+
+    def server_timing(self):
+        parts = [f'total;dur={(self.duration or 0) * 1000:.1f}', f'db;dur={self.query_time * 1000:.1f}']
+        parts += [f'{name};dur={s * 1000:.1f}' for name, (s, _) in self.spans.items() if not name.startswith('db.')]
+        return ', '.join(parts)
+
+
+def current_trace():
+    return _current.get()
+
+
+def start_trace(name):
+    trace = Trace(name)
+    return trace, _current.set(trace)
+
+
+def end_trace(trace, token=None):
+    if token is not None:
+        _current.reset(token)
+    report(trace.finish())
+    return trace
+
+
+class span(ContextDecorator):
+    """Участок трассы: with span('llm'): ... или @span('context'). Без трассы — ничего."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def _recreate_cm(self):
+        # Декоратор: свой экземпляр на вызов, иначе параллельные вызовы делят started
+        return span(self.name)
+
+    def __enter__(self):
+        self.trace = _current.get()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add_span(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def tag(**values):
+    """Поля для записи в лог текущей трассы (user_id, route...)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.tags.update(values)
+
+
+def record_llm(data, model=''):
+    """Счётчики Ollama из ответа /api/chat (или последнего чанка потока) в текущую трассу."""
+    trace = _current.get()
+    if trace is None or not isinstance(data, dict):
+        return
+    call = {'model': data.get('model') or model}
+    for key in LLM_COUNTERS:
+        if key in data:
+            value = data[key]
+            call[key.replace('_duration', '_ms')] = round(value / 1e6, 1) if key.endswith('_duration') else value
+    with trace._lock:
+        trace.llm_calls.append(call)
+
+
+def should_log(trace):
+    if trace.duration * 1000 >= settings.PERF_SLOW_REQUEST_MS:
+        return logging.WARNING
+    if settings.PERF_SAMPLE_RATE and random.random() < settings.PERF_SAMPLE_RATE:
+        return logging.INFO
+    return None
+
+
+def report(trace):
+    level = should_log(trace)
+    if level is not None:
+        logger.log(level, json.dumps(trace.as_dict(), ensure_ascii=False, default=str))
+
+
+def _record_query(execute, sql, params, many, context):
+    trace = _current.get()
+    if trace is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        trace.add_query(sql, time.perf_counter() - started)
+
+
+def _install_query_hook(sender, connection, **kwargs):
+    # Объект соединения переживает переподключения — обёртку добавляем один раз
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def install():
+    """Подключает учёт SQL ко всем новым соединениям (DreambotConfig.ready)."""
+    connection_created.connect(_install_query_hook, dispatch_uid='dreambot_instrumentation')
+
+
+class InstrumentationMiddleware:
+    """Трасса на каждый HTTP-запрос. Потоковый ответ учитывается целиком — до закрытия."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.PERF_INSTRUMENTATION:
+            return self.get_response(request)
+        trace, token = start_trace(f'{request.method} {request.path}')
+        request.trace = trace
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(trace, response)
+
+    async def __acall__(self, request):
+        if not settings.PERF_INSTRUMENTATION:
+            return await self.get_response(request)
+        trace, token = start_trace(f'{request.method} {request.path}')
+        request.trace = trace
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(trace, response)
+
+    def _finish(self, trace, response):
+        trace.tags['status'] = response.status_code
+        if response.streaming:
+            response._resource_closers.append(lambda: end_trace(trace))
+            return response
+        end_trace(trace)
+        if settings.PERF_SERVER_TIMING:
+            response['Server-Timing'] = trace.server_timing()
+        return response
+
+
+class activate:
+    """Делает trace текущей в блоке — для генераторов потоковых ответов, которые выполняются вне middleware."""
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.token = _current.set(self.trace) if self.trace is not None else None
+        return self.trace
+
+    def __exit__(self, *exc):
+        if self.token is not None:
+            try:
+                _current.reset(self.token)
+            except ValueError:
+                # Генератор дочитан уже в другом контексте (ASGI-сервер)
+                _current.set(None)
+        return False
+
+
+def traced_handler(callback):
+    """Обёртка обработчика Telegram: своя трасса на каждый вызов, имя — telegram:<функция>."""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if not settings.PERF_INSTRUMENTATION:
+            return await callback(update, context)
+        trace, token = start_trace(f'telegram:{callback.__name__}')
+        try:
+            return await callback(update, context)
+        finally:
+            end_trace(trace, token)
+
+    return wrapper
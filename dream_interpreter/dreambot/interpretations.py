@@ -0,0 +1,183 @@
+# dreambot/interpretations.py
+"""
+Кэш интерпретаций с объединением одинаковых запросов (single-flight).
+
+Двойной клик «Отправить» и повторные доставки Telegram присылают тот же сон
+с тем же контекстом — вторая генерация в Ollama ничего не добавляет. Ключ кэша —
+хэш нормализованного текста сна, пользователя и сообщений промпта перед сном
+(см. context.build_llm_messages), так что любой новый сон в истории даёт новый ключ.
+
+- готовый ответ лежит в LRU-кэше (INTERPRETATION_CACHE_SIZE) с TTL
+  (INTERPRETATION_CACHE_TTL) и отдаётся без обращения к Ollama;
+- если такой же запрос уже генерируется, остальные ждут его результата
+  (join/ajoin), а не запускают свою генерацию. Если генерация оборвалась
+  (клиент ушёл посреди потока), один из ждущих становится новым лидером.
+
+    reply, flight = get_interpretation_cache().join(key)
+    if reply is None:              # мы лидер — генерируем сами
+        try:
+            reply = generate()
+        finally:
+            cache.finish(key, flight, reply)
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def normalize_dream_text(text):
+    return ' '.join(text.lower().split())
+
+
+def interpretation_key(user_id, context, text, route=None):
+    """context — строка или список сообщений /api/chat (без самого сна); route — маршрут генерации."""
+    if not isinstance(context, str):
+        context = json.dumps(context, ensure_ascii=False, sort_keys=True)
+    model = f"{route.name}:{route.model}" if route is not None else settings.OLLAMA_MODEL
+    context_hash = hashlib.sha256(f"{model}\0{context}".encode()).hexdigest()
+    return hashlib.sha256(f"{user_id}\0{context_hash}\0{normalize_dream_text(text)}".encode()).hexdigest()
+
+
+class Flight:
+    """Генерация в процессе; ждущие получают её результат (None — генерация оборвалась)."""
+
+    def __init__(self):
+        self.result = None
+        self.done = False
+        self._event = threading.Event()
+        self._futures = []
+
+    def _finish(self, result):
+        # Вызывается под замком кэша
+        self.result = result
+        self.done = True
+        self._event.set()
+        for loop, future in self._futures:
+            loop.call_soon_threadsafe(_resolve, future)
+        self._futures.clear()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class InterpretationCache:
+    def __init__(self, maxsize=1000, ttl=900.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, reply)
+        self._flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= self.clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key, reply):
+        with self._lock:
+            self._put(key, reply)
+
+    def _put(self, key, reply):
+        self._entries[key] = (self.clock() + self.ttl, reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _claim(self, key):
+        """(ответ, None, False) — из кэша; (None, flight, True) — мы лидер; (None, flight, False) — ждём лидера."""
+        reply = self._get(key)
+        if reply is not None:
+            self.hits += 1
+            return reply, None, False
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return None, flight, False
+        self.misses += 1
+        flight = self._flights[key] = Flight()
+        return None, flight, True
+
+    def join(self, key):
+        """Возвращает (ответ, None) или (None, flight) — тогда генерирует вызывающий и обязан вызвать finish."""
+        while True:
+            with self._lock:
+                reply, flight, leader = self._claim(key)
+            if reply is not None or leader:
+                return reply, flight
+            flight._event.wait()
+            if flight.result is not None:
+                return flight.result, None
+
+    async def ajoin(self, key):
+        while True:
+            future = None
+            with self._lock:
+                reply, flight, leader = self._claim(key)
+                if flight is not None and not leader and not flight.done:
+                    loop = asyncio.get_running_loop()
+                    future = loop.create_future()
+                    flight._futures.append((loop, future))
+            if reply is not None or leader:
+                return reply, flight
+            if future is not None:
+                await future
+            if flight.result is not None:
+                return flight.result, None
+
+    def finish(self, key, flight, reply, store=True):
+        """Завершает генерацию лидера; reply=None — оборвалась, ждущие попробуют сами."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if reply is not None and store:
+                self._put(key, reply)
+            flight._finish(reply)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_interpretation_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = InterpretationCache(
+                    maxsize=settings.INTERPRETATION_CACHE_SIZE,
+                    ttl=settings.INTERPRETATION_CACHE_TTL,
+                )
+    return _cache
+
+
+def reset_interpretation_cache():
+    global _cache
+    with _cache_lock:
+        _cache = None
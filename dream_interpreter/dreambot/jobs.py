@@ -0,0 +1,162 @@
+# dreambot/jobs.py
+"""
+Асинхронные интерпретации: /api/message/?async=1 сохраняет сон,
+создаёт InterpretationJob и сразу возвращает job id. Генерацию выполняет
+пул фоновых потоков, клиент забирает ответ через /api/jobs/<id>/ (long-poll).
+
+Состояние задач хранится в БД, поэтому после перезапуска процесса
+незавершённые задачи подхватываются заново (resume_pending_jobs).
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import InterpretationJob, Message
+from .routing import choose_route
+from .scheduler import get_scheduler, priority_for
+
+logger = logging.getLogger(__name__)
+
+# Ожидающие long-poll в этом процессе: (event loop, future) — будим, как только задача завершилась
+_waiters = set()
+_waiters_lock = threading.Lock()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _notify_finished():
+    with _waiters_lock:
+        waiters = list(_waiters)
+        _waiters.clear()
+    for loop, future in waiters:
+        loop.call_soon_threadsafe(_resolve, future)
+
+
+def run_job(job_id, ticket=None):
+    """Выполняет задачу, если удалось её захватить (pending → running)."""
+    from .views import get_llm_response
+
+    close_old_connections()
+    try:
+        claimed = InterpretationJob.objects.filter(id=job_id, status=InterpretationJob.PENDING).update(
+            status=InterpretationJob.RUNNING, started_at=timezone.now()
+        )
+        if not claimed:
+            # Задачу уже выполняет другой поток/процесс или она завершена
+            if ticket is not None:
+                ticket.release()
+            return
+        job = InterpretationJob.objects.select_related('user', 'session', 'user_message').get(id=job_id)
+        if ticket is None:
+            # Задача поднята после перезапуска — допуск в очередь уже был пройден
+            ticket = get_scheduler().enqueue(priority_for(job.user), admit=False)
+        route = choose_route(job.user, job.user_message.content)
+        try:
+            try:
+                bot_reply = get_llm_response(
+                    job.user, job.user_message.content, session=job.session, ticket=ticket, route=route,
+                )
+            finally:
+                ticket.release()
+            if not bot_reply:
+                bot_reply = "Извини, произошла ошибка при генерации ответа. Попробуй ещё раз? 😊"
+            bot_message = Message.objects.create(
+                session=job.session, is_user=False, content=bot_reply, route=route.name,
+            )
+            InterpretationJob.objects.filter(id=job_id).update(
+                status=InterpretationJob.DONE, bot_message=bot_message, finished_at=timezone.now()
+            )
+        except Exception as e:
+            logger.error(f"Interpretation job {job_id} failed: {e}", exc_info=True)
+            InterpretationJob.objects.filter(id=job_id).update(
+                status=InterpretationJob.FAILED, finished_at=timezone.now()
+            )
+    finally:
+        _notify_finished()
+        close_old_connections()
+
+
+class JobPool:
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dream-job')
+
+    def submit(self, job_id, ticket=None):
+        return self.executor.submit(run_job, job_id, ticket)
+
+
+def resume_pending_jobs(pool):
+    """
+    Ставит в пул задачи, оставшиеся от прошлого запуска: все pending и те running,
+    что зависли дольше JOB_STALE_AFTER (процесс, который их выполнял, умер).
+    """
+    stale_before = timezone.now() - timedelta(seconds=settings.JOB_STALE_AFTER)
+    InterpretationJob.objects.filter(
+        status=InterpretationJob.RUNNING, started_at__lt=stale_before
+    ).update(status=InterpretationJob.PENDING, started_at=None)
+    job_ids = list(
+        InterpretationJob.objects.filter(status=InterpretationJob.PENDING)
+        .order_by('created_at').values_list('id', flat=True)
+    )
+    for job_id in job_ids:
+        pool.submit(job_id)
+    if job_ids:
+        logger.info(f"Resumed {len(job_ids)} interpretation jobs")
+    return job_ids
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_job_pool():
+    """Пул создаётся лениво; при создании подхватывает незавершённые задачи."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = JobPool(settings.JOB_WORKERS)
+                try:
+                    resume_pending_jobs(pool)
+                except Exception as e:
+                    logger.error(f"Failed to resume interpretation jobs: {e}", exc_info=True)
+                _pool = pool
+    return _pool
+
+
+async def wait_for_job(job_id, timeout):
+    """
+    Long-poll: ждёт завершения задачи не дольше timeout секунд, не занимая поток.
+    Внутри процесса просыпается сразу по сигналу воркера; задачи из других
+    процессов замечает, перечитывая БД раз в секунду.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + timeout
+    while True:
+        # Подписываемся до чтения БД: задача, завершённая между чтением и ожиданием, всё равно разбудит
+        future = loop.create_future()
+        with _waiters_lock:
+            _waiters.add((loop, future))
+        try:
+            job = await InterpretationJob.objects.select_related('bot_message').filter(id=job_id).afirst()
+            if job is None or job.status in (InterpretationJob.DONE, InterpretationJob.FAILED):
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            try:
+                await asyncio.wait_for(future, timeout=min(1.0, remaining))
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            with _waiters_lock:
+                _waiters.discard((loop, future))
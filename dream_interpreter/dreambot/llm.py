@@ -0,0 +1,483 @@
+# dreambot/llm.py
+"""
+Общий клиент Ollama для веба и Telegram-бота.
+
+- LLMClient держит пул keep-alive соединений (requests.Session),
+  AsyncLLMClient — то же самое на httpx для асинхронного кода бота.
+- Адрес, модель, таймаут и температура берутся из settings (OLLAMA_*).
+  Серверов может быть несколько (OLLAMA_BACKENDS): каждый запрос и каждый
+  повтор выбирает сервер в BackendPool (dreambot/backends.py).
+- Интерпретации идут через /api/chat (chat/stream_chat); каждый запрос
+  передаёт keep_alive (OLLAMA_KEEP_ALIVE), чтобы модель и KV-кэш общего
+  системного промпта не выгружались между редкими запросами.
+- Ошибки соединения и 5xx повторяются ограниченное число раз с джиттером.
+- Circuit breaker: после серии неудач запросы сразу падают с LLMUnavailable,
+  вместо того чтобы каждый раз ждать таймаут и держать поток.
+"""
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .backends import Backend, BackendPool, HealthChecker, parse_backends
+from .instrumentation import record_llm
+from .metrics import observe_generation
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    """Базовая ошибка обращения к LLM."""
+
+
+class LLMConnectionError(LLMError):
+    """Не удалось подключиться к Ollama."""
+
+
+class LLMTimeout(LLMError):
+    """Ollama не ответила за отведённое время."""
+
+
+class LLMRequestError(LLMError):
+    """Ollama ответила ошибкой или некорректными данными."""
+
+
+class LLMUnavailable(LLMConnectionError):
+    """Нет доступного сервера (breaker'ы разомкнуты или проверка не пройдена) — запрос даже не отправлялся."""
+
+
+class _ServerError(LLMRequestError):
+    """5xx от Ollama — такой запрос имеет смысл повторить."""
+
+
+class CircuitBreaker:
+    """
+    Классический breaker: closed → open (после failure_threshold неудач подряд)
+    → half-open (после reset_timeout пропускает один пробный запрос) → closed.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+
+
+def backoff_delay(attempt, base):
+    """Экспоненциальная задержка с полным джиттером: U(0, base * 2^attempt)."""
+    return random.uniform(0, base * (2 ** attempt))
+
+
+def parse_keep_alive(value):
+    """'30m' / '1h' — строка длительности Ollama, '-1' / '600' — секунды числом, '' — по умолчанию Ollama."""
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class _BaseLLMClient:
+    def __init__(self, base_url=None, model=None, timeout=None, temperature=None,
+                 max_retries=None, retry_backoff=None, breaker=None, keep_alive=None, pool=None):
+        if pool is None:
+            # Клиент к одному серверу (тесты, бенчмарки); общие клиенты получают get_pool()
+            base_url = (base_url or settings.OLLAMA_URL).rstrip('/')
+            pool = BackendPool([Backend(base_url, breaker=breaker or get_breaker(base_url))])
+        self.pool = pool
+        self.model = model or settings.OLLAMA_MODEL
+        self.timeout = timeout if timeout is not None else settings.OLLAMA_TIMEOUT
+        self.temperature = temperature if temperature is not None else settings.OLLAMA_TEMPERATURE
+        self.max_retries = max_retries if max_retries is not None else settings.LLM_MAX_RETRIES
+        self.retry_backoff = retry_backoff if retry_backoff is not None else settings.LLM_RETRY_BACKOFF
+        self.keep_alive = parse_keep_alive(keep_alive if keep_alive is not None else settings.OLLAMA_KEEP_ALIVE)
+
+    def _payload(self, prompt, stream, options=None, model=None):
+        return self._with_defaults({"prompt": prompt}, stream, options, model)
+
+    def _chat_payload(self, messages, stream, options=None, model=None):
+        return self._with_defaults({"messages": messages}, stream, options, model)
+
+    def _with_defaults(self, payload, stream, options, model):
+        payload = {
+            "model": model or self.model,
+            **payload,
+            "stream": stream,
+            "options": {"temperature": self.temperature, **(options or {})},
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    @property
+    def breaker(self):
+        """Breaker первого сервера пула (для клиента к одному серверу — его единственный)."""
+        return self.pool.backends[0].breaker
+
+    def _acquire(self, model):
+        backend = self.pool.acquire(model)
+        if backend is None:
+            raise LLMUnavailable(f"No available Ollama backend for {model}")
+        return backend
+
+    @staticmethod
+    def _parse_line(line):
+        chunk = json.loads(line)
+        if chunk.get("error"):
+            raise LLMRequestError(chunk["error"])
+        return chunk
+
+    @staticmethod
+    def _token(chunk):
+        # /api/generate: {"response": ...}; /api/chat: {"message": {"content": ...}}
+        if "message" in chunk:
+            return (chunk["message"] or {}).get("content", "")
+        return chunk.get("response", "")
+
+
+class LLMClient(_BaseLLMClient):
+    """Синхронный клиент с пулом соединений; безопасен для использования из разных потоков."""
+
+    def __init__(self, *args, pool_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        size = pool_size or settings.LLM_POOL_SIZE
+        hosts = len(self.pool.backends)
+        self.session.mount('http://', HTTPAdapter(pool_connections=hosts, pool_maxsize=size))
+        self.session.mount('https://', HTTPAdapter(pool_connections=hosts, pool_maxsize=size))
+
+    def _post(self, path, payload, stream=False):
+        """(backend, response); после чтения ответа backend возвращается в пул через pool.release."""
+        attempt = 0
+        while True:
+            backend = self._acquire(payload["model"])
+            try:
+                response = self.session.post(
+                    f"{backend.url}{path}", json=payload, timeout=self.timeout, stream=stream
+                )
+                if response.status_code >= 500:
+                    response.close()
+                    raise _ServerError(f"Ollama HTTP {response.status_code}")
+                if response.status_code >= 400:
+                    # Ошибка клиента (например, неизвестная модель) — повторять бессмысленно,
+                    # и backend при этом жив.
+                    backend.breaker.record_success()
+                    text = response.text
+                    response.close()
+                    raise LLMRequestError(f"Ollama HTTP {response.status_code}: {text[:200]}")
+            except requests.exceptions.ConnectionError as e:
+                error = LLMConnectionError(str(e))
+            except requests.exceptions.Timeout as e:
+                error = LLMTimeout(str(e))
+            except requests.exceptions.RequestException as e:
+                error = LLMRequestError(str(e))
+            except _ServerError as e:
+                error = e
+            except LLMRequestError:
+                self.pool.release(backend)
+                raise
+            else:
+                backend.breaker.record_success()
+                return backend, response
+
+            backend.breaker.record_failure()
+            self.pool.release(backend)
+            # Таймаут генерации не повторяем: модель просто перегружена, повтор только удвоит ожидание
+            if attempt >= self.max_retries or isinstance(error, LLMTimeout):
+                raise error
+            delay = backoff_delay(attempt, self.retry_backoff)
+            logger.warning(f"Ollama request failed ({error}), retry {attempt + 1} in {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def _json(self, path, payload):
+        backend, response = self._post(path, payload)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise LLMRequestError(f"Invalid JSON from Ollama: {e}")
+        finally:
+            self.pool.release(backend)
+
+    def generate(self, prompt, options=None, model=None):
+        """Полный (не потоковый) ответ /api/generate. Возвращает JSON Ollama."""
+        return self._json("/api/generate", self._payload(prompt, False, options, model))
+
+    def chat(self, messages, options=None, model=None):
+        """Полный ответ /api/chat: текст — в data["message"]["content"]."""
+        payload = self._chat_payload(messages, False, options, model)
+        data = self._json("/api/chat", payload)
+        record_llm(data, payload["model"])
+        observe_generation(data, payload["model"])
+        return data
+
+    def embed(self, texts, model):
+        """Векторы /api/embed для списка текстов."""
+        payload = {"model": model, "input": list(texts)}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        data = self._json("/api/embed", payload)
+        if not isinstance(data.get("embeddings"), list):
+            raise LLMRequestError("No embeddings in Ollama response")
+        return data["embeddings"]
+
+    def stream(self, prompt, options=None, model=None):
+        """Генератор токенов /api/generate со stream=True."""
+        return self._stream("/api/generate", self._payload(prompt, True, options, model))
+
+    def stream_chat(self, messages, options=None, model=None):
+        """Генератор токенов /api/chat со stream=True."""
+        return self._stream("/api/chat", self._chat_payload(messages, True, options, model))
+
+    def _stream(self, path, payload):
+        backend, response = self._post(path, payload, stream=True)
+        # Запрос считается незавершённым, пока не дочитан поток
+        with response:
+            try:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = self._parse_line(line)
+                    token = self._token(chunk)
+                    if token:
+                        yield token
+                    if chunk.get("done"):
+                        # Последний чанк несёт счётчики генерации
+                        record_llm(chunk, payload["model"])
+                        observe_generation(chunk, payload["model"])
+                        break
+            except requests.exceptions.Timeout as e:
+                raise LLMTimeout(str(e))
+            except requests.exceptions.RequestException as e:
+                raise LLMConnectionError(str(e))
+            finally:
+                self.pool.release(backend)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncLLMClient(_BaseLLMClient):
+    """Асинхронный двойник LLMClient на httpx. Привязан к одному event loop."""
+
+    def __init__(self, *args, pool_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        size = pool_size or settings.LLM_POOL_SIZE
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+        )
+
+    async def _send(self, path, payload, stream=False):
+        attempt = 0
+        while True:
+            backend = self._acquire(payload["model"])
+            try:
+                request = self.client.build_request("POST", f"{backend.url}{path}", json=payload)
+                response = await self.client.send(request, stream=stream)
+                if response.status_code >= 500:
+                    await response.aclose()
+                    raise _ServerError(f"Ollama HTTP {response.status_code}")
+                if response.status_code >= 400:
+                    backend.breaker.record_success()
+                    await response.aread()
+                    await response.aclose()
+                    raise LLMRequestError(f"Ollama HTTP {response.status_code}: {response.text[:200]}")
+            except httpx.ConnectError as e:
+                error = LLMConnectionError(str(e))
+            except httpx.TimeoutException as e:
+                error = LLMTimeout(str(e))
+            except httpx.HTTPError as e:
+                error = LLMRequestError(str(e))
+            except _ServerError as e:
+                error = e
+            except LLMRequestError:
+                self.pool.release(backend)
+                raise
+            else:
+                backend.breaker.record_success()
+                return backend, response
+
+            backend.breaker.record_failure()
+            self.pool.release(backend)
+            # Таймаут генерации не повторяем: модель просто перегружена, повтор только удвоит ожидание
+            if attempt >= self.max_retries or isinstance(error, LLMTimeout):
+                raise error
+            delay = backoff_delay(attempt, self.retry_backoff)
+            logger.warning(f"Ollama request failed ({error}), retry {attempt + 1} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _json(self, path, payload):
+        backend, response = await self._send(path, payload)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise LLMRequestError(f"Invalid JSON from Ollama: {e}")
+        finally:
+            self.pool.release(backend)
+
+    async def generate(self, prompt, options=None, model=None):
+        return await self._json("/api/generate", self._payload(prompt, False, options, model))
+
+    async def chat(self, messages, options=None, model=None):
+        payload = self._chat_payload(messages, False, options, model)
+        data = await self._json("/api/chat", payload)
+        record_llm(data, payload["model"])
+        observe_generation(data, payload["model"])
+        return data
+
+    def stream(self, prompt, options=None, model=None):
+        return self._stream("/api/generate", self._payload(prompt, True, options, model))
+
+    def stream_chat(self, messages, options=None, model=None):
+        return self._stream("/api/chat", self._chat_payload(messages, True, options, model))
+
+    async def _stream(self, path, payload):
+        backend, response = await self._send(path, payload, stream=True)
+        try:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = self._parse_line(line)
+                token = self._token(chunk)
+                if token:
+                    yield token
+                if chunk.get("done"):
+                    record_llm(chunk, payload["model"])
+                    observe_generation(chunk, payload["model"])
+                    break
+        except httpx.TimeoutException as e:
+            raise LLMTimeout(str(e))
+        except httpx.HTTPError as e:
+            raise LLMConnectionError(str(e))
+        finally:
+            self.pool.release(backend)
+            await response.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# --- Общие экземпляры ---
+
+_lock = threading.RLock()
+_breakers = {}
+_pool = None
+_health_checker = None
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_breaker(base_url):
+    """Один breaker на адрес Ollama — общий для синхронного и асинхронного клиентов."""
+    with _lock:
+        if base_url not in _breakers:
+            _breakers[base_url] = CircuitBreaker(
+                failure_threshold=settings.LLM_BREAKER_THRESHOLD,
+                reset_timeout=settings.LLM_BREAKER_RESET_TIMEOUT,
+            )
+        return _breakers[base_url]
+
+
+def get_pool():
+    """Пул серверов из OLLAMA_BACKENDS (или один OLLAMA_URL); при нескольких запускает HealthChecker."""
+    global _pool, _health_checker
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                configured = parse_backends(settings.OLLAMA_BACKENDS) or [
+                    {'url': settings.OLLAMA_URL.rstrip('/'), 'weight': 1.0, 'models': None}
+                ]
+                pool = BackendPool([
+                    Backend(b['url'], breaker=get_breaker(b['url']), weight=b['weight'], models=b['models'])
+                    for b in configured
+                ])
+                if len(pool.backends) > 1 and settings.OLLAMA_HEALTH_INTERVAL > 0:
+                    _health_checker = HealthChecker(
+                        pool, settings.OLLAMA_HEALTH_INTERVAL, settings.OLLAMA_HEALTH_TIMEOUT,
+                    ).start()
+                _pool = pool
+    return _pool
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = LLMClient(pool=get_pool())
+    return _client
+
+
+def get_async_client():
+    """AsyncLLMClient для текущего event loop (httpx-пул нельзя делить между циклами)."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncLLMClient(pool=get_pool())
+        _async_clients[loop] = client
+    return client
+
+
+def reset_clients():
+    """Сбрасывает общие клиенты, пул серверов и breaker'ы (для тестов и смены настроек)."""
+    global _client, _pool, _health_checker
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        if _health_checker is not None:
+            _health_checker.stop()
+        _pool = _health_checker = None
+        _breakers.clear()
+        _async_clients.clear()
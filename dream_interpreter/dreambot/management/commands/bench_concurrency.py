@@ -0,0 +1,114 @@
+"""
+Сравнение пропускной способности /api/message/ в модели WSGI и ASGI
+на заглушке Ollama с фиксированной задержкой генерации.
+
+WSGI моделируется пулом из --workers потоков (как синхронные воркеры gunicorn):
+одновременно «висящих» интерпретаций не больше, чем воркеров.
+ASGI — один event loop, все запросы ждут LLM одновременно.
+
+    python manage.py bench_concurrency --requests 100 --workers 4 --delay 2
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+from dreambot import llm, scheduler
+from dreambot.models import User
+from dreambot.stub_ollama import StubOllama
+
+
+def _fast_sqlite(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=OFF')
+
+
+class Command(BaseCommand):
+    help = "Бенчмарк одновременных интерпретаций: WSGI (пул потоков) против ASGI (event loop)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50)
+        parser.add_argument('--workers', type=int, default=4, help="число синхронных WSGI-воркеров")
+        parser.add_argument('--delay', type=float, default=2.0, help="задержка заглушки LLM, секунды")
+
+    def handle(self, *args, **options):
+        n, workers, delay = options['requests'], options['workers'], options['delay']
+        # Отдельная временная БД-файл (in-memory SQLite с shared cache блокирует таблицы между потоками)
+        tmpdir = tempfile.mkdtemp()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        # Меряем ожидание LLM, а не fsync диска: временной БД долговечность не нужна
+        connection_created.connect(_fast_sqlite)
+        connection.close()
+        try:
+            with StubOllama(delay=delay) as stub, override_settings(
+                OLLAMA_URL=stub.url, LLM_MAX_CONCURRENCY=n, LLM_QUEUE_SLA=10 ** 6, LLM_MAX_RETRIES=0,
+                LLM_POOL_SIZE=n, ALLOWED_HOSTS=['testserver'], SUMMARIES_ENABLED=False,
+            ):
+                users = [
+                    User.objects.create_user(phone_number=f"+7999{i:07d}", name=f"Bench {i}")
+                    for i in range(n)
+                ]
+                User.objects.update(is_premium=True)  # без дневного лимита
+
+                rows = [
+                    ('WSGI', workers) + self._run_wsgi(stub, users, workers),
+                    ('ASGI', 1) + self._run_asgi(stub, users),
+                ]
+        finally:
+            connection_created.disconnect(_fast_sqlite)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.stdout.write(f"{n} запросов, задержка LLM {delay:.2f} с")
+        self.stdout.write(f"{'режим':<6} {'воркеры':>8} {'время, с':>9} {'запр/с':>8} {'пик LLM':>8}")
+        for mode, w, elapsed, peak in rows:
+            self.stdout.write(f"{mode:<6} {w:>8} {elapsed:>9.2f} {n / elapsed:>8.1f} {peak:>8}")
+
+    def _reset(self, stub):
+        llm.reset_clients()
+        scheduler.reset_scheduler()
+        stub.peak_in_flight = 0
+
+    def _run_wsgi(self, stub, users, workers):
+        self._reset(stub)
+
+        def send(user):
+            client = Client()
+            client.force_login(user)
+            response = client.post('/api/message/', data={'text': 'Мне снилось море'},
+                                   content_type='application/json')
+            assert response.status_code == 200, response.content
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(send, users))
+        return time.perf_counter() - started, stub.peak_in_flight
+
+    def _run_asgi(self, stub, users):
+        self._reset(stub)
+
+        async def send(user):
+            client = AsyncClient()
+            await client.aforce_login(user)
+            response = await client.post('/api/message/', data={'text': 'Мне снилось море'},
+                                         content_type='application/json')
+            assert response.status_code == 200, response.content
+
+        async def main():
+            started = time.perf_counter()
+            await asyncio.gather(*(send(user) for user in users))
+            return time.perf_counter() - started
+
+        elapsed = asyncio.run(main())
+        return elapsed, stub.peak_in_flight
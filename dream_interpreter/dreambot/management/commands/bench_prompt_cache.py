@@ -0,0 +1,138 @@
+"""
+Сколько времени разбора промпта экономит раскладка под KV-кэш Ollama.
+
+Один и тот же сценарий прогоняется двумя способами:
+- «до» — прежний текстовый промпт /api/generate: сразу за SYSTEM_PROMPT профиль,
+  затем сообщения текущего диалога и только потом прошлые сны;
+- «после» — /api/chat (context.build_llm_messages): общий SYSTEM_PROMPT отдельным
+  системным сообщением, дальше контекст от стабильного к изменчивому.
+
+Сценарий: --users пользователей с прошлыми снами по очереди присылают по --rounds
+снов в новой сессии. Итог — суммы prompt_eval_count и prompt_eval_duration из
+ответов Ollama. Краткие содержания выключены в обоих прогонах.
+
+    python manage.py bench_prompt_cache                    # Ollama из OLLAMA_URL
+    python manage.py bench_prompt_cache --stub --slots 4   # заглушка с моделью KV-кэша
+
+На настоящей Ollama прогон «до» идёт первым и частично прогревает кэш общим
+SYSTEM_PROMPT — это играет в его пользу, а не против.
+"""
+import os
+import shutil
+import tempfile
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from dreambot.context import (
+    HISTORY_HINT, SESSION_HINT, SYSTEM_PROMPT, build_llm_messages, current_session_lines,
+    previous_dream_lines, user_profile_lines,
+)
+from dreambot.llm import LLMClient
+from dreambot.models import DreamSession, Message, User
+from dreambot.stub_ollama import StubOllama
+
+DREAMS = [
+    "Мне снилось, что я опаздываю на поезд и не могу найти свой вагон",
+    "Я плыл по тёмному морю, а вдалеке горел маяк",
+    "Снился старый дом бабушки, все комнаты были пустыми",
+    "Я летал над городом и боялся упасть",
+    "Снилось, что я сдаю экзамен, к которому не готовился",
+]
+
+
+def legacy_prompt(user, dream, session):
+    """Прежняя раскладка: один текст, профиль сразу за SYSTEM_PROMPT, текущий диалог перед прошлыми снами."""
+    prompt = SYSTEM_PROMPT
+    profile = user_profile_lines(user)
+    if profile:
+        prompt += "\n\n" + "\n".join(profile)
+    current = current_session_lines(session, dream, summaries=False)
+    previous = previous_dream_lines(user, session, summaries=False)
+    parts = []
+    if current:
+        parts.append("Контекст текущего диалога:\n" + "\n".join(current))
+    if previous:
+        parts.append("\nПредыдущие сны пользователя:\n" + "\n".join(previous))
+        parts.append("\n" + HISTORY_HINT)
+    elif current:
+        parts.append("\n" + SESSION_HINT)
+    if parts:
+        prompt += "\n\n" + "\n".join(parts)
+    return f"{prompt}\n\nНовый сон:\n{dream}"
+
+
+class Command(BaseCommand):
+    help = "Бенчмарк разбора промпта: текстовый промпт против /api/chat с общим системным префиксом"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=4)
+        parser.add_argument('--rounds', type=int, default=3, help="снов от каждого пользователя в сессии")
+        parser.add_argument('--history', type=int, default=4, help="прошлых сессий у каждого пользователя")
+        parser.add_argument('--num-predict', type=int, default=16, help="лимит токенов ответа (меряем разбор промпта)")
+        parser.add_argument('--stub', action='store_true', help="заглушка вместо настоящей Ollama")
+        parser.add_argument('--slots', type=int, default=1, help="слотов KV-кэша в заглушке (OLLAMA_NUM_PARALLEL)")
+        parser.add_argument('--eval-time', type=float, default=0.0002, help="заглушка: секунд на токен промпта")
+
+    def handle(self, *args, **options):
+        # Временная БД: сценарий пишет пользователей и сообщения
+        tmpdir = tempfile.mkdtemp()
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        stub = StubOllama(prompt_eval_time=options['eval_time'], cache_slots=options['slots']) if options['stub'] else None
+        try:
+            with stub or nullcontext(), override_settings(SUMMARIES_ENABLED=False):
+                client = LLMClient(base_url=stub.url if stub else None, max_retries=0)
+                rows = [
+                    ('до', 'generate') + self._run(client, 'generate', options, series=1),
+                    ('после', 'chat') + self._run(client, 'chat', options, series=2),
+                ]
+                client.close()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.stdout.write(
+            f"{options['users']} польз. × {options['rounds']} снов, "
+            f"{'заглушка, слотов: ' + str(options['slots']) if stub else 'Ollama'}"
+        )
+        self.stdout.write(f"{'раскладка':<10} {'API':<9} {'токенов':>9} {'разбор, мс':>11} {'на запрос, мс':>14}")
+        for name, api, count, duration, requests in rows:
+            self.stdout.write(
+                f"{name:<10} {api:<9} {count:>9} {duration / 1e6:>11.0f} {duration / 1e6 / requests:>14.1f}"
+            )
+        before, after = rows[0][3], rows[1][3]
+        if before:
+            self.stdout.write(f"Экономия времени разбора промпта: {1 - after / before:.1%}")
+
+    def _run(self, client, api, options, series):
+        """Возвращает (prompt_eval_count, prompt_eval_duration в нс, число запросов)."""
+        users = []
+        for u in range(options['users']):
+            user = User.objects.create_user(phone_number=f"+7{series}{u:09d}", name=f"Пользователь {u}")
+            for h in range(options['history']):
+                past = DreamSession.objects.create(user=user, is_active=False)
+                Message.objects.create(session=past, is_user=True, content=DREAMS[(u + h) % len(DREAMS)] + f" ({h})")
+                Message.objects.create(session=past, is_user=False, content="Интерпретация прошлого сна.")
+            users.append((user, DreamSession.objects.create(user=user, is_active=True)))
+
+        count = duration = requests = 0
+        llm_options = {'num_predict': options['num_predict']}
+        for r in range(options['rounds']):
+            for u, (user, session) in enumerate(users):
+                dream = DREAMS[(u + r) % len(DREAMS)] + f", ночь {r + 1}"
+                Message.objects.create(session=session, is_user=True, content=dream)
+                if api == 'chat':
+                    data = client.chat(build_llm_messages(user, dream, session=session, summaries=False),
+                                       options=llm_options)
+                    reply = data.get('message', {}).get('content', '')
+                else:
+                    data = client.generate(legacy_prompt(user, dream, session), options=llm_options)
+                    reply = data.get('response', '')
+                Message.objects.create(session=session, is_user=False, content=reply.strip() or "…")
+                count += data.get('prompt_eval_count', 0)
+                duration += data.get('prompt_eval_duration', 0)
+                requests += 1
+        return count, duration, requests
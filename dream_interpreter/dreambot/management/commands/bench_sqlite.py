@@ -0,0 +1,158 @@
+"""
+Конкуренция процессов за один файл SQLite: профиль Django по умолчанию
+против настроенного в settings.DATABASES (WAL, IMMEDIATE, timeout, прагмы).
+
+Процессы-писатели повторяют путь записи сна: половина — как сайт
+(quota.save_dream + ответ бота), половина — как Telegram-бот (сессия дня,
+handlers.active_session_for_today). Читатели в это время листают историю
+(history_page). LLM не вызывается — меряется только база.
+
+    python manage.py bench_sqlite --writers 4 --readers 2 --dreams 200
+
+Для каждого профиля — своя временная БД-файл.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+
+from dreambot.history import history_page
+from dreambot.models import Message, User
+from dreambot.quota import save_dream
+
+# Так Django открывает SQLite без OPTIONS: журнал DELETE, synchronous=FULL, DEFERRED, timeout 5 с
+DEFAULT_PROFILE = {'OPTIONS': {'init_command': 'PRAGMA journal_mode=DELETE'}, 'CONN_MAX_AGE': 0}
+
+
+def _writer(kind, user_id, dreams, results):
+    from telegram_bot.handlers import active_session_for_today
+
+    session_kwargs = {'get_session': active_session_for_today} if kind == 'bot' else {}
+    user = User.objects.get(pk=user_id)
+    latencies, errors = [], 0
+    for i in range(dreams):
+        started = time.perf_counter()
+        try:
+            session, _ = save_dream(user, f"Сон {i}: лечу над городом", **session_kwargs)
+            Message.objects.create(session=session, is_user=False, content=f"Толкование сна {i}")
+        except OperationalError:
+            # «database is locked»: на сайте это ошибка пользователю
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    results.put((kind, latencies, errors))
+
+
+def _reader(user_id, stop, results):
+    user = User.objects.get(pk=user_id)
+    latencies, errors = [], 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            history_page(user)
+        except OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    results.put(('reader', latencies, errors))
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Command(BaseCommand):
+    help = "Бенчмарк записи снов из нескольких процессов в SQLite: профиль по умолчанию против настроенного"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=4, help="процессов записи (сайт и бот поровну)")
+        parser.add_argument('--readers', type=int, default=2, help="процессов чтения истории")
+        parser.add_argument('--dreams', type=int, default=200, help="снов на процесс записи")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            self.stderr.write("Бенчмарк только для SQLite")
+            return
+        tuned = {
+            'OPTIONS': settings.DATABASES['default'].get('OPTIONS', {}),
+            'CONN_MAX_AGE': settings.DATABASES['default'].get('CONN_MAX_AGE', 0),
+        }
+        rows = []
+        # Кэш истории — в памяти процесса, фоновые индексация и краткие содержания не мешают замеру
+        with override_settings(
+            FREE_DREAMS_PER_DAY=10 ** 6, DREAM_RETRIEVAL=False, SUMMARIES_ENABLED=False,
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'history': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            },
+        ):
+            for name, profile in (('default', DEFAULT_PROFILE), ('tuned', tuned)):
+                rows.append((name,) + self._run(profile, options))
+
+        self.stdout.write(
+            f"{options['writers']} писателей × {options['dreams']} снов, {options['readers']} читателей"
+        )
+        self.stdout.write(
+            f"{'профиль':<8} {'время, с':>9} {'снов/с':>8} {'p50, мс':>8} {'p95, мс':>8} "
+            f"{'locked':>7} {'чтений/с':>9}"
+        )
+        for name, elapsed, latencies, errors, reads in rows:
+            self.stdout.write(
+                f"{name:<8} {elapsed:>9.2f} {len(latencies) / elapsed:>8.1f} "
+                f"{_percentile(latencies, 0.5) * 1000:>8.1f} {_percentile(latencies, 0.95) * 1000:>8.1f} "
+                f"{errors:>7} {reads / elapsed:>9.1f}"
+            )
+
+    def _run(self, profile, options):
+        writers, readers = options['writers'], options['readers']
+        saved = {key: connection.settings_dict.get(key) for key in ('OPTIONS', 'CONN_MAX_AGE')}
+        tmpdir = tempfile.mkdtemp()
+        connection.settings_dict.update(profile)
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            users = [
+                User.objects.create_user(phone_number=f"+7998{i:07d}", name=f"Bench {i}")
+                for i in range(writers + readers)
+            ]
+            # Дочерние процессы (fork) открывают свои соединения
+            connection.close()
+            ctx = multiprocessing.get_context('fork')
+            results, stop = ctx.Queue(), ctx.Event()
+            processes = [
+                ctx.Process(target=_writer, args=('web' if i % 2 else 'bot', users[i].pk, options['dreams'], results))
+                for i in range(writers)
+            ]
+            processes += [
+                ctx.Process(target=_reader, args=(users[writers + i].pk, stop, results))
+                for i in range(readers)
+            ]
+            started = time.perf_counter()
+            for process in processes:
+                process.start()
+            collected = [results.get() for _ in range(writers)]
+            elapsed = time.perf_counter() - started
+            stop.set()
+            collected += [results.get() for _ in range(readers)]
+            for process in processes:
+                process.join()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            connection.settings_dict.update(saved)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        latencies = [lat for kind, lats, _ in collected if kind != 'reader' for lat in lats]
+        errors = sum(err for _, _, err in collected)
+        reads = sum(len(lats) for kind, lats, _ in collected if kind == 'reader')
+        return elapsed, latencies, errors, reads
@@ -0,0 +1,25 @@
+"""
+Векторы для снов, записанных до появления индекса похожих снов (или пока
+Ollama с DREAM_EMBED_MODEL была недоступна). Повторный запуск досчитывает
+только недостающее.
+
+    python manage.py build_dream_index --batch 64
+"""
+from django.core.management.base import BaseCommand
+
+from dreambot.dream_index import index_messages
+from dreambot.models import Message
+
+
+class Command(BaseCommand):
+    help = "Досчитать векторы снов для поиска похожих"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=64, help="снов за один запрос к Ollama")
+
+    def handle(self, *args, **options):
+        ids = list(Message.objects.filter(is_user=True).order_by('id').values_list('id', flat=True))
+        created = 0
+        for start in range(0, len(ids), options['batch']):
+            created += index_messages(ids[start:start + options['batch']])
+        self.stdout.write(f"Снов: {len(ids)}, новых векторов: {created}")
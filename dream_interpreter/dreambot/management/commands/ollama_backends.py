@@ -0,0 +1,24 @@
+"""
+Состояние серверов Ollama из OLLAMA_BACKENDS: одна активная проверка и таблица.
+
+    python manage.py ollama_backends
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dreambot.llm import get_pool
+
+
+class Command(BaseCommand):
+    help = "Проверка серверов Ollama из пула"
+
+    def handle(self, *args, **options):
+        pool = get_pool()
+        pool.check_health(settings.OLLAMA_HEALTH_TIMEOUT)
+        self.stdout.write(f"{'сервер':<32} {'вес':>5} {'статус':<10} {'breaker':<10} модели")
+        for backend in pool.snapshot():
+            status = 'ok' if backend['healthy'] else 'недоступен'
+            self.stdout.write(
+                f"{backend['url']:<32} {backend['weight']:>5g} {status:<10} {backend['breaker']:<10} "
+                f"{', '.join(backend['models']) or '—'}"
+            )
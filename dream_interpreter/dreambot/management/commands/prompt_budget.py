@@ -0,0 +1,64 @@
+"""
+Отчёт о размере промпта: прежний (сырые отрывки сообщений и прошлых снов)
+против текущего (скользящие краткие содержания + непокрытый хвост).
+
+Для каждой из последних сессий с сообщениями промпт собирается так, как если бы
+пользователь заново прислал последний сон сессии.
+
+    python manage.py prompt_budget --sessions 200
+"""
+import math
+
+from django.core.management.base import BaseCommand
+
+from dreambot.context import build_llm_messages
+from dreambot.models import DreamSession, Message
+
+# Грубая оценка: в русском тексте токенизаторы Qwen/Llama дают ~3–4 символа на токен
+CHARS_PER_TOKEN = 3.5
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_tokens(m['content']) for m in messages)
+
+
+class Command(BaseCommand):
+    help = "Размер промпта до и после скользящих кратких содержаний"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=100, help="сколько последних сессий посчитать")
+
+    def handle(self, *args, **options):
+        sessions = (
+            DreamSession.objects.filter(message_count__gt=0).select_related('user')
+            .order_by('-last_activity')[:options['sessions']]
+        )
+        before, after = [], []
+        for session in sessions:
+            dream = (
+                Message.objects.filter(session=session, is_user=True)
+                .order_by('-created_at').values_list('content', flat=True).first()
+            )
+            if dream is None:
+                continue
+            for summaries, sizes in ((False, before), (True, after)):
+                messages = build_llm_messages(session.user, dream, session=session, summaries=summaries)
+                sizes.append(estimate_messages_tokens(messages))
+
+        if not before:
+            self.stdout.write("Нет сессий с сообщениями")
+            return
+        self.stdout.write(f"Сессий: {len(before)}, токены оценены как символы / {CHARS_PER_TOKEN}")
+        self.stdout.write(f"{'промпт':<12} {'среднее':>9} {'p95':>7} {'макс':>7} {'всего':>9}")
+        for name, sizes in (('до', before), ('после', after)):
+            ordered = sorted(sizes)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            self.stdout.write(
+                f"{name:<12} {sum(sizes) / len(sizes):>9.0f} {p95:>7} {ordered[-1]:>7} {sum(sizes):>9}"
+            )
+        saved = 1 - sum(after) / sum(before)
+        self.stdout.write(f"Экономия: {saved:.1%}")
@@ -0,0 +1,27 @@
+"""
+Пересобрать поисковый индекс истории (dreambot/search.py) по всем сообщениям —
+после миграции на существующей базе или если индекс разошёлся с данными.
+Новые сообщения индексируются сами (триггеры SQLite).
+
+    python manage.py rebuild_search_index --batch 1000
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from dreambot.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Пересобрать поисковый индекс сообщений пачками"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000, help="сообщений в одной транзакции")
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        started = time.monotonic()
+        indexed = backend.rebuild(batch_size=options['batch'])
+        self.stdout.write(
+            f"{type(backend).__name__}: проиндексировано {indexed} сообщений за {time.monotonic() - started:.1f} с"
+        )
@@ -0,0 +1,39 @@
+"""
+Регистрирует webhook бота в Telegram (или снимает его для возврата к polling).
+
+    python manage.py set_telegram_webhook https://example.com/telegram/webhook/
+    python manage.py set_telegram_webhook --delete
+"""
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from telegram import Bot
+
+
+class Command(BaseCommand):
+    help = "Установка webhook Telegram-бота на /telegram/webhook/"
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', nargs='?', help="публичный https-адрес /telegram/webhook/")
+        parser.add_argument('--delete', action='store_true', help="снять webhook (вернуться к polling)")
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            asyncio.run(self._delete())
+            self.stdout.write("Webhook снят")
+            return
+        if not options['url']:
+            raise CommandError("Укажите url или --delete")
+        if not settings.TELEGRAM_WEBHOOK_SECRET:
+            raise CommandError("TELEGRAM_WEBHOOK_SECRET не задан — webhook отклонит все апдейты")
+        asyncio.run(self._set(options['url']))
+        self.stdout.write(f"Webhook установлен: {options['url']}")
+
+    async def _set(self, url):
+        async with Bot(settings.TELEGRAM_BOT_TOKEN) as bot:
+            await bot.set_webhook(url, secret_token=settings.TELEGRAM_WEBHOOK_SECRET)
+
+    async def _delete(self):
+        async with Bot(settings.TELEGRAM_BOT_TOKEN) as bot:
+            await bot.delete_webhook()
@@ -0,0 +1,20 @@
+"""
+Загрузка моделей в Ollama перед приёмом трафика (например, в скрипте деплоя).
+
+    python manage.py warm_up_llm
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from dreambot.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = "Прогрев моделей маршрутов на всех серверах Ollama"
+
+    def handle(self, *args, **options):
+        results = warm_up()
+        for r in results:
+            status = f"ok, {r['seconds']} с" if r['ok'] else f"ошибка: {r['error']}"
+            self.stdout.write(f"{r['model']} @ {r['url']}: {status}")
+        if not results or not all(r['ok'] for r in results):
+            raise CommandError("Не все модели загружены")
@@ -0,0 +1,366 @@
+# dreambot/metrics.py
+"""
+Метрики для Prometheus: GET /metrics, текстовый формат 0.0.4.
+
+Реестр живёт в памяти процесса. Counter и Histogram с метками пишутся под
+замком, без запросов к БД и сети. Процессов несколько (воркеры gunicorn и
+бот), поэтому каждый процесс сбрасывает свои значения в METRICS_DIR/<pid>.json:
+при очередной записи, если с прошлого сброса прошло METRICS_FLUSH_INTERVAL
+секунд, и при выходе. Файл пишется атомарно, через os.replace. /metrics
+складывает файлы всех процессов и живые значения своего.
+
+Файлы завершившихся процессов остаются, чтобы счётчики не откатывались при
+перезапуске воркера. Процесс с тем же pid продолжает с их значений.
+Обнулить всё — удалить каталог. После fork (gunicorn --preload) дочерний
+процесс начинает с нуля, а не с копии значений родителя.
+
+Доступ к /metrics проверяет scrape_allowed(): запрос с адресов
+METRICS_ALLOWED_IPS (не через прокси) или с заголовком
+Authorization: Bearer <METRICS_TOKEN>.
+"""
+import asyncio
+import atexit
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._reset_state()
+
+    def _reset_state(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._values = {}  # (имя, метки) -> число или список корзин гистограммы
+        self._pid = os.getpid()
+        self._loaded = False
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def _path(self):
+        return os.path.join(settings.METRICS_DIR, f'{self._pid}.json')
+
+    def _load_locked(self):
+        # Значения прошлого процесса с тем же pid — счётчики продолжаются, а не начинаются заново
+        self._loaded = True
+        if not settings.METRICS_DIR:
+            return
+        try:
+            with open(self._path()) as f:
+                samples = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._merge(self._values, samples)
+
+    def update(self, metric, labels, apply):
+        with self._lock:
+            if not self._loaded:
+                self._load_locked()
+            key = (metric.name, labels)
+            self._values[key] = apply(self._values.get(key))
+            self._dirty = True
+            due = time.monotonic() - self._last_flush >= settings.METRICS_FLUSH_INTERVAL
+        if due:
+            self.flush(blocking=False)
+
+    def get(self, metric, labels):
+        with self._lock:
+            return self._values.get((metric.name, labels))
+
+    def _snapshot_locked(self):
+        # Корзины гистограмм копируются: их меняют на месте
+        return [
+            [name, list(labels), list(value) if isinstance(value, list) else value]
+            for (name, labels), value in self._values.items()
+        ]
+
+    def snapshot(self):
+        """[[имя, метки, значение], ...] — значения этого процесса, пригодные для JSON."""
+        with self._lock:
+            if not self._loaded:
+                self._load_locked()
+            return self._snapshot_locked()
+
+    def flush(self, blocking=True):
+        """Записывает значения процесса в METRICS_DIR/<pid>.json, если они менялись."""
+        if not settings.METRICS_DIR or not self._flush_lock.acquire(blocking=blocking):
+            return
+        try:
+            with self._lock:
+                if not self._dirty:
+                    return
+                samples = self._snapshot_locked()
+                self._dirty = False
+                self._last_flush = time.monotonic()
+            path = self._path()
+            tmp = f'{path}.tmp'
+            try:
+                os.makedirs(settings.METRICS_DIR, exist_ok=True)
+                with open(tmp, 'w') as f:
+                    json.dump(samples, f)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.warning(f"Metrics flush to {path} failed: {e}")
+                with self._lock:
+                    self._dirty = True
+        finally:
+            self._flush_lock.release()
+
+    def _merge(self, totals, samples):
+        for name, labels, value in samples:
+            metric = self.metrics.get(name)
+            # Файл от прошлой версии кода: метрику убрали или поменяли корзины
+            if metric is None or not metric.compatible(value):
+                continue
+            key = (name, tuple(labels))
+            totals[key] = metric.add(totals.get(key), value)
+
+    def collect(self):
+        """{(имя, метки): значение} — сумма по всем процессам."""
+        totals = {}
+        directory = settings.METRICS_DIR
+        if directory and os.path.isdir(directory):
+            own = f'{self._pid}.json'
+            for entry in os.scandir(directory):
+                if not entry.name.endswith('.json') or entry.name == own:
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        samples = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self._merge(totals, samples)
+        self._merge(totals, self.snapshot())
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            samples = sorted((labels, value) for (name, labels), value in totals.items() if name == metric.name)
+            for labels, value in samples:
+                lines += metric.expose(dict(zip(metric.labelnames, labels)), value)
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Забывает значения процесса и удаляет его файл (для тестов)."""
+        with self._lock:
+            self._values.clear()
+            self._loaded = True
+            self._dirty = False
+        if settings.METRICS_DIR:
+            try:
+                os.remove(self._path())
+            except OSError:
+                pass
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counter can only increase")
+        self.registry.update(self, self._labels(labels), lambda value: (value or 0) + amount)
+
+    def value(self, **labels):
+        """Значение в этом процессе."""
+        return self.registry.get(self, self._labels(labels)) or 0
+
+    def compatible(self, value):
+        return isinstance(value, (int, float))
+
+    def add(self, total, value):
+        return (total or 0) + value
+
+    def expose(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(), registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+
+        def apply(current):
+            # Счётчики по корзинам (не накопительные) и сумма последним элементом
+            current = current or [0] * len(self.buckets) + [0.0]
+            current[index] += 1
+            current[-1] += value
+            return current
+
+        self.registry.update(self, self._labels(labels), apply)
+
+    def count(self, **labels):
+        """Число наблюдений в этом процессе."""
+        current = self.registry.get(self, self._labels(labels))
+        return sum(current[:-1]) if current else 0
+
+    def compatible(self, value):
+        return isinstance(value, list) and len(value) == len(self.buckets) + 1
+
+    def add(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def expose(self, labels, value):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append(
+                f'{self.name}_bucket{_format_labels({**labels, "le": _format_value(bound)})} {_format_value(cumulative)}'
+            )
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(value[-1])}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {_format_value(cumulative)}')
+        return lines
+
+
+REGISTRY = Registry()
+
+MESSAGES = Counter('dreambot_messages_total', 'Принятые сны по каналам (web, telegram)', ['channel'])
+QUOTA_REJECTIONS = Counter('dreambot_quota_rejections_total', 'Отказы по дневному лимиту бесплатных снов', ['channel'])
+QUEUE_REJECTIONS = Counter('dreambot_llm_queue_rejections_total', 'Отказы очереди к LLM (Overloaded)', ['channel'])
+QUEUE_WAIT = Histogram(
+    'dreambot_llm_queue_wait_seconds', 'Ожидание места в очереди к LLM', ['priority'],
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90),
+)
+LLM_LATENCY = Histogram(
+    'dreambot_llm_request_seconds', 'Длительность генерации без ожидания в очереди; outcome: ok, error, cancelled',
+    ['model', 'outcome'], buckets=(0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120),
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    'dreambot_llm_tokens_per_second', 'Скорость генерации по eval_count и eval_duration Ollama', ['model'],
+    buckets=(1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120),
+)
+LLM_TOKENS = Counter('dreambot_llm_tokens_total', 'Токены Ollama; kind: prompt, completion', ['model', 'kind'])
+LLM_ERRORS = Counter(
+    'dreambot_llm_errors_total', 'Ошибки обращения к Ollama; kind: unavailable, connection, timeout, request, '
+    'unexpected, bad_response', ['kind'],
+)
+CACHE_REQUESTS = Counter('dreambot_cache_requests_total', 'Обращения к кэшам; cache: interpretation, history', ['cache', 'result'])
+
+
+def count_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def observe_generation(data, model):
+    """Токены и скорость генерации из ответа /api/chat (или последнего чанка потока)."""
+    if not isinstance(data, dict):
+        return
+    model = data.get('model') or model
+    if data.get('prompt_eval_count'):
+        LLM_TOKENS.inc(data['prompt_eval_count'], model=model, kind='prompt')
+    if data.get('eval_count'):
+        LLM_TOKENS.inc(data['eval_count'], model=model, kind='completion')
+        if data.get('eval_duration'):
+            LLM_TOKENS_PER_SECOND.observe(data['eval_count'] / (data['eval_duration'] / 1e9), model=model)
+
+
+class llm_timer:
+    """with llm_timer(model): ... — длительность генерации в LLM_LATENCY с исходом ok, error или cancelled."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            outcome = 'ok'
+        elif issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            # Клиент ушёл посреди потока
+            outcome = 'cancelled'
+        else:
+            outcome = 'error'
+        LLM_LATENCY.observe(time.perf_counter() - self.started, model=self.model, outcome=outcome)
+        return False
+
+
+def scrape_allowed(request):
+    token = settings.METRICS_TOKEN
+    # Байты, а не str: compare_digest бросает TypeError на не-ASCII строках
+    header = request.headers.get('Authorization', '').encode('latin-1', 'replace')
+    if token and hmac.compare_digest(header, f'Bearer {token}'.encode()):
+        return True
+    # За обратным прокси REMOTE_ADDR — адрес самого прокси, по нему не доверяем
+    if 'HTTP_X_FORWARDED_FOR' in request.META:
+        return False
+    return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+
+def render_metrics():
+    return REGISTRY.render()
+
+
+def reset_metrics():
+    REGISTRY.reset()
+
+
+def _flush_at_exit():
+    try:
+        REGISTRY.flush()
+    except Exception:
+        pass
+
+
+atexit.register(_flush_at_exit)
+os.register_at_fork(after_in_child=REGISTRY._reset_state)
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreambot', '0003_user_is_staff_user_is_superuser_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dreamsession',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='free_messages_today',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='is_premium',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='last_message_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='premium_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='telegram_id',
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True, verbose_name='Telegram ID'),
+        ),
+        migrations.AlterField(
+            model_name='dreamsession',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
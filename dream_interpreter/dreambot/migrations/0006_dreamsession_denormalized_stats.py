@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:13
+
+from django.db import migrations, models
+
+
+def backfill_session_stats(apps, schema_editor):
+    DreamSession = apps.get_model('dreambot', 'DreamSession')
+    Message = apps.get_model('dreambot', 'Message')
+    for session in DreamSession.objects.iterator():
+        messages = Message.objects.filter(session=session)
+        last = messages.order_by('-created_at').values_list('created_at', flat=True).first()
+        first_dream = messages.filter(is_user=True).order_by('created_at').values_list('content', flat=True).first()
+        session.message_count = messages.count()
+        session.last_activity = last
+        session.first_dream = (first_dream or '')[:150]
+        session.save(update_fields=['message_count', 'last_activity', 'first_dream'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreambot', '0005_interpretationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dreamsession',
+            name='first_dream',
+            field=models.CharField(blank=True, default='', max_length=150),
+        ),
+        migrations.AddField(
+            model_name='dreamsession',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dreamsession',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_session_stats, migrations.RunPython.noop),
+    ]
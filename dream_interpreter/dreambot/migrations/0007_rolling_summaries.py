@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreambot', '0006_dreamsession_denormalized_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dreamsession',
+            name='summarized_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dreamsession',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='dreamsession',
+            name='summary_folded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='dream_summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreambot', '0007_rolling_summaries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='route',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:33
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreambot', '0008_message_route'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DreamEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('embedder', models.CharField(max_length=64)),
+                ('vector', models.BinaryField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dreambot.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'embedder', 'id'], name='dream_embedding_user_idx')],
+                'constraints': [models.UniqueConstraint(fields=('message', 'embedder'), name='dream_embedding_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations
+
+# Поиск по истории (dreambot/search.py): FTS5 и триггеры, только на SQLite.
+# «ё» приводится к «е» при индексации — так же, как в запросах.
+FOLDED = "replace(replace(new.content, 'ё', 'е'), 'Ё', 'Е')"
+
+CREATE = [
+    """CREATE VIRTUAL TABLE dreambot_message_fts USING fts5(
+        content, user_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER dreambot_message_fts_insert AFTER INSERT ON dreambot_message BEGIN
+        INSERT INTO dreambot_message_fts(rowid, content, user_id)
+        SELECT new.id, {FOLDED}, user_id FROM dreambot_dreamsession WHERE id = new.session_id;
+    END""",
+    f"""CREATE TRIGGER dreambot_message_fts_update AFTER UPDATE OF content ON dreambot_message BEGIN
+        UPDATE dreambot_message_fts SET content = {FOLDED} WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER dreambot_message_fts_delete AFTER DELETE ON dreambot_message BEGIN
+        DELETE FROM dreambot_message_fts WHERE rowid = old.id;
+    END""",
+]
+
+DROP = [
+    "DROP TRIGGER IF EXISTS dreambot_message_fts_insert",
+    "DROP TRIGGER IF EXISTS dreambot_message_fts_update",
+    "DROP TRIGGER IF EXISTS dreambot_message_fts_delete",
+    "DROP TABLE IF EXISTS dreambot_message_fts",
+]
+
+
+def fts5_supported(schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return False
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        return any(option == 'ENABLE_FTS5' for option, in cursor.fetchall())
+
+
+def create_fts(apps, schema_editor):
+    # Другие СУБД и SQLite без FTS5 ищут через DatabaseSearchBackend
+    if fts5_supported(schema_editor):
+        for sql in CREATE:
+            schema_editor.execute(sql)
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in DROP:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreambot', '0009_dream_embeddings'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
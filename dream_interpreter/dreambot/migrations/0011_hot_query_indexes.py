@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dreambot', '0010_message_fts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dreamsession',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', '-created_at'], name='dream_session_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dreamsession',
+            index=models.Index(fields=['user', '-created_at'], name='dream_session_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['session', 'created_at'], name='message_session_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_user', True)), fields=['session', 'created_at'], name='message_session_dreams_idx'),
+        ),
+    ]
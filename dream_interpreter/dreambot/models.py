@@ -2,6 +2,10 @@
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.utils import timezone
+import uuid
+
+# Длина начала первого сна сессии, которое попадает в контекст промпта
+FIRST_DREAM_EXCERPT = 150
 
 class UserManager(BaseUserManager):
     def create_user(self, phone_number, name=None, birth_date=None, password=None):
@@ -39,6 +43,9 @@ class User(AbstractBaseUser):
     free_messages_today = models.IntegerField(default=0)
     last_message_date = models.DateField(null=True, blank=True)
 
+    # Сжатый портрет прошлых снов (dreambot/summaries.py) — вместо отрывков из каждой сессии в промпте
+    dream_summary = models.TextField(blank=True, default='')
+
 
     objects = UserManager()
     USERNAME_FIELD = 'phone_number'
@@ -55,6 +62,26 @@ class DreamSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
 
+    # Денормализация для контекста промпта и истории (обновляется в Message.save)
+    first_dream = models.CharField(max_length=FIRST_DREAM_EXCERPT, blank=True, default='')
+    message_count = models.PositiveIntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, blank=True)
+
+    # Скользящее краткое содержание сессии: покрывает сообщения до summarized_at включительно
+    summary = models.TextField(blank=True, default='')
+    summarized_at = models.DateTimeField(null=True, blank=True)
+    # Итог сессии уже вошёл в User.dream_summary
+    summary_folded = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Активная сессия: filter(user, is_active=True).order_by('-created_at').first()
+            models.Index(fields=['user', '-created_at'], condition=models.Q(is_active=True),
+                         name='dream_session_active_idx'),
+            # Последние сессии пользователя: контекст промпта, /history бота, история на сайте
+            models.Index(fields=['user', '-created_at'], name='dream_session_user_idx'),
+        ]
+
     @property
     def created_date(self):
         return self.created_at.date()
@@ -64,5 +91,68 @@ class Message(models.Model):
     is_user = models.BooleanField()
     content = models.TextField()
     audio_file = models.FileField(upload_to='audio/', blank=True, null=True)
+    # Маршрут генерации ответа бота (dreambot/routing.py): small / large
+    route = models.CharField(max_length=16, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     related_name = 'messages'
+
+    class Meta:
+        indexes = [
+            # Сообщения сессии по порядку: чат, контекст промпта, история, краткие содержания.
+            # id SQLite и так хранит в конце каждого индекса — order_by('created_at', 'id') тоже покрыт
+            models.Index(fields=['session', 'created_at'], name='message_session_idx'),
+            # Сны сессии (is_user) по порядку
+            models.Index(fields=['session', 'created_at'], condition=models.Q(is_user=True),
+                         name='message_session_dreams_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            # Одним UPDATE: счётчик, последняя активность и — для первого сна — его начало
+            first_dream = models.F('first_dream')
+            if self.is_user:
+                first_dream = models.Case(
+                    models.When(first_dream='', then=models.Value(self.content[:FIRST_DREAM_EXCERPT])),
+                    default=first_dream,
+                )
+            DreamSession.objects.filter(pk=self.session_id).update(
+                message_count=models.F('message_count') + 1,
+                last_activity=self.created_at,
+                first_dream=first_dream,
+            )
+
+
+class DreamEmbedding(models.Model):
+    """Вектор сна пользователя для поиска похожих прошлых снов (dreambot/dream_index.py)."""
+    message = models.ForeignKey(Message, on_delete=models.CASCADE)
+    # Денормализовано из message.session.user: индекс пользователя читается одним запросом
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    embedder = models.CharField(max_length=64)  # хеширование или модель эмбеддингов Ollama
+    vector = models.BinaryField()  # float16, нормирован
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['message', 'embedder'], name='dream_embedding_unique')]
+        indexes = [models.Index(fields=['user', 'embedder', 'id'], name='dream_embedding_user_idx')]
+
+
+class InterpretationJob(models.Model):
+    """Фоновая интерпретация сна (асинхронный режим /api/message/)."""
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='interpretation_jobs')
+    session = models.ForeignKey(DreamSession, on_delete=models.CASCADE)
+    user_message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='+')
+    bot_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
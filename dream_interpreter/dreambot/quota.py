@@ -0,0 +1,93 @@
+# dreambot/quota.py
+"""
+Дневной лимит бесплатных снов и сохранение сна — общие для сайта и бота.
+
+Раньше счётчик читался в память, сравнивался с лимитом и сохранялся через
+user.save() — до трёх полных перезаписей строки User на сон (вместе с паролем),
+а два одновременных запроса читали одно и то же значение и оба проходили лимит.
+Теперь:
+- consume_dream() — один UPDATE с условием: счётчик растёт, только если лимит
+  не исчерпан, а сброс в начале нового дня — часть того же выражения;
+- save_dream() — списание, сессия и сообщение пользователя в одной короткой
+  транзакции: если сообщение не сохранилось, сон из лимита не списан.
+QuerySet.update() не шлёт post_save, поэтому после коммита отправляется сигнал
+quota_changed — по нему бот сбрасывает кэш пользователей.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .models import DreamSession, Message, User
+
+# kwargs: user
+quota_changed = Signal()
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def dreams_today(user, today=None):
+    today = today or timezone.localdate()
+    return user.free_messages_today if user.last_message_date == today else 0
+
+
+def limit_reached(user, today=None):
+    """Быстрая проверка по загруженному user, без запросов; окончательно решает consume_dream."""
+    return not user.is_premium and dreams_today(user, today) >= settings.FREE_DREAMS_PER_DAY
+
+
+def consume_dream(user, today=None):
+    """
+    Атомарно списывает один сон из дневного лимита; False — лимит исчерпан.
+    У премиум-пользователей ничего не пишется. Поля user обновляются в памяти.
+    """
+    if user.is_premium:
+        return True
+    today = today or timezone.localdate()
+    updated = User.objects.filter(pk=user.pk).filter(
+        ~Q(last_message_date=today) | Q(free_messages_today__lt=settings.FREE_DREAMS_PER_DAY)
+    ).update(
+        free_messages_today=Case(
+            When(last_message_date=today, then=F('free_messages_today') + 1), default=Value(1),
+        ),
+        last_message_date=today,
+    )
+    if not updated:
+        return False
+    # Без повторного чтения: при параллельных запросах значение в памяти может отставать,
+    # но лимит держит условие UPDATE
+    user.free_messages_today = dreams_today(user, today) + 1
+    user.last_message_date = today
+    transaction.on_commit(lambda: quota_changed.send(sender=User, user=user))
+    return True
+
+
+def active_session(user):
+    """Последняя активная сессия пользователя или новая."""
+    session = DreamSession.objects.filter(user=user, is_active=True).order_by('-created_at').first()
+    return session or DreamSession.objects.create(user=user, is_active=True)
+
+
+def save_dream(user, text, get_session=active_session):
+    """
+    Списывает сон из лимита и сохраняет сообщение пользователя: (session, message).
+    QuotaExceeded — лимит исчерпан; get_session(user) выбирает или создаёт сессию.
+    """
+    before = (user.free_messages_today, user.last_message_date)
+    try:
+        with transaction.atomic():
+            if not consume_dream(user):
+                raise QuotaExceeded()
+            session = get_session(user)
+            message = Message.objects.create(session=session, is_user=True, content=text)
+    except Exception:
+        user.free_messages_today, user.last_message_date = before
+        raise
+    return session, message
+
+
+asave_dream = sync_to_async(save_dream)
@@ -0,0 +1,84 @@
+# dreambot/routing.py
+"""
+Выбор модели и бюджета генерации под запрос.
+
+Раньше любой сон шёл в OLLAMA_MODEL без ограничения длины ответа. Теперь:
+- маршрут «small» (LLM_SMALL_MODEL) — короткие сны (меньше LLM_SHORT_DREAM_CHARS
+  символов) и бесплатные пользователи, у которых на сегодня осталось не больше
+  LLM_SMALL_ROUTE_REMAINING снов;
+- маршрут «large» (OLLAMA_MODEL) — всё остальное.
+
+У каждого маршрута свои num_predict, num_ctx и стоп-последовательности (LLM_STOP).
+num_ctx постоянен для модели: Ollama перезагружает модель при его смене.
+Имя маршрута сохраняется в Message.route ответа бота.
+LLM_ROUTING=False — всё идёт маршрутом «large».
+"""
+import logging
+
+from django.conf import settings
+
+from .instrumentation import tag
+from .interpretations import normalize_dream_text
+
+logger = logging.getLogger(__name__)
+
+SMALL = 'small'
+LARGE = 'large'
+
+
+class Route:
+    def __init__(self, name, model, num_predict, num_ctx, stop=()):
+        self.name = name
+        self.model = model
+        self.num_predict = num_predict
+        self.num_ctx = num_ctx
+        self.stop = list(stop)
+
+    def options(self):
+        """options для запроса к Ollama."""
+        options = {'num_predict': self.num_predict, 'num_ctx': self.num_ctx}
+        if self.stop:
+            options['stop'] = self.stop
+        return options
+
+    def __repr__(self):
+        return f"<Route {self.name}: {self.model}>"
+
+
+def get_routes():
+    return {
+        SMALL: Route(SMALL, settings.LLM_SMALL_MODEL, settings.LLM_SMALL_NUM_PREDICT,
+                     settings.LLM_SMALL_NUM_CTX, settings.LLM_STOP),
+        LARGE: Route(LARGE, settings.OLLAMA_MODEL, settings.LLM_LARGE_NUM_PREDICT,
+                     settings.LLM_LARGE_NUM_CTX, settings.LLM_STOP),
+    }
+
+
+def get_route(name):
+    return get_routes()[name]
+
+
+def active_routes():
+    """Маршруты, которые реально используются (для прогрева и /readyz)."""
+    routes = get_routes()
+    return list(routes.values()) if settings.LLM_ROUTING else [routes[LARGE]]
+
+
+def choose_route(user, text):
+    """Маршрут для сна text; free_messages_today уже учитывает этот сон."""
+    route = _choose_route(user, text)
+    tag(route=route.name)
+    return route
+
+
+def _choose_route(user, text):
+    if not settings.LLM_ROUTING:
+        return get_route(LARGE)
+    if len(normalize_dream_text(text)) < settings.LLM_SHORT_DREAM_CHARS:
+        reason = 'short dream'
+    elif not user.is_premium and settings.FREE_DREAMS_PER_DAY - user.free_messages_today <= settings.LLM_SMALL_ROUTE_REMAINING:
+        reason = 'free tier near daily limit'
+    else:
+        return get_route(LARGE)
+    logger.debug(f"Routing user {user.id} to small model: {reason}")
+    return get_route(SMALL)
@@ -0,0 +1,220 @@
+# dreambot/scheduler.py
+"""
+Планировщик запросов к LLM внутри процесса.
+
+Ollama реально тянет лишь пару генераций одновременно, поэтому все обращения
+(веб и Telegram) проходят через LLMScheduler:
+- не больше LLM_MAX_CONCURRENCY генераций одновременно;
+- очередь с приоритетом: премиум-пользователи обслуживаются первыми;
+- контроль допуска: если оценка ожидания больше LLM_QUEUE_SLA, запрос сразу
+  отклоняется с Overloaded(retry_after) вместо того, чтобы висеть до таймаута;
+- средняя длительность генерации для этой оценки считается только по билетам,
+  в которые вошли (with), и от момента входа: ответ из кэша и работа с БД до
+  генерации её не занижают.
+
+Использование:
+    ticket = get_scheduler().enqueue(priority_for(user))   # может бросить Overloaded
+    with ticket:            # или `async with ticket:` — только вокруг самого запроса к LLM
+        data = get_client().chat(...)
+    ticket.release()        # генерация не понадобилась (ответ из кэша)
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import QUEUE_WAIT
+
+PRIORITY_PREMIUM = 0
+PRIORITY_FREE = 1
+PRIORITY_BACKGROUND = 2  # служебные генерации (краткие содержания) — после всех пользователей
+PRIORITY_NAMES = {PRIORITY_PREMIUM: 'premium', PRIORITY_FREE: 'free', PRIORITY_BACKGROUND: 'background'}
+
+
+def priority_for(user):
+    return PRIORITY_PREMIUM if user.is_premium else PRIORITY_FREE
+
+
+class Overloaded(Exception):
+    """Очередь к LLM переполнена; retry_after — через сколько секунд имеет смысл повторить."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM queue is overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Место в очереди. Захватывается через with/async with, освобождается на выходе."""
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.generation_started = None
+        self.granted = False
+        self.done = False
+        self._event = threading.Event()
+        self._future = None
+
+    def _grant(self):
+        # Вызывается под замком планировщика
+        self.granted = True
+        self.started_at = time.monotonic()
+        QUEUE_WAIT.observe(self.started_at - self.enqueued_at, priority=PRIORITY_NAMES.get(self.priority, self.priority))
+        self._event.set()
+        if self._future is not None:
+            loop, future = self._future
+            loop.call_soon_threadsafe(_resolve, future)
+
+    @property
+    def wait_time(self):
+        if self.started_at is None:
+            return None
+        return self.started_at - self.enqueued_at
+
+    def __enter__(self):
+        self._event.wait()
+        self.generation_started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+    async def __aenter__(self):
+        future = None
+        with self.scheduler._lock:
+            if not self.granted:
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._future = (loop, future)
+        if future is not None:
+            try:
+                await future
+            except asyncio.CancelledError:
+                self.release()
+                raise
+        self.generation_started = time.monotonic()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+        return False
+
+    def release(self):
+        """Освобождает слот; для ещё не запущенного билета — убирает его из очереди."""
+        self.scheduler._release(self)
+
+    cancel = release
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrency=2, sla=90.0, expected_duration=20.0, smoothing=0.2):
+        self.max_concurrency = max_concurrency
+        self.sla = sla
+        self.smoothing = smoothing
+        self._avg_duration = float(expected_duration)
+        self._lock = threading.Lock()
+        self._queue = []
+        self._counter = itertools.count()
+        self._running = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def waiting(self):
+        with self._lock:
+            return sum(1 for _, _, t in self._queue if not t.done)
+
+    @property
+    def avg_duration(self):
+        return self._avg_duration
+
+    def _estimate_wait(self, priority):
+        # Впереди — все выполняющиеся и ожидающие с тем же или более высоким приоритетом
+        ahead = self._running + sum(1 for p, _, t in self._queue if p <= priority and not t.done)
+        if ahead < self.max_concurrency:
+            return 0.0
+        rounds = (ahead - self.max_concurrency) // self.max_concurrency + 1
+        return rounds * self._avg_duration
+
+    def estimate_wait(self, priority=PRIORITY_FREE):
+        with self._lock:
+            return self._estimate_wait(priority)
+
+    def enqueue(self, priority=PRIORITY_FREE, admit=True):
+        """
+        Ставит запрос в очередь или бросает Overloaded, если ждать дольше SLA.
+        admit=False — без контроля допуска (запрос уже был принят ранее).
+        """
+        with self._lock:
+            wait = self._estimate_wait(priority)
+            if admit and wait > self.sla:
+                raise Overloaded(retry_after=max(1, math.ceil(wait - self.sla)))
+            ticket = Ticket(self, priority)
+            heapq.heappush(self._queue, (priority, next(self._counter), ticket))
+            self._dispatch()
+            return ticket
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._queue:
+            _, _, ticket = heapq.heappop(self._queue)
+            if ticket.done:
+                continue
+            self._running += 1
+            ticket._grant()
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.done:
+                return
+            ticket.done = True
+            if ticket.granted:
+                self._running -= 1
+                if ticket.generation_started is not None:
+                    duration = time.monotonic() - ticket.generation_started
+                    self._avg_duration += self.smoothing * (duration - self._avg_duration)
+            self._dispatch()
+
+    def submit(self, fn, *args, priority=PRIORITY_FREE, **kwargs):
+        with self.enqueue(priority):
+            return fn(*args, **kwargs)
+
+    async def asubmit(self, fn, *args, priority=PRIORITY_FREE, **kwargs):
+        async with self.enqueue(priority):
+            return await fn(*args, **kwargs)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = LLMScheduler(
+                    max_concurrency=settings.LLM_MAX_CONCURRENCY,
+                    sla=settings.LLM_QUEUE_SLA,
+                    expected_duration=settings.LLM_EXPECTED_DURATION,
+                )
+    return _scheduler
+
+
+def reset_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = None
@@ -0,0 +1,180 @@
+# dreambot/search.py
+"""
+Полнотекстовый поиск по истории снов и интерпретаций (Message.content).
+
+- SQLiteFTSBackend — виртуальная таблица FTS5 dreambot_message_fts (миграция
+  0010): rowid = Message.id, user_id рядом с текстом, чтобы искать только
+  в своей истории. Индекс поддерживают триггеры SQLite на dreambot_message —
+  они срабатывают и для bulk_create и queryset.update(), в обход сигналов.
+  Ранжирование — bm25, подсветка — snippet();
+- DatabaseSearchBackend — запасной для других СУБД (или SQLite без FTS5):
+  icontains по всем словам, новые сверху, подсветка в Python.
+
+SEARCH_BACKEND — путь к своему классу бэкенда; пусто — FTS5, если таблица есть.
+Совпадения в snippet отмечены MATCH_START/MATCH_END; highlight() экранирует
+текст и заменяет метки на теги (<mark> для сайта, <b> для Telegram).
+Индекс для уже существующих сообщений: python manage.py rebuild_search_index
+"""
+import re
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+from .models import Message
+
+FTS_TABLE = 'dreambot_message_fts'
+MATCH_START, MATCH_END = '\x02', '\x03'
+# Слов в отрывке вокруг совпадения
+SNIPPET_TOKENS = 24
+MAX_QUERY_WORDS = 8
+
+WORD_RE = re.compile(r'\w+')
+
+
+def fold(text):
+    # «ё» и «е» в снах пишут вперемешку; FTS5 их не отождествляет
+    return text.replace('ё', 'е').replace('Ё', 'Е')
+
+
+def query_words(query):
+    return WORD_RE.findall(fold(query).lower())[:MAX_QUERY_WORDS]
+
+
+def highlight(snippet, start='<mark>', end='</mark>'):
+    """HTML-безопасный отрывок: текст экранирован, совпадения обёрнуты в start/end."""
+    return escape(snippet).replace(MATCH_START, start).replace(MATCH_END, end)
+
+
+class SearchBackend:
+    """search() возвращает список dict(message_id, session_id, is_user, created_at, snippet), лучшие первыми."""
+
+    def search(self, user_id, query, limit=20):
+        raise NotImplementedError
+
+    def rebuild(self, batch_size=1000):
+        """Переиндексирует все сообщения; возвращает их число."""
+        return 0
+
+
+class DatabaseSearchBackend(SearchBackend):
+    def search(self, user_id, query, limit=20):
+        words = query_words(query)
+        if not words:
+            return []
+        messages = Message.objects.filter(session__user_id=user_id)
+        for word in words:
+            messages = messages.filter(content__icontains=word)
+        rows = messages.order_by('-created_at', '-id').values(
+            'id', 'session_id', 'is_user', 'created_at', 'content',
+        )[:limit]
+        return [
+            {
+                'message_id': row['id'], 'session_id': row['session_id'], 'is_user': row['is_user'],
+                'created_at': row['created_at'], 'snippet': self._snippet(row['content'], words),
+            }
+            for row in rows
+        ]
+
+    @staticmethod
+    def _snippet(content, words):
+        pattern = re.compile('|'.join(re.escape(w) for w in words), re.IGNORECASE)
+        match = pattern.search(fold(content))
+        start = max(0, match.start() - 80) if match else 0
+        excerpt = content[start:start + 200]
+        parts, pos = [], 0
+        # fold() не меняет длину строки — позиции совпадений переносятся на оригинал
+        for m in pattern.finditer(fold(excerpt)):
+            parts += [excerpt[pos:m.start()], MATCH_START, excerpt[m.start():m.end()], MATCH_END]
+            pos = m.end()
+        parts.append(excerpt[pos:])
+        return ('…' if start else '') + ''.join(parts) + ('…' if start + 200 < len(content) else '')
+
+
+class SQLiteFTSBackend(SearchBackend):
+    def search(self, user_id, query, limit=20):
+        words = query_words(query)
+        if not words:
+            return []
+        # Каждое слово — строка в кавычках с префиксным поиском: «волк» находит «волки», «волков»
+        match = ' '.join(f'"{word}"*' for word in words)
+        messages = Message.objects.raw(
+            f"""
+            SELECT m.id, m.session_id, m.is_user, m.created_at,
+                   snippet({FTS_TABLE}, 0, %s, %s, '…', {SNIPPET_TOKENS}) AS snippet
+            FROM {FTS_TABLE} JOIN dreambot_message m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.user_id = %s
+            ORDER BY bm25({FTS_TABLE}), m.id DESC
+            LIMIT %s
+            """,
+            [MATCH_START, MATCH_END, match, user_id, limit],
+        )
+        return [
+            {
+                'message_id': m.id, 'session_id': m.session_id, 'is_user': m.is_user,
+                'created_at': m.created_at, 'snippet': m.snippet,
+            }
+            for m in messages
+        ]
+
+    def rebuild(self, batch_size=1000):
+        # Сообщения новее max_id добавят триггеры — пачки их не трогают
+        max_id = Message.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+        last_id = 0
+        indexed = 0
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid <= %s", [max_id])
+        while True:
+            # Keyset-пачки по id: каждая — своя короткая транзакция, запись в БД не блокируется надолго
+            ids = list(
+                Message.objects.filter(id__gt=last_id, id__lte=max_id)
+                .order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                return indexed
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {FTS_TABLE}(rowid, content, user_id)
+                    SELECT m.id, replace(replace(m.content, 'ё', 'е'), 'Ё', 'Е'), s.user_id
+                    FROM dreambot_message m JOIN dreambot_dreamsession s ON s.id = m.session_id
+                    WHERE m.id BETWEEN %s AND %s
+                    """,
+                    [ids[0], ids[-1]],
+                )
+            indexed += len(ids)
+            last_id = ids[-1]
+
+
+def fts_available():
+    return connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_search_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if settings.SEARCH_BACKEND:
+                _backend = import_string(settings.SEARCH_BACKEND)()
+            elif fts_available():
+                _backend = SQLiteFTSBackend()
+            else:
+                _backend = DatabaseSearchBackend()
+        return _backend
+
+
+def search_messages(user_id, query, limit=20):
+    return get_search_backend().search(user_id, query, limit=limit)
+
+
+def reset_search_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
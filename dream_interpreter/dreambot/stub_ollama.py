@@ -0,0 +1,184 @@
+# dreambot/stub_ollama.py
+"""
+Заглушка Ollama для бенчмарков и тестов: локальный HTTP-сервер с настраиваемой
+задержкой и долей ошибок. Отвечает на /api/generate и /api/chat (обычный и
+потоковый режим), /api/tags и /api/ps (модели, которые уже получали запросы),
+считает одновременные запросы.
+
+Разбор промпта моделируется как в Ollama: у сервера cache_slots слотов KV-кэша,
+запрос берёт самый длинный общий префикс из всех слотов, и пересчитываются
+только токены после него (prompt_eval_count / prompt_eval_duration,
+prompt_eval_time секунд на токен).
+
+    with StubOllama(delay=1.0) as stub:
+        ... settings.OLLAMA_URL = stub.url ...
+        print(stub.peak_in_flight)
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        line = json.dumps(data, ensure_ascii=False).encode() + b'\n'
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path == '/api/tags':
+            if stub.should_fail():
+                return self._send_json({'error': 'stub failure'}, status=500)
+            return self._send_json({'models': [{'name': m} for m in stub.models]})
+        if self.path == '/api/ps':
+            with stub._lock:
+                loaded = sorted(stub.loaded)
+            return self._send_json({'models': [{'name': m} for m in loaded]})
+        self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        stub.begin(self.path, payload)
+        try:
+            if stub.should_fail():
+                return self._send_json({'error': 'stub failure'}, status=500)
+            if self.path not in ('/api/generate', '/api/chat'):
+                return self._send_json({'error': 'not found'}, status=404)
+            stats = stub.evaluate_prompt(payload)
+            with stub._lock:
+                stub.loaded.add(payload.get('model', ''))
+            time.sleep(stats['prompt_eval_duration'] / 1e9)
+            chat = self.path == '/api/chat'
+            tokens = stub.reply.split(' ')
+            if payload.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for i, token in enumerate(tokens):
+                    time.sleep(stub.delay / len(tokens))
+                    self._write_chunk({**_content(chat, token if i == 0 else ' ' + token), 'done': False})
+                self._write_chunk({**_content(chat, ''), 'done': True, **stats})
+                self.wfile.write(b'0\r\n\r\n')
+            else:
+                time.sleep(stub.delay)
+                self._send_json({**_content(chat, stub.reply), 'done': True, **stats})
+        finally:
+            stub.end()
+
+
+def _content(chat, text):
+    if chat:
+        return {'message': {'role': 'assistant', 'content': text}}
+    return {'response': text}
+
+
+def render_prompt(payload):
+    """Текст, который видит модель: сообщения в шаблоне ChatML (prompt /api/generate — одно сообщение user)."""
+    messages = payload.get('messages') or [{'role': 'user', 'content': payload.get('prompt', '')}]
+    rendered = ''.join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return rendered + '<|im_start|>assistant\n'
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+# Грубая оценка длины в токенах, как и в остальной заглушке
+CHARS_PER_TOKEN = 4
+
+
+class StubOllama:
+    def __init__(self, delay=0.0, reply='Это стабовый ответ сонника.', failure_rate=0.0,
+                 models=('qwen2:7b',), port=0, prompt_eval_time=0.0, cache_slots=1):
+        self.delay = delay
+        self.prompt_eval_time = prompt_eval_time
+        self._slots = [''] * cache_slots  # последний разобранный промпт каждого слота, от старых к свежим
+        self.reply = reply
+        self.failure_rate = failure_rate
+        self.models = list(models)
+        self.loaded = set()  # модели «в памяти» для /api/ps
+        self.requests = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def should_fail(self):
+        return self.failure_rate and random.random() < self.failure_rate
+
+    def evaluate_prompt(self, payload):
+        """Занимает слот KV-кэша и возвращает статистику ответа; считаются только токены после общего префикса."""
+        prompt = render_prompt(payload)
+        with self._lock:
+            prefixes = [_common_prefix(cached, prompt) for cached in self._slots]
+            best = max(range(len(self._slots)), key=prefixes.__getitem__)
+            cached = prefixes[best]
+            # Как multi-user кэш Ollama: слот, который пришлось бы обрезать, не трогаем —
+            # общий префикс копируется в давно не использованный (первый в списке)
+            slot = best if cached == len(self._slots[best]) else 0
+            self._slots.pop(slot)
+            self._slots.append(prompt)
+        count = max(1, (len(prompt) - cached) // CHARS_PER_TOKEN)
+        return {
+            'prompt_eval_count': count,
+            'prompt_eval_duration': int(count * self.prompt_eval_time * 1e9),
+            'eval_count': len(self.reply.split(' ')),
+            'eval_duration': int(self.delay * 1e9),
+        }
+
+    def begin(self, path, payload):
+        with self._lock:
+            self.requests.append((path, payload))
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
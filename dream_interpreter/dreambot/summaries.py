@@ -0,0 +1,196 @@
+# dreambot/summaries.py
+"""
+Скользящие краткие содержания вместо сырых отрывков в промпте.
+
+На CPU-инференсе время уходит в основном на разбор промпта, а промпт рос
+с каждым сообщением. Теперь:
+- DreamSession.summary — краткое содержание сессии. После каждой интерпретации
+  фоновая задача дописывает в него только новые сообщения (после summarized_at);
+- User.dream_summary — портрет прошлых снов. Завершённые (неактивные) сессии
+  вливаются в него по одной, после чего помечаются summary_folded.
+
+Промпт (dreambot/context.py) берёт эти два текста плюс ещё не покрытый хвост
+сообщений. Суммаризация идёт через LLMScheduler с фоновым приоритетом и
+никогда не обгоняет запросы пользователей; при ошибке LLM краткое содержание
+просто не обновляется, а в промпт по-прежнему идут отрывки.
+
+Суммаризация не должна удваивать работу LLM на каждый сон, поэтому:
+- модель малого маршрута (dreambot/routing.py) с его num_ctx — она уже
+  прогрета и не перезагружается; при LLM_ROUTING=False — основная;
+- ответ ограничен SUMMARY_NUM_PREDICT токенами;
+- /api/chat: неизменная инструкция — системным сообщением первой (её разбор
+  Ollama берёт из KV-кэша), меняющиеся заметки и сообщения — после.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save
+
+from .llm import get_client
+from .models import DreamSession, Message, User
+from .routing import LARGE, SMALL, get_route
+from .scheduler import PRIORITY_BACKGROUND, get_scheduler
+
+logger = logging.getLogger(__name__)
+
+SESSION_SUMMARY_SYSTEM = """Ты ведёшь краткие заметки психолога-сонника о разговоре с пользователем.
+Тебе присылают текущие заметки и новые сообщения разговора.
+Обнови заметки с учётом новых сообщений: сны, ключевые образы, эмоции и выводы интерпретаций.
+Не больше {limit} символов, без вступлений — только текст заметок."""
+
+SESSION_SUMMARY_PROMPT = """Текущие заметки:
+{summary}
+
+Новые сообщения:
+{messages}"""
+
+USER_SUMMARY_SYSTEM = """Ты ведёшь краткий портрет снов пользователя для психолога-сонника.
+Тебе присылают текущий портрет и заметки об очередном разговоре.
+Обнови портрет: повторяющиеся образы и темы, эмоциональная динамика, важные события.
+Не больше {limit} символов, без вступлений — только текст портрета."""
+
+USER_SUMMARY_PROMPT = """Текущий портрет:
+{summary}
+
+Заметки о разговоре за {date}:
+{session_summary}"""
+
+# Сколько новых сообщений за раз дописывается в краткое содержание сессии
+SUMMARY_BATCH = 20
+# Сколько завершённых сессий вливается в портрет пользователя за одну задачу
+FOLD_BATCH = 4
+
+
+def summary_route():
+    """Малый маршрут, если маршрутизация включена (его модель прогрета), иначе основной."""
+    return get_route(SMALL if settings.LLM_ROUTING else LARGE)
+
+
+def _summarize(system, prompt):
+    """Генерация с фоновым приоритетом; пустая строка — не удалось."""
+    route = summary_route()
+    messages = [
+        {'role': 'system', 'content': system.format(limit=settings.SUMMARY_MAX_CHARS)},
+        {'role': 'user', 'content': prompt},
+    ]
+    options = {'temperature': 0.2, 'num_predict': settings.SUMMARY_NUM_PREDICT, 'num_ctx': route.num_ctx}
+    ticket = get_scheduler().enqueue(PRIORITY_BACKGROUND, admit=False)
+    try:
+        with ticket:
+            data = get_client().chat(messages, options=options, model=route.model)
+    except Exception as e:
+        logger.warning(f"Summary generation failed: {e}")
+        return ''
+    return ((data.get('message') or {}).get('content') or '').strip()[:settings.SUMMARY_MAX_CHARS]
+
+
+def update_session_summary(session_id):
+    """Дописывает в краткое содержание сессии сообщения, появившиеся после summarized_at."""
+    session = DreamSession.objects.get(id=session_id)
+    messages = Message.objects.filter(session=session).order_by('created_at', 'id')
+    if session.summarized_at is not None:
+        messages = messages.filter(created_at__gt=session.summarized_at)
+    messages = list(messages.only('is_user', 'content', 'created_at')[:SUMMARY_BATCH])
+    if not messages:
+        return False
+    lines = "\n".join(
+        f"{'Пользователь' if m.is_user else 'Сонник'}: {m.content[:500]}" for m in messages
+    )
+    summary = _summarize(SESSION_SUMMARY_SYSTEM, SESSION_SUMMARY_PROMPT.format(
+        summary=session.summary or "(пока нет)", messages=lines,
+    ))
+    if not summary:
+        return False
+    DreamSession.objects.filter(id=session_id).update(summary=summary, summarized_at=messages[-1].created_at)
+    return True
+
+
+def fold_user_summary(user_id):
+    """Вливает краткие содержания завершённых сессий в User.dream_summary (старые — первыми)."""
+    sessions = list(
+        DreamSession.objects.filter(user_id=user_id, is_active=False, summary_folded=False)
+        .exclude(summary='').order_by('created_at')[:FOLD_BATCH]
+    )
+    if not sessions:
+        return 0
+    user = User.objects.get(id=user_id)
+    folded = 0
+    for session in sessions:
+        summary = _summarize(USER_SUMMARY_SYSTEM, USER_SUMMARY_PROMPT.format(
+            summary=user.dream_summary or "(пока нет)", date=session.created_at.strftime('%d.%m'),
+            session_summary=session.summary,
+        ))
+        if not summary:
+            break
+        user.dream_summary = summary
+        # save(), а не update(): post_save сбрасывает кэш пользователей бота
+        user.save(update_fields=['dream_summary'])
+        DreamSession.objects.filter(id=session.id).update(summary_folded=True)
+        folded += 1
+    return folded
+
+
+def refresh_summaries(session_id):
+    close_old_connections()
+    try:
+        user_id = DreamSession.objects.filter(id=session_id).values_list('user_id', flat=True).first()
+        if user_id is None:
+            return
+        update_session_summary(session_id)
+        fold_user_summary(user_id)
+    except Exception as e:
+        logger.error(f"Summary refresh for session {session_id} failed: {e}", exc_info=True)
+    finally:
+        close_old_connections()
+
+
+class SummaryQueue:
+    """Один фоновый поток; повторные запросы на ту же сессию, пока она ждёт в очереди, склеиваются."""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dream-summary')
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, session_id):
+        with self._lock:
+            if session_id in self._pending:
+                return None
+            self._pending.add(session_id)
+        return self.executor.submit(self._run, session_id)
+
+    def _run(self, session_id):
+        with self._lock:
+            self._pending.discard(session_id)
+        refresh_summaries(session_id)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_summary_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = SummaryQueue()
+    return _queue
+
+
+def schedule_summary_update(session_id):
+    if settings.SUMMARIES_ENABLED:
+        get_summary_queue().submit(session_id)
+
+
+def _on_message_saved(sender, instance, created, **kwargs):
+    # Ответ сонника завершает обмен — обновляем краткое содержание после коммита
+    if created and not instance.is_user:
+        session_id = instance.session_id
+        transaction.on_commit(lambda: schedule_summary_update(session_id))
+
+
+post_save.connect(_on_message_saved, sender=Message, dispatch_uid='dreambot_rolling_summaries')
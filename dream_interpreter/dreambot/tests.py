@@ -1,3 +1,2252 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from telegram.request import BaseRequest
+
+from . import (
+    backends, dream_index, history, instrumentation, interpretations, jobs, llm, metrics, quota, routing, scheduler,
+    search, summaries, views, warmup,
+)
+from .models import User, DreamSession, DreamEmbedding, Message, InterpretationJob
+from .stub_ollama import StubOllama
+
+
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "history": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "test-history"},
+}
+
+
+def setUpModule():
+    # Кэш истории и метрики тестов — в памяти и во временном каталоге, а не в cache/ рабочей копии
+    global _metrics_dir, _module_settings
+    _metrics_dir = tempfile.mkdtemp()
+    _module_settings = override_settings(CACHES=LOCMEM_CACHES, METRICS_DIR=_metrics_dir)
+    _module_settings.enable()
+
+
+def tearDownModule():
+    metrics.reset_metrics()
+    _module_settings.disable()
+    shutil.rmtree(_metrics_dir, ignore_errors=True)
+
+
+def chat_reply(content, done=True):
+    return {"message": {"role": "assistant", "content": content}, "done": done}
+
+
+class FakeResponse:
+    """Имитация ответа Ollama для requests.Session.post."""
+    status_code = 200
+    text = ""
+
+    def __init__(self, data=None, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class FakeStreamResponse(FakeResponse):
+    """Имитация потокового ответа Ollama (NDJSON)."""
+
+    def __init__(self, tokens):
+        super().__init__()
+        self.lines = [json.dumps(chat_reply(t, done=False)).encode() for t in tokens]
+        self.lines.append(json.dumps(chat_reply("")).encode())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        yield from self.lines
+
+
+def fake_stream_chat(tokens=(), error=None):
+    """Подмена AsyncLLMClient.stream_chat: отдаёт tokens или бросает error."""
+
+    async def stream_chat(self, messages, options=None, model=None):
+        if error is not None:
+            raise error
+        for token in tokens:
+            yield token
+
+    return stream_chat
+
+
+def read_stream(response):
+    """Тело потокового ответа (асинхронный итератор) в синхронном тесте."""
+
+    async def collect():
+        return b"".join([part async for part in response.streaming_content])
+
+    return async_to_sync(collect)()
+
+
+def parse_sse(body):
+    events = []
+    for raw in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in raw.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@override_settings(LLM_RETRY_BACKOFF=0)
+class StreamingMessageTests(TestCase):
+    def setUp(self):
+        llm.reset_clients()
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        self.user = User.objects.create_user(phone_number="+70000000001", name="Анна")
+        self.client.force_login(self.user)
+
+    def test_stream_forwards_tokens_and_saves_reply(self):
+        with mock.patch.object(llm.AsyncLLMClient, "stream_chat", fake_stream_chat(["Анна, ", "это ", "сон."])):
+            response = self.client.post(
+                "/api/message/stream/", data=json.dumps({"text": "Мне снилось море"}),
+                content_type="application/json",
+            )
+            body = read_stream(response).decode()
+
+        self.assertEqual(response["Content-Type"], "text/event-stream; charset=utf-8")
+        events = parse_sse(body)
+        self.assertEqual([e for e, _ in events], ["token", "token", "token", "done"])
+        self.assertEqual(events[-1][1]["reply"], "Анна, это сон.")
+
+        messages = list(Message.objects.order_by("created_at").values_list("is_user", "content"))
+        self.assertEqual(messages, [(True, "Мне снилось море"), (False, "Анна, это сон.")])
+
+    def test_stream_reports_ollama_errors_as_reply(self):
+        stream_chat = fake_stream_chat(error=llm.LLMConnectionError("down"))
+        with mock.patch.object(llm.AsyncLLMClient, "stream_chat", stream_chat):
+            response = self.client.post(
+                "/api/message/stream/", data=json.dumps({"text": "Сон"}),
+                content_type="application/json",
+            )
+            events = parse_sse(read_stream(response).decode())
+
+        self.assertEqual(events[-1][0], "done")
+        self.assertIn("Ollama", events[-1][1]["reply"])
+        self.assertEqual(Message.objects.filter(is_user=False).count(), 1)
+
+    def test_limit_is_returned_as_json(self):
+        self.user.free_messages_today = 5
+        self.user.last_message_date = datetime.date.today()
+        self.user.save()
+        response = self.client.post(
+            "/api/message/stream/", data=json.dumps({"text": "Сон"}),
+            content_type="application/json",
+        )
+        self.assertTrue(response.json()["show_premium_button"])
+        self.assertFalse(DreamSession.objects.exists())
+
+    @override_settings(LLM_ROUTING=False, OLLAMA_BACKENDS="", DREAM_EMBED_MODEL="", LLM_QUEUE_SLA=1000)
+    def test_tokens_are_sent_before_generation_ends_under_asgi(self):
+        from django.core.signals import request_finished, request_started
+        from django.db import close_old_connections
+        from dream_interpreter.asgi import application
+
+        stub = StubOllama(delay=1.5).start()
+        self.addCleanup(stub.stop)
+        settings_patch = override_settings(OLLAMA_URL=stub.url)
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        llm.reset_clients()
+        self.addCleanup(llm.reset_clients)
+        for target in (summaries.schedule_summary_update, dream_index.schedule_indexing):
+            patcher = mock.patch.object(sys.modules[target.__module__], target.__name__)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Как в тестовом клиенте Django: иначе конец запроса закроет соединение с транзакцией теста
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+
+        body = json.dumps({"text": "Мне снилось море"}).encode()
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+            "scheme": "http", "path": "/api/message/stream/", "raw_path": b"/api/message/stream/",
+            "query_string": b"", "root_path": "",
+            "headers": [
+                (b"host", b"localhost"), (b"content-type", b"application/json"),
+                (b"cookie", f"sessionid={self.client.cookies['sessionid'].value}".encode()),
+            ],
+            "client": ("127.0.0.1", 50000), "server": ("localhost", 80),
+        }
+
+        async def run():
+            started = time.monotonic()
+            chunks = []
+            requested = False
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                # Клиент не уходит: ждём, пока сервер не отменит ожидание после ответа
+                await asyncio.Event().wait()
+
+            async def send(message):
+                if message["type"] == "http.response.body" and message.get("body"):
+                    chunks.append((time.monotonic() - started, message["body"].decode()))
+
+            await application(scope, receive, send)
+            return chunks
+
+        chunks = async_to_sync(run)()
+        self.assertGreater(len(chunks), 2)
+        first_at, first = chunks[0]
+        last_at, _ = chunks[-1]
+        self.assertTrue(first.startswith("event: token"))
+        # Генерация заглушки идёт 1.5 с: первый токен уходит клиенту задолго до её конца
+        self.assertLess(first_at, 1.0)
+        self.assertGreaterEqual(last_at, 1.4)
+        self.assertEqual(parse_sse("".join(text for _, text in chunks))[-1][1]["reply"], stub.reply)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LLMClientTests(TestCase):
+    def make_client(self, **kwargs):
+        self.clock = FakeClock()
+        breaker = llm.CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=self.clock)
+        return llm.LLMClient(base_url="http://ollama.test", retry_backoff=0, breaker=breaker, **kwargs)
+
+    def test_retries_connection_errors_then_succeeds(self):
+        client = self.make_client(max_retries=2)
+        responses = [requests.exceptions.ConnectionError("refused"), FakeResponse({"response": "ok"})]
+        with mock.patch.object(client.session, "post", side_effect=responses) as post:
+            self.assertEqual(client.generate("сон")["response"], "ok")
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(client.breaker.state, llm.CircuitBreaker.CLOSED)
+
+    def test_client_errors_are_not_retried(self):
+        client = self.make_client(max_retries=2)
+        with mock.patch.object(client.session, "post", return_value=FakeResponse(status_code=404)) as post:
+            with self.assertRaises(llm.LLMRequestError):
+                client.generate("сон")
+        self.assertEqual(post.call_count, 1)
+
+    def test_breaker_fails_fast_and_recovers_after_reset_timeout(self):
+        client = self.make_client(max_retries=0)
+        with mock.patch.object(client.session, "post", side_effect=requests.exceptions.ConnectionError("down")) as post:
+            for _ in range(3):
+                with self.assertRaises(llm.LLMConnectionError):
+                    client.generate("сон")
+            with self.assertRaises(llm.LLMUnavailable):
+                client.generate("сон")
+        self.assertEqual(post.call_count, 3)
+
+        self.clock.now += 31
+        with mock.patch.object(client.session, "post", return_value=FakeResponse({"response": "ok"})):
+            self.assertEqual(client.generate("сон")["response"], "ok")
+        self.assertEqual(client.breaker.state, llm.CircuitBreaker.CLOSED)
+
+    @override_settings(OLLAMA_KEEP_ALIVE="-1")
+    def test_chat_posts_messages_with_keep_alive(self):
+        client = self.make_client()
+        messages = [{"role": "system", "content": "промпт"}, {"role": "user", "content": "сон"}]
+        with mock.patch.object(client.session, "post", return_value=FakeResponse(chat_reply("ok"))) as post:
+            self.assertEqual(client.chat(messages)["message"]["content"], "ok")
+        self.assertEqual(post.call_args.args[0], "http://ollama.test/api/chat")
+        payload = post.call_args.kwargs["json"]
+        self.assertEqual((payload["messages"], payload["keep_alive"]), (messages, -1))
+        self.assertEqual(llm.parse_keep_alive("30m"), "30m")
+        self.assertIsNone(llm.parse_keep_alive(""))
+
+
+class BackendPoolTests(SimpleTestCase):
+    """Несколько серверов Ollama: заглушки с задержкой и ошибками."""
+
+    messages = [{"role": "user", "content": "сон"}]
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def start_stub(self, **kwargs):
+        stub = StubOllama(**kwargs).start()
+        self.addCleanup(stub.stop)
+        return stub
+
+    def make_pool(self, *stubs, weights=None, models=None):
+        return backends.BackendPool([
+            backends.Backend(
+                stub.url, weight=(weights or {}).get(stub, 1.0), models=(models or {}).get(stub),
+                breaker=llm.CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=self.clock),
+            )
+            for stub in stubs
+        ])
+
+    def send_concurrently(self, pool, n):
+        client = llm.LLMClient(pool=pool, max_retries=0)
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            list(executor.map(lambda _: client.chat(self.messages), range(n)))
+        client.close()
+
+    @override_settings(OLLAMA_BACKENDS="http://a:11434 weight=3 models=qwen2:7b,llama3.2; http://b:11434/",
+                       OLLAMA_HEALTH_INTERVAL=0)
+    def test_pool_is_built_from_settings(self):
+        llm.reset_clients()
+        self.addCleanup(llm.reset_clients)
+        a, b = llm.get_pool().backends
+        self.assertEqual((a.url, a.weight, b.url, b.weight), ("http://a:11434", 3.0, "http://b:11434", 1.0))
+        self.assertTrue(a.serves("llama3.2:latest"))
+        self.assertFalse(a.serves("mistral"))
+        self.assertTrue(b.serves("mistral"))
+        with self.assertRaises(ImproperlyConfigured):
+            backends.parse_backends("http://a:11434 weight=zero")
+
+    def test_least_outstanding_requests_respects_weights(self):
+        fast, slow = self.start_stub(delay=0.3), self.start_stub(delay=0.3)
+        self.send_concurrently(self.make_pool(fast, slow), 4)
+        self.assertEqual((len(fast.requests), len(slow.requests)), (2, 2))
+
+        big, small = self.start_stub(delay=0.3), self.start_stub(delay=0.3)
+        self.send_concurrently(self.make_pool(big, small, weights={big: 3}), 8)
+        self.assertEqual((len(big.requests), len(small.requests)), (6, 2))
+
+    def test_failing_backend_is_ejected_and_readmitted(self):
+        good, bad = self.start_stub(), self.start_stub(failure_rate=1.0)
+        pool = self.make_pool(good, bad)
+        client = llm.LLMClient(pool=pool, max_retries=2, retry_backoff=0)
+        for _ in range(6):
+            self.assertEqual(client.chat(self.messages)["message"]["content"], good.reply)
+        # Две ошибки подряд размыкают breaker — дальше на плохой сервер запросы не идут
+        self.assertEqual(len(bad.requests), 2)
+        self.assertEqual(pool.backends[1].breaker.state, llm.CircuitBreaker.OPEN)
+
+        bad.failure_rate = 0.0
+        pool.check_health()
+        self.assertEqual(pool.backends[1].breaker.state, llm.CircuitBreaker.CLOSED)
+        acquired = [pool.acquire("qwen2:7b"), pool.acquire("qwen2:7b")]
+        self.assertEqual({b.url for b in acquired}, {good.url, bad.url})
+        for backend in acquired:
+            pool.release(backend)
+
+        good.stop()  # активная проверка исключает сервер, не дожидаясь ошибок запросов
+        pool.check_health(timeout=0.5)
+        self.assertFalse(pool.backends[0].healthy)
+        self.assertEqual(client.chat(self.messages)["message"]["content"], bad.reply)
+        client.close()
+
+    def test_requests_go_to_backends_serving_the_model(self):
+        llama, qwen = self.start_stub(models=("llama3.2:latest",)), self.start_stub(models=("qwen2:7b",))
+        pool = self.make_pool(llama, qwen)
+        pool.check_health()
+        client = llm.LLMClient(pool=pool, max_retries=0)
+        client.chat(self.messages, model="qwen2:7b")
+        client.chat(self.messages, model="llama3.2")
+        self.assertEqual([p["model"] for _, p in qwen.requests], ["qwen2:7b"])
+        self.assertEqual([p["model"] for _, p in llama.requests], ["llama3.2"])
+        with self.assertRaises(llm.LLMUnavailable):
+            client.chat(self.messages, model="mistral")
+        self.assertEqual([b["outstanding"] for b in pool.snapshot()], [0, 0])
+        client.close()
+
+
+class LLMSchedulerTests(TestCase):
+    def test_premium_requests_jump_the_queue(self):
+        sched = scheduler.LLMScheduler(max_concurrency=1, sla=1000)
+        first = sched.enqueue(scheduler.PRIORITY_FREE)
+        free = sched.enqueue(scheduler.PRIORITY_FREE)
+        premium = sched.enqueue(scheduler.PRIORITY_PREMIUM)
+        self.assertEqual((first.granted, free.granted, premium.granted), (True, False, False))
+
+        first.release()
+        self.assertTrue(premium.granted)
+        self.assertFalse(free.granted)
+        premium.release()
+        self.assertTrue(free.granted)
+
+    def test_rejects_when_estimated_wait_exceeds_sla(self):
+        sched = scheduler.LLMScheduler(max_concurrency=1, sla=10, expected_duration=20)
+        sched.enqueue(scheduler.PRIORITY_FREE)
+        with self.assertRaises(scheduler.Overloaded) as ctx:
+            sched.enqueue(scheduler.PRIORITY_FREE)
+        self.assertEqual(ctx.exception.retry_after, 10)
+
+    def test_only_generations_update_the_duration_estimate(self):
+        sched = scheduler.LLMScheduler(max_concurrency=1, sla=1000, expected_duration=20, smoothing=0.5)
+        # Ответ из кэша: билет освобождается, не войдя в генерацию
+        sched.enqueue().release()
+        self.assertEqual(sched.avg_duration, 20)
+
+        ticket = sched.enqueue()
+        time.sleep(0.2)  # сборка промпта и запросы к БД до генерации
+        with ticket:
+            pass
+        # В оценку попало только время внутри with, а не 0.2 с до него
+        self.assertLess(sched.avg_duration, 10.05)
+
+    def test_cancelled_ticket_does_not_hold_a_slot(self):
+        sched = scheduler.LLMScheduler(max_concurrency=1, sla=1000)
+        first = sched.enqueue()
+        waiting = sched.enqueue()
+        waiting.cancel()
+        first.release()
+        self.assertEqual(sched.running, 0)
+        self.assertEqual(sched.waiting, 0)
+
+    def test_async_submissions_respect_concurrency_limit(self):
+        sched = scheduler.LLMScheduler(max_concurrency=2, sla=1000)
+        active = []
+        peak = []
+
+        async def job():
+            active.append(1)
+            peak.append(len(active))
+            await asyncio.sleep(0.01)
+            active.pop()
+
+        async def main():
+            await asyncio.gather(*(sched.asubmit(job) for _ in range(6)))
+
+        asyncio.run(main())
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(sched.running, 0)
+
+    @override_settings(LLM_MAX_CONCURRENCY=1, LLM_QUEUE_SLA=5, LLM_EXPECTED_DURATION=20)
+    def test_send_message_returns_retry_after_when_overloaded(self):
+        scheduler.reset_scheduler()
+        user = User.objects.create_user(phone_number="+70000000002")
+        self.client.force_login(user)
+        busy = scheduler.get_scheduler().enqueue()
+        try:
+            response = self.client.post(
+                "/api/message/", data=json.dumps({"text": "Сон"}), content_type="application/json",
+            )
+        finally:
+            busy.release()
+            scheduler.reset_scheduler()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "15")
+        self.assertFalse(Message.objects.exists())
+
+
+@override_settings(LLM_RETRY_BACKOFF=0)
+class InterpretationJobTests(TestCase):
+    def setUp(self):
+        llm.reset_clients()
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        self.user = User.objects.create_user(phone_number="+70000000003")
+        self.client.force_login(self.user)
+
+    def post_async(self, text):
+        with mock.patch.object(jobs.JobPool, "submit") as submit:
+            response = self.client.post(
+                "/api/message/?async=1", data=json.dumps({"text": text}), content_type="application/json",
+            )
+        return response, submit
+
+    def test_async_mode_returns_job_and_reply_is_polled(self):
+        response, submit = self.post_async("Мне снился лес")
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job_id"]
+        self.assertEqual(InterpretationJob.objects.get(id=job_id).status, InterpretationJob.PENDING)
+        self.assertEqual(Message.objects.filter(is_user=True).count(), 1)
+
+        status_url = response.json()["status_url"]
+        with mock.patch.object(jobs, "get_job_pool"):
+            self.assertEqual(self.client.get(status_url).json()["status"], "pending")
+
+        ticket = submit.call_args.args[1]
+        with mock.patch.object(requests.Session, "post", return_value=FakeResponse(chat_reply("Лес — это ты."))):
+            jobs.run_job(job_id, ticket)
+
+        with mock.patch.object(jobs, "get_job_pool"):
+            data = self.client.get(status_url + "?wait=5").json()
+        self.assertEqual(data["status"], "done")
+        self.assertEqual(data["reply"], "Лес — это ты.")
+        self.assertEqual(scheduler.get_scheduler().running, 0)
+
+    def test_unfinished_jobs_are_resumed_after_restart(self):
+        self.post_async("Сон 1")
+        self.post_async("Сон 2")
+        # Перезапуск процесса: очередь в памяти пропадает, задачи остаются в БД
+        scheduler.reset_scheduler()
+        InterpretationJob.objects.filter(user_message__content="Сон 1").update(
+            status=InterpretationJob.RUNNING,
+            started_at=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        pool = mock.Mock()
+        resumed = jobs.resume_pending_jobs(pool)
+        self.assertEqual(len(resumed), 2)
+        self.assertEqual(pool.submit.call_count, 2)
+
+        with mock.patch.object(requests.Session, "post", return_value=FakeResponse(chat_reply("ok"))):
+            for job_id in resumed:
+                jobs.run_job(job_id)
+        self.assertEqual(InterpretationJob.objects.filter(status=InterpretationJob.DONE).count(), 2)
+
+    def test_job_is_bound_to_its_own_message(self):
+        real_save = views.asave_dream
+
+        async def save_then_concurrent_submit(user, text):
+            saved = await real_save(user, text)
+            # Второй запрос двойной отправки успел сохранить свой сон раньше, чем создана задача
+            await Message.objects.acreate(session=saved[0], is_user=True, content="Сон из второго запроса")
+            return saved
+
+        with mock.patch.object(views, "asave_dream", save_then_concurrent_submit):
+            response, _ = self.post_async("Сон из первого запроса")
+        job = InterpretationJob.objects.select_related("user_message").get(id=response.json()["job_id"])
+        self.assertEqual(job.user_message.content, "Сон из первого запроса")
+
+    @override_settings(JOB_LONG_POLL_MAX=0.2)
+    def test_non_finite_wait_is_not_an_endless_poll(self):
+        response, _ = self.post_async("Сон")
+        status_url = response.json()["status_url"]
+        wait = mock.AsyncMock(side_effect=jobs.wait_for_job)
+        with mock.patch.object(jobs, "get_job_pool"), mock.patch.object(views, "wait_for_job", wait):
+            for value in ("nan", "inf", "-inf", "abc", "100", "0.1"):
+                self.assertEqual(self.client.get(f"{status_url}?wait={value}").json()["status"], "pending")
+        self.assertEqual([c.args[1] for c in wait.call_args_list], [0, 0, 0, 0, 0.2, 0.1])
+
+    def test_job_status_is_private(self):
+        response, _ = self.post_async("Сон")
+        other = User.objects.create_user(phone_number="+70000000004")
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(response.json()["status_url"]).status_code, 404)
+
+    def test_long_poll_waits_without_a_thread_and_wakes_on_finish(self):
+        self.assertTrue(asyncio.iscoroutinefunction(views.job_status))
+        response, _ = self.post_async("Мне снилось море")
+        job_id = response.json()["job_id"]
+
+        async def main():
+            started = time.monotonic()
+            waiter = asyncio.ensure_future(jobs.wait_for_job(job_id, 10))
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiter.done())
+            # Задача завершилась в воркере этого процесса — ожидающий просыпается сразу, не дожидаясь опроса БД
+            await InterpretationJob.objects.filter(id=job_id).aupdate(status=InterpretationJob.FAILED)
+            jobs._notify_finished()
+            job = await waiter
+            return job, time.monotonic() - started
+
+        job, elapsed = async_to_sync(main)()
+        self.assertEqual(job.status, InterpretationJob.FAILED)
+        self.assertLess(elapsed, 0.8)
+
+
+class AsyncViewTests(TestCase):
+    async def test_clear_chat_and_update_profile_run_natively_async(self):
+        user = await User.objects.acreate(phone_number="+70000000005")
+        await DreamSession.objects.acreate(user=user, is_active=True)
+        await self.async_client.aforce_login(user)
+
+        response = await self.async_client.post("/api/clear-chat/")
+        self.assertEqual(response.json(), {"status": "ok"})
+        self.assertEqual(await DreamSession.objects.filter(user=user, is_active=True).acount(), 1)
+        self.assertEqual(await DreamSession.objects.filter(user=user).acount(), 2)
+
+        response = await self.async_client.post(
+            "/api/profile/", data={"name": "Олег", "birth_date": "1990-05-01"}, content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"status": "ok"})
+        await user.arefresh_from_db()
+        self.assertEqual((user.name, user.birth_date), ("Олег", datetime.date(1990, 5, 1)))
+
+    async def test_send_message_uses_async_llm_client(self):
+        user = await User.objects.acreate(phone_number="+70000000006")
+        await self.async_client.aforce_login(user)
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        generate = mock.AsyncMock(return_value=chat_reply(" Сон о полёте. "))
+        with mock.patch.object(llm.AsyncLLMClient, "chat", generate):
+            response = await self.async_client.post(
+                "/api/message/", data={"text": "Я летал"}, content_type="application/json",
+            )
+        self.assertEqual(response.json()["reply"], "Сон о полёте.")
+        generate.assert_awaited_once()
+        self.assertEqual(await Message.objects.filter(is_user=False).acount(), 1)
+
+
+
+@override_settings(LLM_RETRY_BACKOFF=0)
+class InterpretationCacheTests(TestCase):
+    """Повтор того же сна не запускает вторую генерацию в Ollama."""
+
+    def setUp(self):
+        llm.reset_clients()
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        self.user = User.objects.create_user(phone_number="+70000000020")
+        self.client.force_login(self.user)
+
+    def send(self, text):
+        return self.client.post("/api/message/", data={"text": text}, content_type="application/json")
+
+    def test_duplicate_submission_is_served_from_cache(self):
+        generate = mock.AsyncMock(return_value=chat_reply("Море — это ты."))
+        with mock.patch.object(llm.AsyncLLMClient, "chat", generate):
+            first = self.send("Мне снилось  море")
+            second = self.send("мне снилось море")  # двойной клик, другая раскладка пробелов и регистра
+            other = self.send("Мне снился лес")
+
+        self.assertEqual(first.json()["reply"], "Море — это ты.")
+        self.assertEqual(second.json()["reply"], "Море — это ты.")
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(generate.await_count, 2)
+        # Сообщения сохраняются и для ответа из кэша
+        self.assertEqual(Message.objects.filter(is_user=False).count(), 3)
+        self.assertEqual(scheduler.get_scheduler().running, 0)
+
+    def test_error_replies_are_not_cached(self):
+        down = mock.AsyncMock(side_effect=llm.LLMConnectionError("down"))
+        with mock.patch.object(llm.AsyncLLMClient, "chat", down):
+            self.assertIn("Ollama", self.send("Сон").json()["reply"])
+        generate = mock.AsyncMock(return_value=chat_reply("Ответ."))
+        with mock.patch.object(llm.AsyncLLMClient, "chat", generate):
+            self.assertEqual(self.send("Сон").json()["reply"], "Ответ.")
+        generate.assert_awaited_once()
+
+    def test_concurrent_identical_requests_share_one_generation(self):
+        calls = []
+
+        async def slow_generate(client, messages, **kwargs):
+            calls.append(messages)
+            await asyncio.sleep(0.1)
+            return chat_reply("Один ответ на всех.")
+
+        async def main():
+            return await asyncio.gather(*(
+                views.aget_llm_response(self.user, "Я летал над городом") for _ in range(5)
+            ))
+
+        messages = [{"role": "system", "content": "контекст"}, {"role": "user", "content": "Я летал над городом"}]
+        with mock.patch.object(views, "build_llm_messages", return_value=messages), \
+                mock.patch.object(llm.AsyncLLMClient, "chat", slow_generate):
+            replies = asyncio.run(main())
+
+        self.assertEqual(replies, ["Один ответ на всех."] * 5)
+        self.assertEqual(len(calls), 1)
+        cache = interpretations.get_interpretation_cache()
+        self.assertEqual((cache.misses, cache.coalesced), (1, 4))
+
+    def test_waiters_take_over_when_leader_aborts(self):
+        cache = interpretations.InterpretationCache()
+        reply, leader = cache.join("k")
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(cache.join("k")))
+        waiter.start()
+        time.sleep(0.05)
+        cache.finish("k", leader, None)  # клиент ушёл посреди потока
+        waiter.join(timeout=5)
+        reply, flight = results[0]
+        self.assertIsNone(reply)
+        self.assertIsNotNone(flight)  # ждущий стал лидером и генерирует сам
+        cache.finish("k", flight, "ответ")
+        self.assertEqual(cache.join("k"), ("ответ", None))
+
+    def test_entries_expire_and_are_evicted(self):
+        clock = FakeClock()
+        cache = interpretations.InterpretationCache(maxsize=2, ttl=10, clock=clock)
+        for key in ("a", "b", "c"):
+            cache.put(key, key.upper())
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "B")
+        clock.now = 10
+        self.assertIsNone(cache.get("b"))
+
+
+@override_settings(LLM_SHORT_DREAM_CHARS=40, LLM_SMALL_ROUTE_REMAINING=1, FREE_DREAMS_PER_DAY=5)
+class ModelRoutingTests(TestCase):
+    LONG_DREAM = "Мне снилось, что я иду по бесконечному коридору и не могу найти выход"
+
+    def setUp(self):
+        llm.reset_clients()
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        self.user = User.objects.create_user(phone_number="+70000000050")
+
+    def test_route_depends_on_dream_size_and_tier(self):
+        from .routing import choose_route
+
+        self.assertEqual(choose_route(self.user, self.LONG_DREAM).name, "large")
+        self.assertEqual(choose_route(self.user, "Снилась кошка").name, "small")
+        self.user.free_messages_today = 4  # этот сон — четвёртый из пяти
+        self.assertEqual(choose_route(self.user, self.LONG_DREAM).name, "small")
+        self.user.is_premium = True
+        self.assertEqual(choose_route(self.user, self.LONG_DREAM).name, "large")
+        with override_settings(LLM_ROUTING=False):
+            self.assertEqual(choose_route(self.user, "Снилась кошка").name, "large")
+
+    @override_settings(LLM_SMALL_MODEL="llama3.2:3b", OLLAMA_MODEL="qwen2:7b", LLM_LARGE_NUM_PREDICT=400,
+                       LLM_SMALL_NUM_PREDICT=200, LLM_STOP=["Новый сон:"])
+    def test_route_budget_is_sent_and_recorded(self):
+        self.client.force_login(self.user)
+        chat = mock.AsyncMock(return_value=chat_reply("Ответ."))
+        with mock.patch.object(llm.AsyncLLMClient, "chat", chat):
+            for text in (self.LONG_DREAM, "Снилась кошка"):
+                self.client.post("/api/message/", data={"text": text}, content_type="application/json")
+
+        (large, small) = [c.kwargs for c in chat.await_args_list]
+        self.assertEqual((large["model"], large["options"]["num_predict"]), ("qwen2:7b", 400))
+        self.assertEqual((small["model"], small["options"]["num_predict"]), ("llama3.2:3b", 200))
+        self.assertEqual(large["options"]["stop"], ["Новый сон:"])
+        self.assertIn("num_ctx", small["options"])
+        routes = list(Message.objects.filter(is_user=False).order_by("id").values_list("route", flat=True))
+        self.assertEqual(routes, ["large", "small"])
+
+
+class WarmupReadinessTests(SimpleTestCase):
+    def setUp(self):
+        llm.reset_clients()
+        self.addCleanup(llm.reset_clients)
+
+    def test_startup_does_not_wait_for_ollama(self):
+        # Сервер, который принимает соединения и молчит: прежний прогрев в settings ждал бы OLLAMA_TIMEOUT
+        silent = socket.socket()
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(8)
+        self.addCleanup(silent.close)
+        env = {**os.environ, "OLLAMA_URL": "http://127.0.0.1:%d" % silent.getsockname()[1], "OLLAMA_TIMEOUT": "30"}
+        manage = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "manage.py")
+        started = time.monotonic()
+        result = subprocess.run([sys.executable, manage, "check"], env=env, capture_output=True, timeout=60)
+        elapsed = time.monotonic() - started
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+        self.assertLess(elapsed, 10)
+        silent.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            silent.accept()
+
+    def test_only_server_processes_warm_up(self):
+        self.assertTrue(warmup.is_server_process(["/venv/bin/uvicorn", "dream_interpreter.asgi:application"]))
+        self.assertTrue(warmup.is_server_process(["run_telegram.py"]))
+        self.assertTrue(warmup.is_server_process(["manage.py", "runserver", "--noreload"], {}))
+        self.assertTrue(warmup.is_server_process(["manage.py", "runserver"], {"RUN_MAIN": "true"}))
+        # Процесс-наблюдатель автоперезагрузки запросы не обслуживает
+        self.assertFalse(warmup.is_server_process(["manage.py", "runserver"], {}))
+        self.assertFalse(warmup.is_server_process(["manage.py", "migrate"], {}))
+        self.assertFalse(warmup.is_server_process(["-c"], {}))
+
+    def test_readyz_reports_loaded_models(self):
+        stub = StubOllama().start()
+        self.addCleanup(stub.stop)
+        with override_settings(OLLAMA_URL=stub.url, OLLAMA_BACKENDS="", OLLAMA_MODEL="qwen2:7b",
+                               LLM_SMALL_MODEL="llama3.2:3b", LLM_LARGE_NUM_CTX=4096):
+            llm.reset_clients()
+            self.assertEqual(self.client.get("/healthz").status_code, 200)
+            response = self.client.get("/readyz")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json()["missing"], ["llama3.2:3b", "qwen2:7b"])
+
+            results = warmup.warm_up()
+            self.assertEqual(sorted(r["model"] for r in results if r["ok"]), ["llama3.2:3b", "qwen2:7b"])
+            large = next(p for _, p in stub.requests if p["model"] == "qwen2:7b")
+            self.assertEqual(large["options"]["num_predict"], 1)
+            self.assertEqual(large["options"]["num_ctx"], 4096)
+            response = self.client.get("/readyz")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["warmup"], "done")
+
+            with override_settings(LLM_ROUTING=False, OLLAMA_MODEL="mistral"):
+                self.assertEqual(self.client.get("/readyz").json()["missing"], ["mistral:latest"])
+            stub.stop()
+            self.assertEqual(self.client.get("/readyz").status_code, 503)
+
+    def test_warm_up_command_fails_without_ollama(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        with override_settings(OLLAMA_URL="http://127.0.0.1:9", OLLAMA_BACKENDS=""):
+            llm.reset_clients()
+            with self.assertRaises(CommandError):
+                call_command("warm_up_llm", stdout=open(os.devnull, "w"))
+
+
+class ContextBuilderTests(TestCase):
+    """Контекст промпта собирается за фиксированное число запросов."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(phone_number="+70000000030", name="Анна")
+
+    def add_history(self, sessions, messages_per_session):
+        for i in range(sessions):
+            session = DreamSession.objects.create(user=self.user, is_active=False)
+            for j in range(messages_per_session):
+                Message.objects.create(session=session, is_user=j % 2 == 0, content=f"сон {i}.{j}")
+        current = DreamSession.objects.create(user=self.user, is_active=True)
+        for j in range(messages_per_session):
+            Message.objects.create(session=current, is_user=j % 2 == 0, content=f"сегодня {j}")
+        Message.objects.create(session=current, is_user=True, content="Новый сон")
+        return current
+
+    def test_query_count_does_not_grow_with_history(self):
+        from .context import build_llm_context
+
+        # Окно сессии, прошлые сессии и новые строки индекса похожих снов
+        small = self.add_history(sessions=1, messages_per_session=2)
+        with self.assertNumQueries(3):
+            build_llm_context(self.user, "Новый сон", session=small)
+
+        large = self.add_history(sessions=30, messages_per_session=40)
+        with self.assertNumQueries(3):
+            context = build_llm_context(self.user, "Новый сон", session=large)
+
+        # Последние 4 сообщения текущей сессии и первые сны 4 последних прошлых сессий
+        self.assertIn("[Сегодня] Сонник: сегодня 39", context)
+        self.assertIn("[Сегодня] Пользователь: сегодня 36", context)
+        self.assertNotIn("сегодня 35", context)
+        self.assertEqual(context.count("Сон: сон "), 4)
+        self.assertIn("Сон: сон 29.0...", context)
+        self.assertNotIn("Новый сон", context)
+
+    def test_session_stats_are_maintained_on_message_create(self):
+        session = DreamSession.objects.create(user=self.user)
+        Message.objects.create(session=session, is_user=True, content="Я летал" + "!" * 200)
+        last = Message.objects.create(session=session, is_user=False, content="Полёт — это свобода.")
+        Message.objects.create(session=session, is_user=True, content="Второй сон")
+        session.refresh_from_db()
+        self.assertEqual(session.message_count, 3)
+        self.assertEqual(session.first_dream, ("Я летал" + "!" * 200)[:150])
+        self.assertGreaterEqual(session.last_activity, last.created_at)
+
+    def test_empty_sessions_are_skipped(self):
+        from .context import build_llm_context
+
+        old = DreamSession.objects.create(user=self.user, is_active=False)
+        Message.objects.create(session=old, is_user=True, content="Старый сон")
+        DreamSession.objects.create(user=self.user, is_active=False)  # «Очистить» без новых снов
+        current = DreamSession.objects.create(user=self.user)
+        Message.objects.create(session=current, is_user=True, content="Сон")
+        self.assertIn("Сон: Старый сон...", build_llm_context(self.user, "Сон", session=current))
+
+    def test_system_prompt_is_a_shared_prefix(self):
+        from .context import SYSTEM_PROMPT, build_llm_messages
+
+        other = User.objects.create_user(
+            phone_number="+70000000031", name="Олег", birth_date=datetime.date(1990, 5, 1),
+        )
+        anna = build_llm_messages(self.user, "Я летал", session=self.add_history(sessions=2, messages_per_session=2))
+        oleg = build_llm_messages(other, "Я летал")
+        self.assertEqual(anna[0], {"role": "system", "content": SYSTEM_PROMPT})
+        self.assertEqual(oleg[0], anna[0])
+        self.assertIn("Имя пользователя: Олег", oleg[1]["content"])
+        self.assertEqual(oleg[-1], {"role": "user", "content": "Новый сон:\nЯ летал"})
+        # Прошлые сны меняются реже текущего диалога и идут раньше него
+        context = anna[1]["content"]
+        self.assertLess(context.index("Предыдущие сны"), context.index("Контекст текущего диалога"))
+
+        with StubOllama(cache_slots=2) as stub:
+            client = llm.LLMClient(base_url=stub.url, max_retries=0)
+            first = client.chat(anna)["prompt_eval_count"]
+            second = client.chat(oleg)["prompt_eval_count"]
+            again = client.chat(anna)["prompt_eval_count"]
+            client.close()
+        self.assertLess(second, first // 2)  # SYSTEM_PROMPT уже в KV-кэше
+        self.assertEqual(again, 1)  # слот Анны не вытеснен запросом Олега
+
+
+class DreamIndexTests(TestCase):
+    def setUp(self):
+        dream_index.reset_dream_index()
+        self.addCleanup(dream_index.reset_dream_index)
+        self.user = User.objects.create_user(phone_number="+70000000060", name="Анна")
+
+    def dream(self, session, text):
+        message = Message.objects.create(session=session, is_user=True, content=text)
+        Message.objects.create(session=session, is_user=False, content="Интерпретация.")
+        return message
+
+    def test_similar_old_dream_reaches_the_prompt(self):
+        from .context import build_llm_context
+
+        old = DreamSession.objects.create(user=self.user, is_active=False)
+        with mock.patch.object(dream_index, "schedule_indexing") as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                wolf = Message.objects.create(session=old, is_user=True, content="Меня преследовали волки в тёмном лесу")
+        schedule.assert_called_once_with(wolf.id)
+        for i in range(6):
+            session = DreamSession.objects.create(user=self.user, is_active=False)
+            self.dream(session, f"Я покупала хлеб в магазине номер {i}")
+        current = DreamSession.objects.create(user=self.user)
+        Message.objects.create(session=current, is_user=True, content="Снова волки гнались за мной по лесу")
+        past = Message.objects.exclude(session=current).values_list("id", flat=True)
+        self.assertEqual(dream_index.index_messages(past), 7)  # только сны, без ответов сонника
+        self.assertEqual(dream_index.index_messages(past), 0)
+
+        context = build_llm_context(self.user, "Снова волки гнались за мной по лесу", session=current)
+        # Сон о волках старше четырёх последних сессий, но попадает в промпт как похожий
+        self.assertEqual(context.count("волки в тёмном лесу"), 1)
+        self.assertIn("Похожие сны из прошлого:", context)
+        self.assertNotIn("Снова волки", context)
+        similar = context.split("Похожие сны из прошлого:\n")[1]
+        self.assertNotIn("хлеб", similar)
+
+        # Новый сон индексируется — следующий поиск дочитывает только его
+        index = dream_index.load_index(self.user.id, dream_index.HASHING)
+        self.assertEqual(len(index), 7)
+        dream_index.index_messages(Message.objects.filter(session=current).values_list("id", flat=True))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(dream_index.load_index(self.user.id, dream_index.HASHING)), 8)
+
+    @override_settings(DREAM_EMBED_MODEL="nomic-embed-text")
+    def test_ollama_embeddings_with_hashing_fallback(self):
+        session = DreamSession.objects.create(user=self.user, is_active=False)
+        first, second = self.dream(session, "Я летала над морем"), self.dream(session, "Я тонула в море")
+
+        def embed(texts, model):
+            return [[1.0, 0.0] if "летала" in t else [0.6, 0.8] for t in texts]
+
+        with mock.patch.object(llm.LLMClient, "embed", side_effect=embed):
+            dream_index.index_messages([first.id, second.id])
+            embedder, query = dream_index.embed_query("Я летала над морем")
+        self.assertEqual(embedder, "ollama:nomic-embed-text")
+        self.assertEqual(DreamEmbedding.objects.filter(embedder=embedder).count(), 2)
+        index = dream_index.load_index(self.user.id, embedder)
+        self.assertEqual([i for i, _ in index.search(query, 2)], [0, 1])
+
+        with mock.patch.object(llm.LLMClient, "embed", side_effect=llm.LLMTimeout("timeout")):
+            self.assertEqual(dream_index.embed_query("Я летала")[0], dream_index.HASHING)
+
+    @override_settings(DREAM_EMBED_MODEL="nomic-embed-text", OLLAMA_BACKENDS="", DREAM_EMBED_QUERY_TIMEOUT=0.2)
+    def test_embedding_timeouts_do_not_open_the_generation_breaker(self):
+        llm.reset_clients()
+        self.addCleanup(llm.reset_clients)
+        timeout = requests.exceptions.ReadTimeout("busy")
+        with mock.patch.object(requests.Session, "post", side_effect=timeout) as post:
+            for _ in range(settings.LLM_BREAKER_THRESHOLD + 2):
+                self.assertEqual(dream_index.embed_query("Я летала")[0], dream_index.HASHING)
+        self.assertEqual(post.call_args.kwargs["timeout"], 0.2)
+        # Разомкнулся только breaker эмбеддингов: дальше запрос сразу идёт по хешированию
+        self.assertEqual(post.call_count, settings.LLM_BREAKER_THRESHOLD)
+        self.assertEqual(llm.get_pool().backends[0].breaker.state, llm.CircuitBreaker.CLOSED)
+
+    @override_settings(DREAM_EMBED_MODEL="nomic-embed-text", OLLAMA_BACKENDS="")
+    def test_query_is_not_embedded_while_ollama_generates(self):
+        llm.reset_clients()
+        self.addCleanup(llm.reset_clients)
+        backend = llm.get_pool().acquire(settings.OLLAMA_MODEL)  # идёт генерация
+        with mock.patch.object(llm.LLMClient, "embed") as embed:
+            self.assertEqual(dream_index.embed_query("Я летала")[0], dream_index.HASHING)
+            embed.assert_not_called()
+            llm.get_pool().release(backend)
+            embed.return_value = [[1.0, 0.0]]
+            self.assertEqual(dream_index.embed_query("Я летала")[0], "ollama:nomic-embed-text")
+
+    def test_retrieval_is_fast_for_thousands_of_dreams(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((5000, dream_index.HASH_DIM)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index = dream_index.DreamIndex()
+        index.extend([
+            (i + 1, i % 50, timezone.now(), f"сон {i}", vector.astype(np.float16).tobytes())
+            for i, vector in enumerate(vectors)
+        ])
+        query = dream_index.hashing_vector("Меня преследовали волки в тёмном лесу")
+        timings = []
+        for _ in range(20):
+            started = time.perf_counter()
+            index.search(query, 6, exclude_session=3)
+            timings.append(time.perf_counter() - started)
+        self.assertLess(min(timings), 0.003)
+
+
+class HistorySearchTests(TestCase):
+    def setUp(self):
+        search.reset_search_backend()
+        self.addCleanup(search.reset_search_backend)
+        self.user = User.objects.create(phone_number="+70000000070", telegram_id="700")
+        self.other = User.objects.create_user(phone_number="+70000000071")
+        self.session = DreamSession.objects.create(user=self.user)
+
+    def add(self, content, is_user=True, user=None):
+        session = self.session if user is None else DreamSession.objects.create(user=user)
+        return Message.objects.create(session=session, is_user=is_user, content=content)
+
+    def test_fts_search_is_ranked_highlighted_and_per_user(self):
+        self.assertIsInstance(search.get_search_backend(), search.SQLiteFTSBackend)
+        wolves = self.add("Волки, волки и ещё раз волки гнались за мной")
+        self.add("Мне снился лес, а вдалеке выл волк")
+        self.add("Волки <script>alert(1)</script> в городе", user=self.other)
+        tree = self.add("Под ёлкой лежал подарок", is_user=False)
+
+        hits = search.get_search_backend().search(self.user.id, "волк")
+        self.assertEqual(len(hits), 2)
+        self.assertEqual(hits[0]["message_id"], wolves.id)  # bm25: больше совпадений — выше
+        self.assertIn("<mark>Волки</mark>", search.highlight(hits[0]["snippet"]))
+        self.assertEqual([h["message_id"] for h in search.get_search_backend().search(self.user.id, "ЕЛКОЙ")], [tree.id])
+        self.assertFalse(hits[0]["created_at"] is None)
+
+        # Триггеры держат индекс в синхронизации и при queryset.update()/delete()
+        Message.objects.filter(id=tree.id).update(content="Под сосной")
+        self.assertEqual(search.get_search_backend().search(self.user.id, "елкой"), [])
+        Message.objects.filter(id=wolves.id).delete()
+        self.assertEqual(len(search.get_search_backend().search(self.user.id, "волк")), 1)
+
+        other = search.get_search_backend().search(self.other.id, "волки")
+        self.assertIn("&lt;script&gt;", search.highlight(other[0]["snippet"]))
+        # Синтаксис FTS5 в запросе не ломает поиск
+        self.assertEqual(search.get_search_backend().search(self.user.id, 'лес" OR *'), [])
+
+    def test_rebuild_indexes_existing_rows_in_batches(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from django.db import connection
+
+        for i in range(5):
+            self.add(f"Сон про море номер {i}")
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {search.FTS_TABLE}")
+        self.assertEqual(search.get_search_backend().search(self.user.id, "море"), [])
+
+        out = StringIO()
+        call_command("rebuild_search_index", "--batch", "2", stdout=out)
+        self.assertIn("проиндексировано 5", out.getvalue())
+        self.assertEqual(len(search.get_search_backend().search(self.user.id, "море")), 5)
+
+    @override_settings(SEARCH_BACKEND="dreambot.search.DatabaseSearchBackend")
+    def test_database_backend_for_other_databases(self):
+        self.add("Я летал над морем")
+        self.add("Потом море стало льдом", is_user=False)
+        hits = search.get_search_backend().search(self.user.id, "море")
+        self.assertEqual([h["is_user"] for h in hits], [False, True])  # новые сверху
+        self.assertEqual(search.highlight(hits[0]["snippet"]), "Потом <mark>море</mark> стало льдом")
+
+    def test_search_endpoint(self):
+        self.add("Снились волки")
+        self.assertEqual(self.client.get("/api/search/?q=волки").status_code, 401)
+        self.client.force_login(self.user)
+        data = self.client.get("/api/search/", {"q": "волки"}).json()
+        self.assertEqual(len(data["results"]), 1)
+        self.assertEqual(data["results"][0]["snippet"], "Снились <mark>волки</mark>")
+        self.assertEqual(self.client.get("/api/search/", {"q": ""}).json()["results"], [])
+
+    async def test_telegram_search_command(self):
+        from telegram_bot import handlers, identity
+
+        identity.user_cache.clear()
+        await sync_to_async(self.add)("Снились волки в лесу")
+        update = fake_telegram_update(700, "/search волки")
+        await handlers.search_command(update, SimpleNamespace(args=["волки"], user_data={}))
+        text = update.message.reply_text.await_args.args[0]
+        self.assertIn("<b>волки</b>", text)
+        self.assertEqual(update.message.reply_text.await_args.kwargs["parse_mode"], "HTML")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        history.history_cache().clear()
+        self.user = User.objects.create_user(phone_number="+70000000080")
+
+    def exchange(self, session, day, n, reply=True):
+        dream = Message.objects.create(session=session, is_user=True, content=f"сон {day}.{n}")
+        messages = [dream]
+        if reply:
+            messages.append(Message.objects.create(session=session, is_user=False, content=f"ответ {day}.{n}"))
+        when = timezone.now().replace(hour=9, minute=0) - datetime.timedelta(days=day) + datetime.timedelta(minutes=n)
+        Message.objects.filter(id__in=[m.id for m in messages]).update(created_at=when)
+
+    def make_history(self, dreams_per_day):
+        for day, count in enumerate(dreams_per_day):
+            session = DreamSession.objects.create(user=self.user, is_active=day == 0)
+            for n in range(count):
+                self.exchange(session, day, n)
+
+    def read_all(self, page_size):
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                days, cursor = history.history_page(self.user, cursor=cursor, page_size=page_size)
+            pages.append(days)
+            if cursor is None:
+                return pages
+
+    def test_pages_cover_history_once_without_splitting_days(self):
+        self.make_history([3, 2, 4, 1, 2])
+        pages = self.read_all(page_size=5)
+        days = [day for page in pages for day, _ in page]
+        self.assertEqual(len(days), len(set(days)))  # день целиком на одной странице
+        self.assertEqual(days, sorted(days, reverse=True))
+        self.assertEqual([[len(items) for _, items in page] for page in pages], [[3, 2], [4, 1], [2]])
+        self.assertEqual(len(self.read_all(page_size=4)), 4)  # [3], [2], [4], [1, 2]
+        first_day = pages[0][0][1]
+        self.assertEqual([item["dream"] for item in first_day], ["сон 0.0", "сон 0.1", "сон 0.2"])
+        self.assertEqual(first_day[0]["interpretation"], "ответ 0.0")
+
+    def test_day_longer_than_page_is_read_whole(self):
+        self.make_history([1, 7, 1])
+        pages, cursor = [], None
+        while True:
+            days, cursor = history.history_page(self.user, cursor=cursor, page_size=3)
+            pages.append([len(items) for _, items in days])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [[1], [7], [1]])
+
+    def test_unanswered_dreams_are_skipped(self):
+        session = DreamSession.objects.create(user=self.user)
+        self.exchange(session, 1, 0, reply=False)
+        self.exchange(session, 1, 1)
+        (day, items), = history.history_page(self.user)[0]
+        self.assertEqual([(i["dream"], i["interpretation"]) for i in items], [("сон 1.1", "ответ 1.1")])
+
+    def test_history_view_and_api(self):
+        self.make_history([2, 2, 2])
+        self.client.force_login(self.user)
+        with override_settings(HISTORY_PAGE_SIZE=3):
+            page = self.client.get("/history/")
+            cursor = page.context["next_cursor"]
+            self.assertContains(page, "сон 0.1")
+            self.assertNotContains(page, "сон 1.0")
+            data = self.client.get("/api/history/", {"cursor": cursor}).json()
+        self.assertEqual(len(data["days"]), 1)
+        self.assertIn("ответ 1.0", data["days"][0]["html"])
+        self.assertIsNotNone(data["next_cursor"])
+        self.assertEqual(self.client.get("/api/history/", {"cursor": "!!"}).status_code, 400)
+
+
+class HistoryCacheTests(HistoryPaginationTests):
+    def committed(self, func, *args, **kwargs):
+        """Выполняет on_commit-колбэки (сброс кэша истории), не запуская фоновые задачи."""
+        with mock.patch.object(summaries, "schedule_summary_update"), \
+                mock.patch.object(dream_index, "schedule_indexing"), \
+                self.captureOnCommitCallbacks(execute=True):
+            return func(*args, **kwargs)
+
+    def test_past_days_are_rendered_once(self):
+        self.make_history([1, 2, 3])
+        with mock.patch.object(history, "render_to_string", wraps=history.render_to_string) as render:
+            first, _ = history.cached_history_page(self.user)
+            self.assertEqual(render.call_count, 3)
+            with self.assertNumQueries(0):
+                again, _ = history.cached_history_page(self.user)
+            self.assertEqual(again, first)
+            self.assertEqual(render.call_count, 3)
+
+            session = DreamSession.objects.get(user=self.user, is_active=True)
+            self.committed(self.exchange, session, 0, 5)
+            with self.assertNumQueries(1):
+                days, _ = history.cached_history_page(self.user)
+            # Перерисован только сегодняшний день
+            self.assertEqual(render.call_count, 4)
+            self.assertIn("сон 0.5", days[0][1])
+            self.assertEqual(days[1:], first[1:])
+
+    def test_reply_after_midnight_invalidates_the_dream_day(self):
+        session = DreamSession.objects.create(user=self.user)
+        dream = Message.objects.create(session=session, is_user=True, content="сон до полуночи")
+        yesterday = timezone.now() - datetime.timedelta(days=1)
+        Message.objects.filter(id=dream.id).update(created_at=yesterday)
+        key = f"history:{self.user.id}:day:{yesterday.date().isoformat()}:version"
+        before = history._version(key)
+        self.committed(Message.objects.create, session=session, is_user=False, content="ответ после полуночи")
+        self.assertGreater(history._version(key), before)
+        (day, html), = history.cached_history_page(self.user)[0]
+        self.assertEqual(day, yesterday.date())
+        self.assertIn("ответ после полуночи", html)
+
+    def test_returning_visitor_gets_304(self):
+        self.make_history([1, 1])
+        self.client.force_login(self.user)
+        page = self.client.get("/history/")
+        self.assertEqual(page.status_code, 200)
+        self.assertIn("private", page["Cache-Control"])
+        etag, last_modified = page["ETag"], page["Last-Modified"]
+
+        self.assertEqual(self.client.get("/history/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get("/history/", HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        session = DreamSession.objects.get(user=self.user, is_active=True)
+        self.committed(self.exchange, session, 0, 1)
+        fresh = self.client.get("/history/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(fresh.status_code, 200)
+        self.assertContains(fresh, "сон 0.1")
+        self.assertNotEqual(fresh["ETag"], etag)
+
+        # Очистка чата тоже меняет версию
+        self.client.post("/api/clear-chat/")
+        self.assertEqual(self.client.get("/history/", HTTP_IF_NONE_MATCH=fresh["ETag"]).status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, FREE_DREAMS_PER_DAY=5)
+class DreamQuotaTests(TransactionTestCase):
+    """Лимит снов списывается атомарно и держится при параллельных запросах."""
+
+    def setUp(self):
+        self.user = User.objects.create(phone_number="+70000000090")
+        for target in (summaries.schedule_summary_update, dream_index.schedule_indexing):
+            patcher = mock.patch.object(sys.modules[target.__module__], target.__name__)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def counter(self):
+        return User.objects.values_list("free_messages_today", "last_message_date").get(pk=self.user.pk)
+
+    def test_concurrent_dreams_do_not_exceed_the_limit(self):
+        attempts = 12
+        barrier = threading.Barrier(attempts)
+
+        def send(_):
+            # У каждого запроса свой экземпляр User, прочитанный до чужих списаний
+            user = User.objects.get(pk=self.user.pk)
+            barrier.wait()
+            try:
+                for _ in range(50):
+                    try:
+                        quota.save_dream(user, "сон о гонке")
+                        return True
+                    except quota.QuotaExceeded:
+                        return False
+                    except OperationalError as e:
+                        # Общий in-memory SQLite тестов не ждёт блокировку, а сразу отказывает — повторяем
+                        if "locked" not in str(e):
+                            raise
+                        time.sleep(0.01)
+                raise AssertionError("database stayed locked")
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(attempts) as executor:
+            results = list(executor.map(send, range(attempts)))
+
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual(self.counter(), (5, timezone.localdate()))
+        self.assertEqual(Message.objects.filter(is_user=True).count(), 5)
+
+    def test_stale_user_cannot_take_the_last_dream_twice(self):
+        User.objects.filter(pk=self.user.pk).update(free_messages_today=4, last_message_date=timezone.localdate())
+        first, second = User.objects.get(pk=self.user.pk), User.objects.get(pk=self.user.pk)
+        self.assertTrue(quota.consume_dream(first))
+        self.assertFalse(quota.limit_reached(second))  # в памяти — ещё 4 из 5
+        self.assertFalse(quota.consume_dream(second))
+        self.assertEqual(self.counter()[0], 5)
+
+    def test_new_day_resets_counter_in_one_update(self):
+        yesterday = timezone.localdate() - datetime.timedelta(days=1)
+        User.objects.filter(pk=self.user.pk).update(free_messages_today=5, last_message_date=yesterday)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(quota.limit_reached(user))
+        with self.assertNumQueries(1):
+            self.assertTrue(quota.consume_dream(user))
+        self.assertEqual(self.counter(), (1, timezone.localdate()))
+        self.assertEqual((user.free_messages_today, user.last_message_date), (1, timezone.localdate()))
+
+    def test_dream_write_path_touches_only_quota_columns(self):
+        user = User.objects.get(pk=self.user.pk)
+        # BEGIN, списание, сессия (SELECT + INSERT), сон, счётчики сессии, COMMIT
+        with self.assertNumQueries(7) as queries:
+            session, message = quota.save_dream(user, "Мне снилось море")
+        update = next(q["sql"] for q in queries.captured_queries if q["sql"].startswith("UPDATE"))
+        self.assertIn("free_messages_today", update)
+        self.assertNotIn("password", update)
+        self.assertEqual(message.session, session)
+
+    def test_failed_message_does_not_spend_quota(self):
+        user = User.objects.get(pk=self.user.pk)
+        with mock.patch.object(Message.objects, "create", side_effect=RuntimeError("disk full")):
+            with self.assertRaises(RuntimeError):
+                quota.save_dream(user, "сон")
+        self.assertEqual(self.counter(), (0, None))
+        self.assertEqual((user.free_messages_today, user.last_message_date), (0, None))
+
+    def test_premium_dreams_are_not_counted(self):
+        User.objects.filter(pk=self.user.pk).update(is_premium=True)
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(quota.consume_dream(user))
+        self.assertEqual(self.counter(), (0, None))
+
+    def test_bot_user_cache_is_dropped_after_quota_update(self):
+        from telegram_bot import identity
+
+        User.objects.filter(pk=self.user.pk).update(telegram_id="777")
+        user = User.objects.get(pk=self.user.pk)
+        identity.user_cache.clear()
+        identity.user_cache.set("777", user)
+        quota.consume_dream(user)
+        self.assertIsNone(identity.user_cache.get("777"))
+
+
+class SQLiteProfileTests(SimpleTestCase):
+    def test_new_connections_get_the_tuned_profile(self):
+        from django.conf import settings
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            settings_dict = {**settings.DATABASES["default"], "NAME": os.path.join(tmpdir, "db.sqlite3"), "TEST": {}}
+            wrapper = DatabaseWrapper(settings_dict, alias="sqlite_profile")
+            try:
+                with wrapper.cursor() as cursor:
+                    def pragma(name):
+                        return cursor.execute(f"PRAGMA {name}").fetchone()[0]
+
+                    self.assertEqual(pragma("journal_mode"), "wal")
+                    self.assertEqual(pragma("synchronous"), 1)  # NORMAL
+                    self.assertEqual(pragma("busy_timeout"), int(settings.SQLITE_TIMEOUT * 1000))
+                    self.assertEqual(pragma("cache_size"), -settings.SQLITE_CACHE_SIZE_KB)
+                self.assertEqual(wrapper.transaction_mode, "IMMEDIATE")
+            finally:
+                wrapper.close()
+        self.assertGreater(settings.DATABASES["default"]["CONN_MAX_AGE"], 0)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, LLM_ROUTING=False, OLLAMA_MODEL="qwen2:7b", OLLAMA_BACKENDS="", DREAM_EMBED_MODEL="",
+    LLM_MAX_CONCURRENCY=4, LLM_QUEUE_SLA=1000, PERF_SLOW_REQUEST_MS=0, PERF_SAMPLE_RATE=0,
+)
+class InstrumentationTests(TestCase):
+    """Трасса запроса: спаны, SQL и счётчики Ollama — в Server-Timing и логе dreambot.perf."""
+
+    def setUp(self):
+        self.stub = StubOllama(delay=0.05).start()
+        self.addCleanup(self.stub.stop)
+        settings_patch = override_settings(OLLAMA_URL=self.stub.url)
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        llm.reset_clients()
+        self.addCleanup(llm.reset_clients)
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        for target in (summaries.schedule_summary_update, dream_index.schedule_indexing):
+            patcher = mock.patch.object(sys.modules[target.__module__], target.__name__)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = User.objects.create(phone_number="+70000000095", telegram_id="9595")
+
+    def perf_records(self, logs):
+        return [json.loads(record.getMessage()) for record in logs.records]
+
+    def test_message_request_is_traced(self):
+        self.client.force_login(self.user)
+        with self.assertLogs("dreambot.perf", "WARNING") as logs:
+            response = self.client.post("/api/message/", data={"text": "Мне снилось море"},
+                                        content_type="application/json")
+        self.assertEqual(response.json()["reply"], self.stub.reply)
+        record, = self.perf_records(logs)
+        self.assertEqual(record["name"], "POST /api/message/")
+        self.assertEqual((record["status"], record["user_id"], record["route"]), (200, self.user.id, "large"))
+        self.assertEqual(set(record["spans"]), {"context", "llm", "db.read", "db.write"})
+        self.assertGreaterEqual(record["spans"]["llm"]["ms"], 50)
+        self.assertEqual(record["queries"], sum(s["count"] for n, s in record["spans"].items() if n.startswith("db.")))
+        call, = record["llm"]
+        self.assertEqual(call["model"], "qwen2:7b")
+        self.assertEqual(call["eval_ms"], 50.0)
+        self.assertIn("prompt_eval_ms", call)
+        self.assertIn("eval_count", call)
+        timing = response["Server-Timing"]
+        self.assertTrue(timing.startswith("total;dur="))
+        self.assertIn("llm;dur=", timing)
+
+    def test_streamed_reply_is_traced_until_the_stream_closes(self):
+        self.client.force_login(self.user)
+        with self.assertLogs("dreambot.perf", "WARNING") as logs:
+            response = self.client.post("/api/message/stream/", data={"text": "Мне снилось море"},
+                                        content_type="application/json")
+            read_stream(response)
+            response.close()
+        record, = self.perf_records(logs)
+        self.assertEqual(record["name"], "POST /api/message/stream/")
+        self.assertIn("llm", record["spans"])
+        self.assertEqual(len(record["llm"]), 1)
+        # Ответ бота сохраняется в генераторе — и тоже попадает в трассу
+        self.assertGreaterEqual(record["spans"]["db.write"]["count"], 2)
+
+    def test_fast_requests_are_sampled(self):
+        self.client.force_login(self.user)
+        with override_settings(PERF_SLOW_REQUEST_MS=10 ** 6), self.assertNoLogs("dreambot.perf"):
+            self.client.get("/history/")
+        with override_settings(PERF_SLOW_REQUEST_MS=10 ** 6, PERF_SAMPLE_RATE=1), \
+                self.assertLogs("dreambot.perf", "INFO") as logs:
+            self.client.get("/history/")
+        self.assertEqual(logs.records[0].levelname, "INFO")
+        self.assertEqual(self.perf_records(logs)[0]["name"], "GET /history/")
+
+    def test_telegram_handlers_are_traced(self):
+        from telegram_bot import identity
+        from telegram_bot.handlers import handle_message
+
+        identity.user_cache.clear()
+        update = fake_telegram_update(9595, "Мне снилось море")
+        with self.assertLogs("dreambot.perf", "WARNING") as logs:
+            async_to_sync(instrumentation.traced_handler(handle_message))(update, SimpleNamespace(user_data={}))
+        record, = self.perf_records(logs)
+        self.assertEqual(record["name"], "telegram:handle_message")
+        self.assertEqual(record["user_id"], self.user.id)
+        self.assertEqual(set(record["spans"]), {"context", "llm", "db.read", "db.write"})
+        self.assertEqual(record["llm"][0]["eval_count"], len(self.stub.reply.split(" ")))
+
+    def test_hooks_do_nothing_outside_a_trace(self):
+        with instrumentation.span("llm"):
+            pass
+        instrumentation.record_llm({"eval_count": 1})
+        self.assertIsNone(instrumentation.current_trace())
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, LLM_ROUTING=False, OLLAMA_MODEL="qwen2:7b", OLLAMA_BACKENDS="", DREAM_EMBED_MODEL="",
+    LLM_MAX_CONCURRENCY=4, LLM_QUEUE_SLA=1000, PERF_INSTRUMENTATION=False, METRICS_TOKEN="",
+    METRICS_ALLOWED_IPS=["127.0.0.1"],
+)
+class MetricsTests(TestCase):
+    """Метрики Prometheus: формат, сумма по процессам, доступ к /metrics и что считают сайт и бот."""
+
+    def setUp(self):
+        metrics.reset_metrics()
+        self.addCleanup(metrics.reset_metrics)
+        self.stub = StubOllama(delay=0.05).start()
+        self.addCleanup(self.stub.stop)
+        settings_patch = override_settings(OLLAMA_URL=self.stub.url)
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        llm.reset_clients()
+        self.addCleanup(llm.reset_clients)
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        for target in (summaries.schedule_summary_update, dream_index.schedule_indexing):
+            patcher = mock.patch.object(sys.modules[target.__module__], target.__name__)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = User.objects.create(phone_number="+70000000096", telegram_id="9696")
+
+    def test_text_format(self):
+        registry = metrics.Registry()
+        requests_total = metrics.Counter("test_requests_total", "Запросы", ["path"], registry=registry)
+        latency = metrics.Histogram("test_latency_seconds", "Время", buckets=(0.1, 1), registry=registry)
+        requests_total.inc(path='/a"b')
+        requests_total.inc(2, path='/a"b')
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+        with override_settings(METRICS_DIR=""):
+            text = registry.render()
+        self.assertIn("# TYPE test_requests_total counter\n", text)
+        self.assertIn('test_requests_total{path="/a\\"b"} 3.0\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1.0\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 2.0\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 3.0\n', text)
+        self.assertIn("test_latency_seconds_sum 5.55\n", text)
+        self.assertIn("test_latency_seconds_count 3.0\n", text)
+        with self.assertRaises(ValueError):
+            requests_total.inc(method="GET")
+
+    def test_values_of_all_processes_are_summed(self):
+        metrics.MESSAGES.inc(2, channel="web")
+        pid = os.fork()
+        if pid == 0:
+            # Дочерний процесс начинает с нуля, а не с копии значений родителя
+            code = 0 if metrics.MESSAGES.value(channel="web") == 0 else 1
+            metrics.MESSAGES.inc(3, channel="web")
+            metrics.REGISTRY.flush()
+            os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.addCleanup(os.remove, os.path.join(settings.METRICS_DIR, f"{pid}.json"))
+        self.assertIn('dreambot_messages_total{channel="web"} 5.0\n', metrics.render_metrics())
+        self.assertEqual(metrics.MESSAGES.value(channel="web"), 2)
+
+    def test_endpoint_is_protected(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn(b"# TYPE dreambot_messages_total counter", response.content)
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.1.2.3").status_code, 403)
+        # Локальный адрес за прокси — это адрес прокси, а не клиента
+        self.assertEqual(self.client.get("/metrics", HTTP_X_FORWARDED_FOR="10.1.2.3").status_code, 403)
+        with override_settings(METRICS_TOKEN="s3cret"):
+            self.assertEqual(
+                self.client.get("/metrics", REMOTE_ADDR="10.1.2.3", HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200,
+            )
+            self.assertEqual(
+                self.client.get("/metrics", REMOTE_ADDR="10.1.2.3", HTTP_AUTHORIZATION="Bearer nope").status_code, 403,
+            )
+            # Не-ASCII в заголовке — отказ, а не 500
+            self.assertEqual(
+                self.client.get("/metrics", REMOTE_ADDR="10.1.2.3", HTTP_AUTHORIZATION="Bearer пароль").status_code, 403,
+            )
+        with override_settings(METRICS_ENABLED=False):
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+    def test_web_and_telegram_dreams_are_counted(self):
+        from telegram_bot import identity
+        from telegram_bot.handlers import handle_message
+
+        self.client.force_login(self.user)
+        response = self.client.post("/api/message/", data={"text": "Мне снилось море"}, content_type="application/json")
+        self.assertEqual(response.json()["reply"], self.stub.reply)
+        identity.user_cache.clear()
+        async_to_sync(handle_message)(fake_telegram_update(9696, "Мне снился лес"), SimpleNamespace(user_data={}))
+
+        self.assertEqual(metrics.MESSAGES.value(channel="web"), 1)
+        self.assertEqual(metrics.MESSAGES.value(channel="telegram"), 1)
+        self.assertEqual(metrics.LLM_LATENCY.count(model="qwen2:7b", outcome="ok"), 2)
+        self.assertEqual(metrics.LLM_TOKENS_PER_SECOND.count(model="qwen2:7b"), 2)
+        self.assertEqual(
+            metrics.LLM_TOKENS.value(model="qwen2:7b", kind="completion"), 2 * len(self.stub.reply.split(" ")),
+        )
+        self.assertEqual(metrics.QUEUE_WAIT.count(priority="free"), 2)
+        self.assertEqual(metrics.CACHE_REQUESTS.value(cache="interpretation", result="miss"), 2)
+
+        User.objects.filter(pk=self.user.pk).update(
+            free_messages_today=settings.FREE_DREAMS_PER_DAY, last_message_date=timezone.localdate(),
+        )
+        self.client.force_login(User.objects.get(pk=self.user.pk))
+        self.client.post("/api/message/", data={"text": "Мне снилось небо"}, content_type="application/json")
+        self.assertEqual(metrics.QUOTA_REJECTIONS.value(channel="web"), 1)
+        self.assertEqual(metrics.MESSAGES.value(channel="web"), 1)
+
+    def test_llm_errors_are_counted_by_class(self):
+        with mock.patch.object(llm.LLMClient, "chat", side_effect=llm.LLMConnectionError("refused")):
+            views.get_llm_response(self.user, "Мне снилось море")
+        views.llm_error_reply(llm.LLMTimeout("timeout"))
+        views.llm_error_reply(llm.LLMRequestError("500"))
+        self.assertEqual(metrics.LLM_ERRORS.value(kind="connection"), 1)
+        self.assertEqual(metrics.LLM_ERRORS.value(kind="timeout"), 1)
+        self.assertEqual(metrics.LLM_ERRORS.value(kind="request"), 1)
+        self.assertEqual(metrics.LLM_LATENCY.count(model="qwen2:7b", outcome="error"), 1)
+
+
+def seed_dream_archive(users, sessions, dreams_per_session=2):
+    """
+    Архив снов для проверки планов запросов: users пользователей по sessions сессий
+    (активна последняя), в каждой dreams_per_session пар сон — ответ. Возвращает пользователей.
+    """
+    people = User.objects.bulk_create([User(phone_number=f"+7555{i:07d}") for i in range(users)])
+    archive = DreamSession.objects.bulk_create([
+        DreamSession(user=user, is_active=n == sessions - 1, first_dream=f"Сон {n} о море",
+                     message_count=dreams_per_session * 2, summary_folded=n < sessions // 2)
+        for user in people for n in range(sessions)
+    ])
+    messages = Message.objects.bulk_create([
+        Message(session=session, is_user=k % 2 == 0, content=f"{'Сон' if k % 2 == 0 else 'Ответ'} {k} о море и лесе")
+        for session in archive for k in range(dreams_per_session * 2)
+    ])
+    with connection.cursor() as cursor:
+        # bulk_create ставит всем одно время — разносим сессии по дням (активная — сегодняшняя),
+        # а сообщения внутри сессии — по секундам
+        cursor.execute(
+            "UPDATE dreambot_dreamsession SET created_at = datetime('now', '-' || (%s - (id - %s) %% %s) || ' days')",
+            [sessions - 1, archive[0].id, sessions],
+        )
+        cursor.execute(
+            "UPDATE dreambot_message SET created_at = (SELECT datetime(s.created_at, '+' || (dreambot_message.id - %s) "
+            "|| ' seconds') FROM dreambot_dreamsession s WHERE s.id = dreambot_message.session_id)",
+            [messages[0].id],
+        )
+        cursor.execute("ANALYZE")
+    return people
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DREAM_EMBED_MODEL="", LLM_MAX_CONCURRENCY=4, LLM_QUEUE_SLA=1000)
+class QueryBudgetTests(TestCase):
+    """
+    Горячие пути на большом архиве: число запросов не растёт с историей, и ни один
+    запрос не читает таблицу целиком (EXPLAIN QUERY PLAN без SCAN по таблицам).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed_dream_archive(users=40, sessions=30)[0]
+        User.objects.filter(pk=cls.user.pk).update(telegram_id="4242")
+        cls.user.telegram_id = "4242"
+
+    def setUp(self):
+        from telegram_bot import identity
+
+        identity.user_cache.clear()
+        history.history_cache().clear()
+        scheduler.reset_scheduler()
+        interpretations.reset_interpretation_cache()
+        dream_index.reset_dream_index()
+        for target in (summaries.schedule_summary_update, dream_index.schedule_indexing):
+            patcher = mock.patch.object(sys.modules[target.__module__], target.__name__)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        async def stream_chat(client, messages, options=None, model=None):
+            yield "Море — символ чувств."
+
+        for name, fake in (("stream_chat", stream_chat),
+                           ("chat", mock.AsyncMock(return_value=chat_reply("Море — символ чувств.")))):
+            patcher = mock.patch.object(llm.AsyncLLMClient, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assertIndexedQueries(self, queries):
+        """Каждый SELECT/UPDATE/DELETE идёт по индексу (SCAN допустим только для виртуальной таблицы FTS)."""
+        with connection.cursor() as cursor:
+            for query in queries:
+                sql = query["sql"]
+                if not sql.startswith(("SELECT", "UPDATE", "DELETE")):
+                    continue
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                plan = [row[-1] for row in cursor.fetchall()]
+                scans = [step for step in plan if step.startswith("SCAN") and "VIRTUAL TABLE" not in step]
+                self.assertFalse(scans, f"{sql}\n" + "\n".join(plan))
+
+    def assertBudget(self, budget, func, *args, **kwargs):
+        with self.assertNumQueries(budget) as queries:
+            result = func(*args, **kwargs)
+        self.assertIndexedQueries(queries.captured_queries)
+        return result
+
+    def assertUsesIndex(self, queryset, index):
+        self.assertIn(f"USING INDEX {index}", queryset.explain())
+
+    def test_hot_querysets_use_composite_indexes(self):
+        session = DreamSession.objects.filter(user=self.user).order_by("id").first()
+        active = DreamSession.objects.filter(user=self.user, is_active=True).order_by("-created_at")[:1]
+        self.assertUsesIndex(active, "dream_session_active_idx")
+        self.assertUsesIndex(DreamSession.objects.filter(user=self.user).order_by("-created_at")[:10],
+                             "dream_session_user_idx")
+        self.assertUsesIndex(Message.objects.filter(session=session).order_by("created_at"), "message_session_idx")
+        self.assertUsesIndex(Message.objects.filter(session=session, is_user=True).order_by("-created_at")[:1],
+                             "message_session_dreams_idx")
+        plan = history._answered_dreams(self.user)[:31].explain()
+        self.assertIn("message_session_dreams_idx (session_id=?)", plan)
+        self.assertIn("message_session_idx (session_id=? AND created_at>?)", plan)
+
+    def test_web_views_within_budget(self):
+        self.client.force_login(self.user)
+        # Сессия и пользователь из django_session — в каждом запросе
+        self.assertEqual(self.assertBudget(4, self.client.get, "/chat/").status_code, 200)
+        self.assertEqual(self.assertBudget(3, self.client.get, "/history/").status_code, 200)
+        page = self.client.get("/api/history/").json()
+        self.assertBudget(3, self.client.get, "/api/history/", {"cursor": page["next_cursor"]})
+        self.assertEqual(len(self.assertBudget(3, self.client.get, "/api/search/", {"q": "лесе"}).json()["results"]), 20)
+        # Сессия и пользователь, списание лимита и сон, контекст промпта (3), ответ
+        response = self.assertBudget(
+            13, self.client.post, "/api/message/", data={"text": "Мне снилось море"}, content_type="application/json",
+        )
+        self.assertEqual(response.json()["reply"], "Море — символ чувств.")
+        self.assertBudget(4, self.client.post, "/api/clear-chat/")
+
+    def test_bot_handlers_within_budget(self):
+        from telegram_bot import handlers
+
+        context = SimpleNamespace(user_data={}, args=["лесе"])
+        update = fake_telegram_update(4242, "Мне снилось море")
+        # Как /api/message/, но пользователь — из кэша по telegram_id (промах — один запрос)
+        self.assertBudget(12, async_to_sync(handlers.handle_message), update, context)
+        self.assertEqual(update.message.reply_text.return_value.edits[-1][0], "Море — символ чувств.")
+
+        self.assertBudget(2, async_to_sync(handlers.search_command), fake_telegram_update(4242, "/search лесе"), context)
+        callback = SimpleNamespace(
+            data="history", answer=mock.AsyncMock(), edit_message_text=mock.AsyncMock(),
+        )
+        update = SimpleNamespace(callback_query=callback, effective_user=SimpleNamespace(id=4242),
+                                 effective_chat=SimpleNamespace(id=4242))
+        self.assertBudget(1, async_to_sync(handlers.button_callback), update, context)
+        self.assertIn("История твоих снов", callback.edit_message_text.await_args.args[0])
+
+
+class RollingSummaryTests(TestCase):
+    """Краткие содержания обновляются инкрементально и заменяют отрывки в промпте."""
+
+    def setUp(self):
+        scheduler.reset_scheduler()
+        self.user = User.objects.create_user(phone_number="+70000000040")
+        self.session = DreamSession.objects.create(user=self.user)
+        self.prompts = []
+        self.requests = []
+
+        def chat(messages, options=None, model=None):
+            self.requests.append((messages, options, model))
+            self.prompts.append(messages[-1]["content"])
+            return {"message": {"role": "assistant", "content": f"итог {len(self.prompts)}"}}
+
+        client = mock.Mock()
+        client.chat.side_effect = chat
+        patcher = mock.patch.object(summaries, "get_client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def exchange(self, session, dream, reply="Интерпретация " + "о" * 300):
+        Message.objects.create(session=session, is_user=True, content=dream)
+        return Message.objects.create(session=session, is_user=False, content=reply)
+
+    def test_bot_reply_schedules_update_after_commit(self):
+        with mock.patch.object(summaries, "schedule_summary_update") as schedule, \
+                mock.patch.object(dream_index, "schedule_indexing"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.exchange(self.session, "Сон")
+        schedule.assert_called_once_with(self.session.id)
+
+    def test_session_summary_is_incremental(self):
+        self.exchange(self.session, "Мне снилось море")
+        last = self.exchange(self.session, "Потом я плыл")
+        self.assertTrue(summaries.update_session_summary(self.session.id))
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.summary, self.session.summarized_at), ("итог 1", last.created_at))
+
+        # Новых сообщений нет — LLM не вызывается
+        self.assertFalse(summaries.update_session_summary(self.session.id))
+        self.assertEqual(len(self.prompts), 1)
+
+        self.exchange(self.session, "А затем взлетел")
+        summaries.update_session_summary(self.session.id)
+        self.assertIn("итог 1", self.prompts[1])
+        self.assertIn("А затем взлетел", self.prompts[1])
+        self.assertNotIn("Мне снилось море", self.prompts[1])
+
+    @override_settings(LLM_ROUTING=True, LLM_SMALL_MODEL="llama3.2:3b", SUMMARY_NUM_PREDICT=200)
+    def test_summaries_use_the_small_route_and_a_stable_prefix(self):
+        self.exchange(self.session, "Мне снилось море")
+        summaries.update_session_summary(self.session.id)
+        self.exchange(self.session, "Потом я плыл")
+        summaries.update_session_summary(self.session.id)
+        (first, options, model), (second, _, _) = self.requests
+        self.assertEqual(model, "llama3.2:3b")
+        self.assertEqual(options["num_predict"], 200)
+        self.assertEqual(options["num_ctx"], routing.get_route(routing.SMALL).num_ctx)
+        # Инструкция одна и та же и идёт первой — меняется только последнее сообщение
+        self.assertEqual(first[0]["role"], "system")
+        self.assertEqual(first[0], second[0])
+        self.assertNotEqual(first[-1], second[-1])
+        with override_settings(LLM_ROUTING=False):
+            self.assertEqual(summaries.summary_route().model, routing.get_route(routing.LARGE).model)
+
+    def test_finished_sessions_fold_into_user_summary(self):
+        self.exchange(self.session, "Вчерашний сон")
+        summaries.update_session_summary(self.session.id)
+        DreamSession.objects.filter(id=self.session.id).update(is_active=False)
+        DreamSession.objects.create(user=self.user)
+
+        self.assertEqual(summaries.fold_user_summary(self.user.id), 1)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.dream_summary, "итог 2")
+        self.assertTrue(DreamSession.objects.get(id=self.session.id).summary_folded)
+        self.assertEqual(summaries.fold_user_summary(self.user.id), 0)
+
+    def test_prompt_uses_summaries_instead_of_snippets(self):
+        from .context import build_llm_context
+
+        old = DreamSession.objects.create(user=self.user, is_active=False)
+        for i in range(3):
+            self.exchange(old, f"Старый сон {i}")
+        summaries.update_session_summary(old.id)
+        summaries.fold_user_summary(self.user.id)
+        for i in range(3):
+            self.exchange(self.session, f"Сегодняшний сон {i}")
+        summaries.update_session_summary(self.session.id)
+        Message.objects.create(session=self.session, is_user=True, content="Новый сон")
+        self.user.refresh_from_db()
+        self.session.refresh_from_db()
+
+        with self.assertNumQueries(3):
+            compact = build_llm_context(self.user, "Новый сон", session=self.session)
+        raw = build_llm_context(self.user, "Новый сон", session=self.session, summaries=False)
+        self.assertIn(self.user.dream_summary, compact)
+        self.assertIn(self.session.summary, compact)
+        self.assertNotIn("Сегодняшний сон", compact)
+        self.assertNotIn("Старый сон", compact)
+        self.assertIn("Сегодняшний сон 2", raw)
+        self.assertLess(len(compact), len(raw))
+
+    def test_prompt_budget_report(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        for i in range(3):
+            self.exchange(self.session, f"Сон {i}")
+        summaries.update_session_summary(self.session.id)
+        out = StringIO()
+        call_command("prompt_budget", stdout=out)
+        self.assertIn("Сессий: 1", out.getvalue())
+        self.assertIn("Экономия", out.getvalue())
+
+class FakeTelegramMessage:
+    """Отправленное ботом сообщение: запоминает правки."""
+
+    def __init__(self, text="🌙 Анализирую твой сон..."):
+        self.text = text
+        self.edits = []
+        self.delete = mock.AsyncMock()
+        self.reply_text = mock.AsyncMock()
+
+    async def edit_text(self, text, reply_markup=None):
+        self.edits.append((text, reply_markup))
+        self.text = text
+
+
+def fake_telegram_update(chat_id, text):
+    message = SimpleNamespace(text=text, reply_text=mock.AsyncMock())
+    message.reply_text.return_value = FakeTelegramMessage()
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id), effective_user=SimpleNamespace(id=chat_id), message=message,
+    )
+
+
+class TelegramConcurrencyTests(SimpleTestCase):
+    """Пропускная способность бота с медленным LLM: чаты параллельно, внутри чата — по порядку."""
+    LLM_DELAY = 0.3
+    DB_DELAY = 0.05
+
+    def setUp(self):
+        from telegram_bot import handlers
+        from telegram_bot.concurrency import PerChatUpdateProcessor
+
+        self.handlers = handlers
+        self.processor = PerChatUpdateProcessor(32)
+        self.replies = []
+        self.db_threads = set()
+        scheduler.reset_scheduler()
+
+        def blocking_db(*args, **kwargs):
+            # Имитация синхронного ORM-вызова
+            self.db_threads.add(threading.get_ident())
+            time.sleep(self.DB_DELAY)
+            return SimpleNamespace(id=1, is_premium=True, last_message_date=timezone.now().date())
+
+        async def slow_llm(user, text, session=None, ticket=None, route=None):
+            await asyncio.sleep(self.LLM_DELAY)
+            self.replies.append(text)
+            yield f"Ответ на: {text}"
+
+        patches = [
+            mock.patch.object(handlers, "resolve_telegram_user", sync_to_async(blocking_db)),
+            mock.patch.object(handlers, "save_user_dream", sync_to_async(lambda user, text: (blocking_db(), None))),
+            mock.patch.object(handlers, "create_message", sync_to_async(blocking_db)),
+            mock.patch.object(handlers, "astream_llm_response", slow_llm),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    @override_settings(LLM_MAX_CONCURRENCY=16, LLM_QUEUE_SLA=1000)
+    def test_slow_llm_does_not_serialize_chats(self):
+        chats = 8
+
+        async def main():
+            updates = [fake_telegram_update(chat_id, f"сон {chat_id}") for chat_id in range(chats)]
+            context = SimpleNamespace(user_data={"user_id": 1})
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                self.processor.process_update(u, self.handlers.handle_message(u, context)) for u in updates
+            ))
+            return time.perf_counter() - started
+
+        elapsed = asyncio.run(main())
+        serial = chats * (self.LLM_DELAY + 3 * self.DB_DELAY)
+        self.assertEqual(len(self.replies), chats)
+        self.assertLess(elapsed, serial / 3)
+        # ORM-вызовы разных апдейтов идут в разных потоках, а не в одном общем
+        self.assertGreater(len(self.db_threads), 1)
+
+    @override_settings(LLM_MAX_CONCURRENCY=16, LLM_QUEUE_SLA=1000)
+    def test_updates_within_a_chat_keep_their_order(self):
+        async def main():
+            updates = [fake_telegram_update(42, f"сон {i}") for i in range(4)]
+            context = SimpleNamespace(user_data={"user_id": 1})
+            await asyncio.gather(*(
+                self.processor.process_update(u, self.handlers.handle_message(u, context)) for u in updates
+            ))
+
+        asyncio.run(main())
+        self.assertEqual(self.replies, [f"сон {i}" for i in range(4)])
+
+
+class ProgressiveReplyTests(SimpleTestCase):
+    """Потоковый ответ в Telegram: правки плейсхолдера склеиваются по интервалу."""
+
+    def test_edits_are_coalesced(self):
+        from telegram_bot.streaming import CURSOR, ProgressiveReply
+
+        clock = FakeClock()
+        message = FakeTelegramMessage()
+        reply = ProgressiveReply(message, interval=1.0, clock=clock)
+
+        async def main():
+            for i in range(20):
+                await reply.feed(f"слово{i} ")
+                clock.now += 0.2
+            await reply.finish(reply.text.strip(), reply_markup="menu")
+
+        asyncio.run(main())
+        # Первая правка сразу, дальше не чаще раза в секунду, плюс финальная
+        self.assertEqual(message.edits[0], ("слово0" + CURSOR, None))
+        self.assertLessEqual(len(message.edits), 6)
+        final_text = " ".join(f"слово{i}" for i in range(20))
+        self.assertEqual(message.edits[-1], (final_text, "menu"))
+        message.reply_text.assert_not_called()
+
+    def test_retry_after_postpones_edits(self):
+        from telegram.error import RetryAfter
+        from telegram_bot.streaming import ProgressiveReply
+
+        clock = FakeClock()
+        message = FakeTelegramMessage()
+        edit_text = message.edit_text
+        calls = []
+
+        async def rate_limited(text, reply_markup=None):
+            calls.append(clock.now)
+            if len(calls) == 1:
+                raise RetryAfter(5)
+            await edit_text(text, reply_markup=reply_markup)
+
+        message.edit_text = rate_limited
+        reply = ProgressiveReply(message, interval=1.0, clock=clock)
+
+        async def main():
+            for i in range(10):
+                await reply.feed(f"т{i} ")
+                clock.now += 1.0
+
+        asyncio.run(main())
+        # После RetryAfter(5) в t=0 следующая попытка — не раньше t=5
+        self.assertEqual(calls[:2], [0.0, 5.0])
+
+    def test_long_reply_is_split(self):
+        from telegram_bot.streaming import TELEGRAM_TEXT_LIMIT, ProgressiveReply
+
+        message = FakeTelegramMessage()
+        reply = ProgressiveReply(message, interval=1.0, clock=FakeClock())
+        text = "а" * (TELEGRAM_TEXT_LIMIT + 10)
+        asyncio.run(reply.finish(text, reply_markup="menu"))
+        self.assertEqual(message.edits, [("а" * TELEGRAM_TEXT_LIMIT, None)])
+        message.reply_text.assert_awaited_once_with("а" * 10, reply_markup="menu")
+
+    @override_settings(LLM_MAX_CONCURRENCY=4, LLM_QUEUE_SLA=1000, TELEGRAM_EDIT_INTERVAL=0)
+    def test_handler_streams_into_placeholder(self):
+        from telegram_bot import handlers
+
+        scheduler.reset_scheduler()
+        user = SimpleNamespace(id=1, is_premium=True, last_message_date=timezone.now().date())
+
+        async def tokens(user, text, session=None, ticket=None, route=None):
+            for token in ["Море ", "— символ ", "эмоций."]:
+                yield token
+
+        patches = [
+            mock.patch.object(handlers, "resolve_telegram_user", mock.AsyncMock(return_value=user)),
+            mock.patch.object(handlers, "save_user_dream", mock.AsyncMock(return_value=(mock.Mock(), mock.Mock()))),
+            mock.patch.object(handlers, "create_message", mock.AsyncMock()),
+            mock.patch.object(handlers, "astream_llm_response", tokens),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        update = fake_telegram_update(1, "Мне снилось море")
+        asyncio.run(handlers.handle_message(update, SimpleNamespace(user_data={"user_id": 1})))
+
+        placeholder = update.message.reply_text.return_value
+        # Пользователь получает одно сообщение, которое дописывается на глазах
+        update.message.reply_text.assert_awaited_once()
+        self.assertEqual(len(placeholder.edits), 4)
+        text, markup = placeholder.edits[-1]
+        self.assertEqual(text, "Море — символ эмоций.")
+        self.assertIsNotNone(markup)
+        placeholder.delete.assert_not_called()
+        handlers.create_message.assert_awaited_with(session=mock.ANY, is_user=False, content=text, route="small")
+
+    @override_settings(LLM_MAX_CONCURRENCY=4, LLM_QUEUE_SLA=1000, TELEGRAM_EDIT_INTERVAL=0)
+    def test_intermediate_edit_timeout_does_not_stop_the_reply(self):
+        from telegram.error import TimedOut
+        from telegram_bot import handlers
+
+        scheduler.reset_scheduler()
+        user = SimpleNamespace(id=1, is_premium=True, last_message_date=timezone.now().date())
+        produced = []
+
+        async def tokens(user, text, session=None, ticket=None, route=None):
+            for token in ["Море ", "— символ ", "эмоций."]:
+                produced.append(token)
+                yield token
+
+        patches = [
+            mock.patch.object(handlers, "resolve_telegram_user", mock.AsyncMock(return_value=user)),
+            mock.patch.object(handlers, "save_user_dream", mock.AsyncMock(return_value=(mock.Mock(), mock.Mock()))),
+            mock.patch.object(handlers, "create_message", mock.AsyncMock()),
+            mock.patch.object(handlers, "astream_llm_response", tokens),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        update = fake_telegram_update(1, "Мне снилось море")
+        placeholder = update.message.reply_text.return_value
+        edit_text = placeholder.edit_text
+
+        async def flaky_edit(text, reply_markup=None):
+            # Промежуточные правки (без клавиатуры) падают по таймауту, финальная проходит
+            if reply_markup is None:
+                raise TimedOut()
+            await edit_text(text, reply_markup=reply_markup)
+
+        placeholder.edit_text = flaky_edit
+        with self.assertLogs("telegram_bot.streaming", "WARNING"):
+            asyncio.run(handlers.handle_message(update, SimpleNamespace(user_data={"user_id": 1})))
+
+        self.assertEqual(len(produced), 3)
+        text, markup = placeholder.edits[-1]
+        self.assertEqual(text, "Море — символ эмоций.")
+        self.assertIsNotNone(markup)
+        handlers.create_message.assert_awaited_with(session=mock.ANY, is_user=False, content=text, route="small")
+
+
+def telegram_payload(update_id, chat_id, text):
+    """Апдейт в том виде, в каком его присылает Telegram на webhook."""
+    message = {
+        "message_id": update_id,
+        "date": 1700000000,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Тест"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Подменяет HTTP-транспорт PTB: запоминает вызовы Bot API и отвечает заготовками."""
+
+    def __init__(self):
+        self.calls = []
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((api_method, params))
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Сонник", "username": "dream_bot"}
+        elif api_method == "sendMessage":
+            result = {
+                "message_id": len(self.calls), "date": 1700000000,
+                "chat": {"id": params["chat_id"], "type": "private"}, "text": params["text"],
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+@override_settings(TELEGRAM_WEBHOOK_SECRET="s3cret", TELEGRAM_PERSISTENCE_FILE="")
+class TelegramWebhookTests(SimpleTestCase):
+    """Апдейты, пришедшие на webhook, обрабатываются теми же хендлерами, что и при polling."""
+
+    def setUp(self):
+        from telegram_bot import application, handlers, webhook
+
+        self.fake_request = FakeTelegramRequest()
+        patches = [
+            mock.patch.object(
+                webhook, "build_application",
+                lambda updater=True: application.build_application(updater=updater, request=self.fake_request),
+            ),
+            # Незнакомый Telegram ID — пользователь ещё не отправил номер
+            mock.patch.object(handlers, "resolve_telegram_user", mock.AsyncMock(return_value=None)),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def post_updates(self, payloads, secret="s3cret"):
+        from django.test import AsyncClient
+        from telegram_bot import webhook
+
+        async def main():
+            client = AsyncClient()
+            statuses = []
+            for payload in payloads:
+                response = await client.post(
+                    "/telegram/webhook/", data=payload, content_type="application/json",
+                    headers={"X-Telegram-Bot-Api-Secret-Token": secret},
+                )
+                statuses.append(response.status_code)
+            application = webhook._applications.get(asyncio.get_running_loop())
+            if application is not None:
+                # Ждём, пока апдейты из очереди будут обработаны, и останавливаем приложение
+                while application.update_queue.qsize() or application.update_processor.current_concurrent_updates:
+                    await asyncio.sleep(0.01)
+                await application.stop()
+                await application.shutdown()
+            return statuses
+
+        return asyncio.run(main())
+
+    def sent_texts(self):
+        return [(params["chat_id"], params["text"]) for method, params in self.fake_request.calls
+                if method == "sendMessage"]
+
+    def test_updates_are_dispatched_to_handlers(self):
+        statuses = self.post_updates([
+            telegram_payload(1, 100, "/start"),
+            telegram_payload(2, 100, "/help"),
+            telegram_payload(3, 200, "Мне снилось море"),
+        ])
+        self.assertEqual(statuses, [200, 200, 200])
+        sent = self.sent_texts()
+        self.assertEqual(len(sent), 3)
+        self.assertIn("ИИ сонник", sent[0][1])
+        self.assertIn("Помощь", sent[1][1])
+        # Без номера телефона бот просит его отправить
+        self.assertEqual(sent[2], (200, "📱 Нажми «Отправить номер»."))
+
+    def test_wrong_secret_is_rejected(self):
+        statuses = self.post_updates([telegram_payload(1, 100, "/start")], secret="wrong")
+        self.assertEqual(statuses, [403])
+        self.assertEqual(self.fake_request.calls, [])
+
+    def test_non_ascii_secret_is_rejected(self):
+        # Не-ASCII в заголовке — отказ, а не 500
+        statuses = self.post_updates([telegram_payload(1, 100, "/start")], secret="s3crét")
+        self.assertEqual(statuses, [403])
+        self.assertEqual(self.fake_request.calls, [])
+
+    @override_settings(TELEGRAM_WEBHOOK_SECRET="")
+    def test_disabled_without_secret(self):
+        statuses = self.post_updates([telegram_payload(1, 100, "/start")])
+        self.assertEqual(statuses, [404])
+
+
+class TelegramIdentityTests(TestCase):
+    """Пользователь бота определяется по telegram_id из кэша и переживает перезапуск."""
+
+    def setUp(self):
+        from telegram_bot import identity
+
+        self.identity = identity
+        identity.user_cache.clear()
+
+    def test_cache_is_bounded_lru_with_ttl(self):
+        from telegram_bot.identity import UserCache
+
+        clock = FakeClock()
+        cache = UserCache(maxsize=2, ttl=10, clock=clock)
+        users = [SimpleNamespace(pk=i, telegram_id=str(i)) for i in range(3)]
+        cache.set("0", users[0])
+        cache.set("1", users[1])
+        self.assertIsNotNone(cache.get("0"))  # "0" становится самым свежим
+        cache.set("2", users[2])
+        self.assertIsNone(cache.get("1"))
+        self.assertEqual(len(cache), 2)
+        clock.now = 10
+        self.assertIsNone(cache.get("0"))
+        self.assertIsNone(cache.get("2"))
+
+    def test_lookup_is_cached_and_invalidated_on_save(self):
+        user = User.objects.create(phone_number="+70000000010", telegram_id="555")
+        resolve = async_to_sync(self.identity.resolve_telegram_user)
+
+        with self.assertNumQueries(1):
+            first = resolve(555)
+        with self.assertNumQueries(0):
+            cached = resolve(555)
+        self.assertEqual((first.pk, cached.pk), (user.pk, user.pk))
+
+        # Премиум, профиль и счётчик снов меняются через save() — кэш сбрасывается
+        user.is_premium = True
+        user.save()
+        with self.assertNumQueries(1):
+            fresh = resolve(555)
+        self.assertTrue(fresh.is_premium)
+
+    async def test_profile_edits_do_not_write_back_stale_cached_fields(self):
+        from telegram_bot import handlers
+
+        user = await User.objects.acreate(phone_number="+70000000012", telegram_id="888")
+        await self.identity.resolve_telegram_user(888)  # запись попала в кэш
+        # Сайт (другой процесс, сигнал сюда не доходит) выдал премиум и учёл сон
+        await User.objects.filter(pk=user.pk).aupdate(
+            is_premium=True, free_messages_today=2, last_message_date=datetime.date.today(),
+        )
+        context = SimpleNamespace(user_data={})
+
+        await handlers.handle_name(fake_telegram_update(888, "Вера"), context)
+        await handlers.handle_birth_date(fake_telegram_update(888, "01.02.1990"), context)
+
+        await user.arefresh_from_db()
+        self.assertEqual((user.name, user.birth_date), ("Вера", datetime.date(1990, 2, 1)))
+        self.assertEqual((user.is_premium, user.free_messages_today), (True, 2))
+        self.assertEqual(user.last_message_date, datetime.date.today())
+
+    async def test_known_user_is_recognized_after_restart(self):
+        from telegram_bot import handlers
+
+        await User.objects.acreate(phone_number="+70000000011", telegram_id="777", is_premium=True)
+        update = fake_telegram_update(777, "Мне снилось море")
+        context = SimpleNamespace(user_data={})  # user_data пуст, как после перезапуска
+
+        async def tokens(user, text, session=None, ticket=None, route=None):
+            yield "Море — символ эмоций."
+
+        scheduler.reset_scheduler()
+        with mock.patch.object(handlers, "astream_llm_response", tokens):
+            await handlers.handle_message(update, context)
+
+        self.assertIn("user_id", context.user_data)
+        placeholder = update.message.reply_text.return_value
+        self.assertEqual(placeholder.edits[-1][0], "Море — символ эмоций.")
+
+    def test_user_data_and_conversations_are_persisted(self):
+        import os
+        import tempfile
+        from telegram_bot.application import build_application
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, "state.pickle")
+
+        async def main():
+            with override_settings(TELEGRAM_PERSISTENCE_FILE=path):
+                application = build_application(updater=False, request=FakeTelegramRequest())
+                await application.initialize()
+                application.user_data[777]["user_id"] = 5
+                application.mark_data_for_update_persistence(user_ids=777)
+                await application.update_persistence()
+                await application.shutdown()
+
+                restarted = build_application(updater=False, request=FakeTelegramRequest())
+                await restarted.initialize()
+                user_data = dict(restarted.user_data[777])
+                conversations = [h for h in restarted.handlers[0] if getattr(h, "persistent", False)]
+                await restarted.shutdown()
+            return user_data, conversations
+
+        user_data, conversations = asyncio.run(main())
+        self.assertEqual(user_data, {"user_id": 5})
+        self.assertEqual([h.name for h in conversations], ["profile"])
@@ -7,7 +7,14 @@ urlpatterns = [
     path('chat/', views.chat_view, name='chat'),
     path('profile/', views.profile_view, name='profile'),
     path('history/', views.history_view, name='history'),
+    path('api/history/', views.history_api, name='history_api'),
+    path('api/search/', views.search_history, name='search_history'),
     path('api/message/', views.send_message, name='send_message'),
+    path('api/message/stream/', views.send_message_stream, name='send_message_stream'),
+    path('api/jobs/<uuid:job_id>/', views.job_status, name='job_status'),
+    path('healthz', views.healthz, name='healthz'),
+    path('readyz', views.readyz, name='readyz'),
+    path('metrics', views.metrics_view, name='metrics'),
     path('api/profile/', views.update_profile, name='update_profile'),
     path('guide/', views.guide_view, name='guide'),
     path('api/clear-chat/', views.clear_chat, name='clear_chat'),
@@ -1,43 +1,39 @@
 # dreambot/views.py
 import json
-import requests
+import math
 import time
 import hashlib
-from datetime import date, datetime
+from contextlib import nullcontext
+from datetime import datetime
 from django.shortcuts import render, redirect
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse, HttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_http_methods
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.contrib.auth import login
 from django.conf import settings
-from django.db.models import Prefetch
 from django.utils import timezone
-from .models import User, DreamSession, Message
-
-# Системный промпт — психологический уклон
-SYSTEM_PROMPT = """
-Ты — эмпатичный психолог-сонник. Твоя задача — помочь пользователю глубже понять свои сны как отражение его подсознания.
-
-Следуй этим правилам:
-1. Никогда не используй эзотерику, гадания, символизм вроде «птица — к удаче».
-2. Не предсказывай будущее. Сны — не пророчества, а зеркало настоящего.
-3. Сосредоточься на:
-   - эмоциях, которые вызвал сон (страх, радость, смущение и т.д.)
-   - внутренних конфликтах (желание vs обязанность, свобода vs безопасность)
-   - недавних событиях или переживаниях в реальной жизни
-   - скрытых потребностях или подавленных чувствах
-4. Говори мягко, тепло, поддерживающе. Не осуждай и не интерпретируй агрессивно.
-5. Обращайся по имени, если оно известно.
-6. Отвечай одним связным абзацем (3–5 предложений). Не задавай уточняющих вопросов.
-7. Избегай клише вроде «возможно, это связано с...». Говори уверенно, но деликатно.
-8. Будь эмпатичным: чувствуй эмоциональное состояние пользователя и отражай его в ответе.
-9. Если видишь повторяющиеся темы или паттерны в нескольких снах — обязательно отметь это и помоги увидеть глубинные связи.
-
-Пример хорошего ответа:
-«Анна, в твоём сне о падении я чувствую сильный страх потери контроля. Это может отражать текущую ситуацию на работе, где ты чувствуешь давление и неуверенность. Падение — не предупреждение, а признак того, что ты уже давно держишься из последних сил. Твоё подсознание напоминает: позволить себе остановиться — не слабость, а забота о себе».
-
-Теперь проанализируй сон пользователя.
-"""
+from django.urls import reverse
+from asgiref.sync import sync_to_async
+from .models import User, DreamSession, Message, InterpretationJob
+from .jobs import get_job_pool, wait_for_job
+from .scheduler import get_scheduler, priority_for, Overloaded
+from .interpretations import get_interpretation_cache, interpretation_key
+from .context import build_llm_messages
+from .routing import choose_route
+from .quota import QuotaExceeded, asave_dream, limit_reached
+from .warmup import check_readiness, warmup_status
+from .search import highlight, search_messages
+from .instrumentation import activate, span, tag
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, LLM_ERRORS, MESSAGES, QUEUE_REJECTIONS, QUOTA_REJECTIONS,
+    count_cache, llm_timer, render_metrics, scrape_allowed,
+)
+from .history import cached_history_page, history_last_modified, history_version, invalidate_history
+from .llm import (
+    get_client, get_async_client, get_pool,
+    LLMConnectionError, LLMTimeout, LLMRequestError, LLMUnavailable,
+)
 
 
 def landing(request):
@@ -75,13 +71,15 @@ def chat_view(request):
 
 
 @csrf_exempt
-def clear_chat(request):
-    if not request.user.is_authenticated:
+async def clear_chat(request):
+    user = await request.auser()
+    if not user.is_authenticated:
         return JsonResponse({'error': 'Не авторизован'}, status=401)
     if request.method != "POST":
         return JsonResponse({'error': 'Только POST'}, status=400)
-    DreamSession.objects.filter(user=request.user, is_active=True).update(is_active=False)
-    DreamSession.objects.create(user=request.user, is_active=True)
+    await DreamSession.objects.filter(user=user, is_active=True).aupdate(is_active=False)
+    await DreamSession.objects.acreate(user=user, is_active=True)
+    await sync_to_async(invalidate_history)(user.id)
     return JsonResponse({'status': 'ok'})
 
 
@@ -89,193 +87,273 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def get_llm_response(user, user_message, session=None):
-    # Формируем базовый промпт
-    prompt = SYSTEM_PROMPT
-    if user.name:
-        prompt += f"\n\nИмя пользователя: {user.name}"
-    if user.birth_date:
-        from datetime import date
-        today = date.today()
-        age = today.year - user.birth_date.year - ((today.month, today.day) < (user.birth_date.month, user.birth_date.day))
-        prompt += f"\nВозраст пользователя: {age} лет"
-    
-    # Собираем контекст из текущей сессии (последние сообщения)
-    current_session_messages = []
-    if session:
-        # Получаем все сообщения, затем берем все кроме последнего
-        all_messages = list(Message.objects.filter(session=session).order_by('created_at'))
-        if len(all_messages) > 1:
-            previous_messages = all_messages[:-1]  # Все кроме последнего
-            # Берем последние 4 сообщения из текущей сессии (2 пары)
-            for msg in previous_messages[-4:]:
-                if msg.is_user:
-                    current_session_messages.append(f"[Сегодня] Пользователь: {msg.content[:200]}")  # Ограничиваем длину
-                else:
-                    current_session_messages.append(f"[Сегодня] Сонник: {msg.content[:200]}")
-    
-    # Собираем контекст из предыдущих сессий (последние сны из разных дней)
-    previous_sessions_dreams = []
-    if session:
-        # Берем последние 3-4 сессии (кроме текущей)
-        previous_sessions = DreamSession.objects.filter(
-            user=user
-        ).exclude(id=session.id).order_by('-created_at')[:4]
-        
-        for prev_session in previous_sessions:
-            # Берем первый сон из каждой предыдущей сессии (обычно это основной сон дня)
-            first_user_message = Message.objects.filter(
-                session=prev_session, is_user=True
-            ).order_by('created_at').first()
-            
-            if first_user_message:
-                session_date = prev_session.created_at.strftime('%d.%m')
-                dream_preview = first_user_message.content[:150]  # Первые 150 символов
-                previous_sessions_dreams.append(f"[{session_date}] Сон: {dream_preview}...")
-    
-    # Формируем полный контекст
-    context_parts = []
-    
-    if current_session_messages:
-        context_parts.append("Контекст текущего диалога:\n" + "\n".join(current_session_messages))
-    
-    if previous_sessions_dreams:
-        context_parts.append("\nПредыдущие сны пользователя:\n" + "\n".join(previous_sessions_dreams))
-        context_parts.append("\nВАЖНО: Учитывай предыдущие сны из разных дней при анализе нового сна. Ищи связи, закономерности и эмоциональные паттерны между снами. Если видишь повторяющиеся темы, символы или эмоции — обязательно отметь это и помоги увидеть глубинные связи. Анализируй динамику эмоционального состояния пользователя через несколько дней.")
-    elif current_session_messages:
-        context_parts.append("\nВАЖНО: Учитывай предыдущие сны и интерпретации при анализе нового сна. Ищи связи, закономерности и эмоциональные паттерны.")
-    
-    if context_parts:
-        context_text = "\n\n" + "\n".join(context_parts)
-    else:
-        context_text = ""
-    
-    full_input = f"{prompt}{context_text}\n\nНовый сон:\n{user_message}"
-    
-    try:
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "qwen2:7b",
-                "prompt": full_input,
-                "stream": False,
-                "options": {"temperature": 0.7}
-            },
-            timeout=60
-        )
-        response.raise_for_status()
-        data = response.json()
-        if "response" not in data:
-            logger.error(f"Ollama response missing 'response' field: {data}")
-            return "Извини, произошла ошибка при обработке. Попробуй ещё раз? 😊"
-        return data["response"].strip()
-    except requests.exceptions.ConnectionError as e:
-        logger.error(f"Ollama connection error: {e}")
+def llm_error_reply(exc):
+    """Текст ответа пользователю для ошибки обращения к Ollama."""
+    if isinstance(exc, LLMUnavailable):
+        LLM_ERRORS.inc(kind='unavailable')
+        logger.error(f"Ollama unavailable (circuit open): {exc}")
+        return "Извини, сервис временно недоступен. Убедись, что Ollama запущен. Попробуй ещё раз через минуту. 😊"
+    if isinstance(exc, LLMConnectionError):
+        LLM_ERRORS.inc(kind='connection')
+        logger.error(f"Ollama connection error: {exc}")
         return "Извини, сервис временно недоступен. Убедись, что Ollama запущен. Попробуй ещё раз через минуту. 😊"
-    except requests.exceptions.Timeout as e:
-        logger.error(f"Ollama timeout error: {e}")
+    if isinstance(exc, LLMTimeout):
+        LLM_ERRORS.inc(kind='timeout')
+        logger.error(f"Ollama timeout error: {exc}")
         return "Извини, ответ занимает слишком много времени. Попробуй ещё раз. 😊"
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ollama request error: {e}")
+    if isinstance(exc, LLMRequestError):
+        LLM_ERRORS.inc(kind='request')
+        logger.error(f"Ollama request error: {exc}")
         return "Извини, произошла ошибка при запросе. Попробуй ещё раз? 😊"
+    LLM_ERRORS.inc(kind='unexpected')
+    logger.error(f"Ollama unexpected error: {exc}", exc_info=exc)
+    return "Извини, я сейчас устал… Расскажи ещё раз? 😊"
+
+
+def _has_reply(data):
+    return "content" in (data.get("message") or {})
+
+
+def _reply_from_data(data):
+    if not _has_reply(data):
+        LLM_ERRORS.inc(kind='bad_response')
+        logger.error(f"Ollama response missing 'message.content' field: {data}")
+        return "Извини, произошла ошибка при обработке. Попробуй ещё раз? 😊"
+    return data["message"]["content"].strip()
+
+
+def _llm_slot(ticket):
+    """Место в очереди к LLM нужно только лидеру: ответ из кэша или чужой генерации его не ждёт."""
+    return ticket if ticket is not None else nullcontext()
+
+
+def _release(ticket):
+    if ticket is not None:
+        ticket.release()
+
+
+def _generate(messages, ticket, route):
+    """(ответ, можно ли кэшировать) — тексты ошибок в кэш не попадают."""
+    try:
+        with _llm_slot(ticket), span('llm'), llm_timer(route.model):
+            data = get_client().chat(messages, options=route.options(), model=route.model)
     except Exception as e:
-        logger.error(f"Ollama unexpected error: {e}", exc_info=True)
-        return "Извини, я сейчас устал… Расскажи ещё раз? 😊"
+        return llm_error_reply(e), False
+    return _reply_from_data(data), _has_reply(data)
 
 
-@csrf_exempt
-def send_message(request):
-    if not request.user.is_authenticated:
+async def _agenerate(messages, ticket, route):
+    try:
+        async with _llm_slot(ticket):
+            with span('llm'), llm_timer(route.model):
+                data = await get_async_client().chat(messages, options=route.options(), model=route.model)
+    except Exception as e:
+        return llm_error_reply(e), False
+    return _reply_from_data(data), _has_reply(data)
+
+
+def get_llm_response(user, user_message, session=None, ticket=None, route=None):
+    """
+    Ответ на сон. Повтор того же сна в том же контексте берётся из кэша
+    интерпретаций или дожидается уже идущей генерации (dreambot/interpretations.py).
+    ticket — место в очереди к LLM: занимается только при реальной генерации.
+    route — модель и бюджет генерации (dreambot/routing.py), по умолчанию choose_route.
+    """
+    route = route or choose_route(user, user_message)
+    messages = build_llm_messages(user, user_message, session=session)
+    key = interpretation_key(user.pk, messages[:-1], user_message, route=route)
+    cache = get_interpretation_cache()
+    reply, flight = cache.join(key)
+    count_cache('interpretation', reply is not None)
+    if reply is not None:
+        _release(ticket)
+        return reply
+    reply, cacheable = None, False
+    try:
+        reply, cacheable = _generate(messages, ticket, route)
+    finally:
+        cache.finish(key, flight, reply, store=cacheable)
+    return reply
+
+
+async def aget_llm_response(user, user_message, session=None, ticket=None, route=None):
+    """Асинхронный вариант get_llm_response: ORM в потоке, запрос к Ollama — через httpx."""
+    route = route or choose_route(user, user_message)
+    messages = await sync_to_async(build_llm_messages)(user, user_message, session=session)
+    key = interpretation_key(user.pk, messages[:-1], user_message, route=route)
+    cache = get_interpretation_cache()
+    reply, flight = await cache.ajoin(key)
+    count_cache('interpretation', reply is not None)
+    if reply is not None:
+        _release(ticket)
+        return reply
+    reply, cacheable = None, False
+    try:
+        reply, cacheable = await _agenerate(messages, ticket, route)
+    finally:
+        cache.finish(key, flight, reply, store=cacheable)
+    return reply
+
+
+async def astream_llm_response(user, user_message, session=None, ticket=None, route=None):
+    """
+    Асинхронный генератор токенов ответа Ollama (stream=True, NDJSON — один JSON-объект на строку)
+    для потокового эндпоинта сайта и Telegram-бота.
+    Ошибки соединения не глотает — их обрабатывает вызывающий код через llm_error_reply.
+    Ответ из кэша интерпретаций приходит одним токеном.
+    """
+    route = route or choose_route(user, user_message)
+    messages = await sync_to_async(build_llm_messages)(user, user_message, session=session)
+    key = interpretation_key(user.pk, messages[:-1], user_message, route=route)
+    cache = get_interpretation_cache()
+    reply, flight = await cache.ajoin(key)
+    count_cache('interpretation', reply is not None)
+    if reply is not None:
+        _release(ticket)
+        yield reply
+        return
+    parts = []
+    reply = None
+    try:
+        async with _llm_slot(ticket):
+            with span('llm'), llm_timer(route.model):
+                async for token in get_async_client().stream_chat(messages, options=route.options(), model=route.model):
+                    parts.append(token)
+                    yield token
+        reply = ''.join(parts).strip() or None
+    finally:
+        cache.finish(key, flight, reply)
+
+
+def overloaded_response(exc):
+    response = JsonResponse({
+        'reply': f"🌙 Сейчас очень много снов в очереди. Попробуй ещё раз через {exc.retry_after} сек.",
+        'retry_after': exc.retry_after,
+    }, status=429)
+    response['Retry-After'] = str(exc.retry_after)
+    return response
+
+
+def _limit_response():
+    return JsonResponse({
+        'reply': (
+            f"💫 Ты достиг(ла) лимита — {settings.FREE_DREAMS_PER_DAY} снов в день.\n\n"
+            "Хочешь неограниченный доступ к глубокой интерпретации и сохранению всей истории?\n\n"
+            "👉 Нажми кнопку ниже, чтобы разблокировать Премиум!"
+        ),
+        'show_premium_button': True
+    }, status=200)
+
+
+async def _aaccept_dream(request):
+    """
+    Общая часть /api/message/ и /api/message/stream/: проверки, лимит,
+    место в очереди к LLM, сессия и сохранение сообщения пользователя.
+    Возвращает (user, session, text, message, ticket, None) — message это сохранённое
+    сообщение пользователя — или (None, None, None, None, None, JsonResponse с ошибкой).
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
         logger.warning("Unauthenticated request to send_message")
-        return JsonResponse({'reply': 'Пожалуйста, войдите.'}, status=200)
+        return None, None, None, None, None, JsonResponse({'reply': 'Пожалуйста, войдите.'}, status=200)
     if request.method != "POST":
         logger.warning(f"Invalid method {request.method} to send_message")
-        return JsonResponse({'reply': 'Неверный метод.'}, status=200)
+        return None, None, None, None, None, JsonResponse({'reply': 'Неверный метод.'}, status=200)
 
-    user = request.user
-    today = date.today()
-
-    # ИСПРАВЛЕНО: проверка на None
-    if user.last_message_date is None or user.last_message_date != today:
-        user.last_message_date = today
-        user.free_messages_today = 0
-        user.save()
+    # Быстрый отказ без записи в БД; гонки за последний сон решает save_dream
+    if limit_reached(user):
+        QUOTA_REJECTIONS.inc(channel='web')
+        return None, None, None, None, None, _limit_response()
 
-    # Проверка лимита
-    if not user.is_premium and user.free_messages_today >= 5:
-        return JsonResponse({
-            'reply': (
-                "💫 Ты достиг(ла) лимита — 5 снов в день.\n\n"
-                "Хочешь неограниченный доступ к глубокой интерпретации и сохранению всей истории?\n\n"
-                "👉 Нажми кнопку ниже, чтобы разблокировать Премиум!"
-            ),
-            'show_premium_button': True
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON decode error in send_message: {e}")
+        return None, None, None, None, None, JsonResponse({
+            'reply': 'Неверный формат данных. Попробуй ещё раз.'
         }, status=200)
+    text = data.get('text', '').strip()
+    if not text:
+        return None, None, None, None, None, JsonResponse({'reply': 'Пожалуйста, опиши сон.'}, status=200)
 
+    logger.info(f"Processing message from user {user.id}: {text[:50]}...")
+    tag(user_id=user.id)
+
+    # Место в очереди занимаем до записи в БД: при перегрузке сон не сохраняется и лимит не тратится
     try:
-        data = json.loads(request.body)
-        text = data.get('text', '').strip()
-        if not text:
-            return JsonResponse({'reply': 'Пожалуйста, опиши сон.'}, status=200)
+        ticket = get_scheduler().enqueue(priority_for(user))
+    except Overloaded as e:
+        QUEUE_REJECTIONS.inc(channel='web')
+        logger.warning(f"LLM queue overloaded, rejecting user {user.id} (retry after {e.retry_after}s)")
+        return None, None, None, None, None, overloaded_response(e)
 
-        logger.info(f"Processing message from user {user.id}: {text[:50]}...")
+    try:
+        session, message = await asave_dream(user, text)
+    except QuotaExceeded:
+        QUOTA_REJECTIONS.inc(channel='web')
+        ticket.cancel()
+        return None, None, None, None, None, _limit_response()
+    except Exception as e:
+        logger.error(f"Error saving user message: {e}", exc_info=True)
+        ticket.cancel()
+        return None, None, None, None, None, JsonResponse({
+            'reply': 'Ошибка при сохранении сообщения. Попробуй ещё раз.'
+        }, status=200)
 
-        try:
-            session = DreamSession.objects.filter(user=user, is_active=True).order_by('-created_at').first()
-            if not session:
-                session = DreamSession.objects.create(user=user, is_active=True)
-        except Exception as e:
-            logger.error(f"Error creating/getting session: {e}", exc_info=True)
-            return JsonResponse({
-                'reply': 'Ошибка при создании сессии. Попробуй обновить страницу.'
-            }, status=200)
+    MESSAGES.inc(channel='web')
+    return user, session, text, message, ticket, None
 
-        try:
-            user_msg = Message.objects.create(session=session, is_user=True, content=text)
-        except Exception as e:
-            logger.error(f"Error creating user message: {e}", exc_info=True)
-            return JsonResponse({
-                'reply': 'Ошибка при сохранении сообщения. Попробуй ещё раз.'
-            }, status=200)
 
-        if not user.is_premium:
-            try:
-                user.free_messages_today += 1
-                user.save()
-            except Exception as e:
-                logger.error(f"Error updating user message count: {e}", exc_info=True)
-                # Продолжаем выполнение, это не критично
+async def _asave_bot_reply(session, bot_reply, route=''):
+    """Сохраняет ответ бота (route — имя маршрута генерации) и возвращает время ответа в ISO-формате."""
+    try:
+        bot_msg = await Message.objects.acreate(session=session, is_user=False, content=bot_reply, route=route)
+    except Exception as e:
+        logger.error(f"Error creating bot message: {e}", exc_info=True)
+        return datetime.now().isoformat()
+    return bot_msg.created_at.isoformat()
+
+
+@csrf_exempt
+async def send_message(request):
+    try:
+        user, session, text, message, ticket, error = await _aaccept_dream(request)
+        if error:
+            return error
+
+        if request.GET.get('async'):
+            # Асинхронный режим: сразу отдаём id задачи, ответ забирается через /api/jobs/<id>/
+            # Именно сохранённое сообщение, а не «последнее в сессии»: при двойной отправке
+            # каждая задача толкует свой сон
+            job = await InterpretationJob.objects.acreate(user=user, session=session, user_message=message)
+            pool = await sync_to_async(get_job_pool)()
+            pool.submit(job.id, ticket)
+            return JsonResponse({
+                'job_id': str(job.id),
+                'status': job.status,
+                'status_url': reverse('job_status', args=[job.id]),
+            }, status=202)
 
-        logger.info(f"Calling get_llm_response for user {user.id}")
+        route = choose_route(user, text)
+        logger.info(f"Calling get_llm_response for user {user.id} ({route.name} route)")
         try:
-            bot_reply = get_llm_response(user, text, session=session)
+            bot_reply = await aget_llm_response(user, text, session=session, ticket=ticket, route=route)
             if not bot_reply:
                 logger.error("get_llm_response returned empty reply")
                 bot_reply = "Извини, произошла ошибка при генерации ответа. Попробуй ещё раз? 😊"
         except Exception as e:
             logger.error(f"Error in get_llm_response: {e}", exc_info=True)
             bot_reply = "Извини, произошла ошибка при обработке. Попробуй ещё раз? 😊"
+        finally:
+            ticket.release()
         
         logger.info(f"Received reply from LLM: {bot_reply[:50] if bot_reply else 'None'}...")
-        
-        try:
-            bot_msg = Message.objects.create(session=session, is_user=False, content=bot_reply)
-        except Exception as e:
-            logger.error(f"Error creating bot message: {e}", exc_info=True)
-            # Продолжаем выполнение, но без сохранения времени
-            bot_time = datetime.now().isoformat()
-        else:
-            bot_time = bot_msg.created_at.isoformat()
+        bot_time = await _asave_bot_reply(session, bot_reply, route=route.name)
 
         return JsonResponse({
             'reply': bot_reply,
             'bot_time': bot_time
         })
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error in send_message: {e}")
-        return JsonResponse({
-            'reply': 'Неверный формат данных. Попробуй ещё раз.'
-        }, status=200)
     except Exception as e:
         logger.error(f"Unhandled error in send_message: {e}", exc_info=True)
         # Возвращаем 200 с сообщением об ошибке, чтобы не было 500 в браузере
@@ -284,6 +362,119 @@ def send_message(request):
         }, status=200)
 
 
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@csrf_exempt
+async def send_message_stream(request):
+    """
+    Потоковый вариант /api/message/: токены Ollama уходят в браузер по мере
+    генерации (Server-Sent Events). Итоговый ответ сохраняется после конца потока.
+    События: token {token}, done {reply, bot_time}.
+    View и генератор асинхронные: под ASGI синхронный генератор Django читает
+    целиком (sync_to_async(list)) и отдаёт поток одним куском в конце генерации.
+    """
+    try:
+        user, session, text, _, ticket, error = await _aaccept_dream(request)
+    except Exception as e:
+        logger.error(f"Unhandled error in send_message_stream: {e}", exc_info=True)
+        return JsonResponse({
+            'reply': 'Извини, произошла неожиданная ошибка. Попробуй ещё раз? 😊'
+        }, status=200)
+    if error:
+        return error
+    route = choose_route(user, text)
+
+    async def event_stream():
+        parts = []
+        saved = False
+        # Генератор читается уже после выхода из middleware — трассу запроса делаем текущей явно
+        with activate(getattr(request, 'trace', None)):
+            try:
+                logger.info(f"Streaming LLM response for user {user.id}")
+                try:
+                    async for token in astream_llm_response(user, text, session=session, ticket=ticket, route=route):
+                        parts.append(token)
+                        yield _sse('token', {'token': token})
+                    bot_reply = ''.join(parts).strip()
+                    if not bot_reply:
+                        logger.error("astream_llm_response returned empty reply")
+                        bot_reply = "Извини, произошла ошибка при генерации ответа. Попробуй ещё раз? 😊"
+                except Exception as e:
+                    bot_reply = llm_error_reply(e)
+                bot_time = await _asave_bot_reply(session, bot_reply, route=route.name)
+                saved = True
+                yield _sse('done', {'reply': bot_reply, 'bot_time': bot_time})
+            finally:
+                ticket.release()
+                # Клиент закрыл соединение посреди генерации — сохраняем то, что успели
+                # получить, чтобы в истории у сна была пара-интерпретация.
+                if not saved and parts:
+                    await _asave_bot_reply(session, ''.join(parts).strip(), route=route.name)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    # Если клиент ушёл до первого чтения, генератор так и не стартует — место в очереди
+    # освобождаем при закрытии ответа (release идемпотентен).
+    response._resource_closers.append(ticket.release)
+    return response
+
+
+@require_http_methods(["GET"])
+def healthz(request):
+    """Liveness: процесс отвечает. Состояние серверов LLM — справочно, без сетевых запросов."""
+    return JsonResponse({'status': 'ok', 'llm': get_pool().snapshot(), 'warmup': warmup_status()})
+
+
+@require_http_methods(["GET"])
+def readyz(request):
+    """Readiness: 200, когда все используемые модели загружены в Ollama, иначе 503."""
+    report = check_readiness(settings.OLLAMA_HEALTH_TIMEOUT)
+    return JsonResponse(report, status=200 if report['ready'] else 503)
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """Метрики всех процессов в формате Prometheus; доступ — metrics.scrape_allowed."""
+    if not settings.METRICS_ENABLED:
+        return HttpResponse(status=404)
+    if not scrape_allowed(request):
+        return HttpResponse(status=403)
+    return HttpResponse(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+@require_http_methods(["GET"])
+async def job_status(request, job_id):
+    """
+    Статус фоновой интерпретации. ?wait=N — long-poll до N секунд (не больше JOB_LONG_POLL_MAX).
+    Асинхронный: ожидающий клиент не держит поток воркера.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'Не авторизован'}, status=401)
+    if not await InterpretationJob.objects.filter(id=job_id, user=user).aexists():
+        return JsonResponse({'error': 'Задача не найдена'}, status=404)
+    # Подхватывает задачи, оставшиеся от прошлого запуска процесса
+    await sync_to_async(get_job_pool)()
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        wait = 0
+    # nan проходит через min/max и сделал бы ожидание бесконечным
+    if not math.isfinite(wait):
+        wait = 0
+    job = await wait_for_job(job_id, min(max(wait, 0), settings.JOB_LONG_POLL_MAX))
+    data = {'job_id': str(job.id), 'status': job.status}
+    if job.status == InterpretationJob.DONE and job.bot_message:
+        data['reply'] = job.bot_message.content
+        data['bot_time'] = job.bot_message.created_at.isoformat()
+    elif job.status == InterpretationJob.FAILED:
+        data['reply'] = "Извини, произошла ошибка при обработке. Попробуй ещё раз? 😊"
+    return JsonResponse(data)
+
+
 def profile_view(request):
     if not request.user.is_authenticated:
         return redirect('landing')
@@ -292,8 +483,9 @@ def profile_view(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def update_profile(request):
-    if not request.user.is_authenticated:
+async def update_profile(request):
+    user = await request.auser()
+    if not user.is_authenticated:
         return JsonResponse({'error': 'Не авторизован'}, status=401)
     try:
         data = json.loads(request.body)
@@ -305,34 +497,80 @@ def update_profile(request):
                 birth_date = datetime.strptime(birth_date_str, '%Y-%m-%d').date()
             except ValueError:
                 return JsonResponse({'error': 'Неверный формат даты'}, status=400)
-        user = request.user
         user.name = name
         user.birth_date = birth_date
-        user.save()
+        await user.asave()
         return JsonResponse({'status': 'ok'})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 
+def _history_etag(request):
+    if not request.user.is_authenticated:
+        return None
+    return f'W/"history-{request.user.id}-{history_version(request.user.id)}"'
+
+
+def _history_last_modified(request):
+    if not request.user.is_authenticated:
+        return None
+    return history_last_modified(request.user.id)
+
+
+# Версия истории меняется с каждым сообщением — браузер переспрашивает каждый раз и получает 304, пока она та же
+history_conditional = condition(etag_func=_history_etag, last_modified_func=_history_last_modified)
+
+
+@cache_control(private=True, no_cache=True)
+@history_conditional
 def history_view(request):
     if not request.user.is_authenticated:
         return redirect('landing')
-    sessions = DreamSession.objects.filter(user=request.user).prefetch_related(
-        Prefetch('message_set', queryset=Message.objects.order_by('created_at'))
-    ).order_by('-created_at')
-    from collections import defaultdict
-    history_by_date = defaultdict(list)
-    for session in sessions:
-        messages = list(session.message_set.all())
-        for i in range(0, len(messages) - 1, 2):
-            if messages[i].is_user and not messages[i+1].is_user:
-                history_by_date[messages[i].created_at.date()].append({
-                    'dream': messages[i].content,
-                    'interpretation': messages[i+1].content,
-                    'time': messages[i].created_at.strftime('%H:%M')
-                })
-    sorted_history = sorted(history_by_date.items(), key=lambda x: x[0], reverse=True)
-    return render(request, 'dreambot/history.html', {'history': sorted_history})
+    days, next_cursor = cached_history_page(request.user)
+    return render(request, 'dreambot/history.html', {'history': days, 'next_cursor': next_cursor})
+
+
+@require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@history_conditional
+def history_api(request):
+    """Следующая страница истории: ?cursor=... → {'days': [{'date', 'html'}], 'next_cursor'}."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Не авторизован'}, status=401)
+    try:
+        days, next_cursor = cached_history_page(request.user, cursor=request.GET.get('cursor'))
+    except ValueError:
+        return JsonResponse({'error': 'Неверный курсор'}, status=400)
+    return JsonResponse({
+        'days': [{'date': day.isoformat(), 'html': html} for day, html in days],
+        'next_cursor': next_cursor,
+    })
+
+
+@require_http_methods(["GET"])
+def search_history(request):
+    """Поиск по своим снам и интерпретациям: ?q=слова&limit=N. Отрывки — готовый HTML с <mark>."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Не авторизован'}, status=401)
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 50)
+    except ValueError:
+        limit = 20
+    hits = search_messages(request.user.id, query, limit=limit) if query else []
+    return JsonResponse({
+        'query': query,
+        'results': [
+            {
+                'id': hit['message_id'],
+                'is_user': hit['is_user'],
+                'date': hit['created_at'].strftime('%d.%m.%Y'),
+                'time': hit['created_at'].strftime('%H:%M'),
+                'snippet': highlight(hit['snippet']),
+            }
+            for hit in hits
+        ],
+    })
 
 
 def guide_view(request):
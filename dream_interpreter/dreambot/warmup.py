@@ -0,0 +1,138 @@
+# dreambot/warmup.py
+"""
+Прогрев LLM после старта и проверка готовности.
+
+Раньше settings.py при импорте синхронно ждал Ollama (до OLLAMA_TIMEOUT секунд),
+и так начиналась каждая команда manage.py, тест, воркер и бот. Теперь импорт
+настроек ничего не делает, а:
+- warm_up() загружает в память каждую используемую модель (routing.active_routes)
+  на каждом сервере пула, который её обслуживает: короткий /api/chat с общим
+  SYSTEM_PROMPT и num_predict=1 — заодно системный промпт попадает в KV-кэш.
+  num_ctx тот же, что у маршрута, иначе первый настоящий запрос перезагрузит модель;
+- start_background_warmup() запускает прогрев в фоновом потоке — его вызывает
+  DreambotConfig.ready в серверных процессах (LLM_WARMUP); вручную —
+  python manage.py warm_up_llm;
+- check_readiness() — для /readyz: какие модели загружены (GET /api/ps серверов).
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from .backends import canonical_model_name
+from .context import SYSTEM_PROMPT
+from .llm import LLMClient, LLMError, get_pool
+from .routing import active_routes
+
+logger = logging.getLogger(__name__)
+
+IDLE, RUNNING, DONE, FAILED = 'idle', 'running', 'done', 'failed'
+
+# Процессы, которые обслуживают запросы; остальным (migrate, shell, тесты) прогрев не нужен
+SERVER_PROGRAMS = ('uvicorn', 'gunicorn', 'daphne', 'hypercorn', 'run_telegram.py')
+
+_lock = threading.Lock()
+_status = {'state': IDLE, 'results': []}
+
+
+def warmup_status():
+    with _lock:
+        return {'state': _status['state'], 'results': list(_status['results'])}
+
+
+def _warm_backend(backend, route):
+    client = LLMClient(base_url=backend.url, breaker=backend.breaker, max_retries=0)
+    started = time.monotonic()
+    try:
+        client.chat(
+            [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": "Привет"}],
+            options={**route.options(), 'num_predict': 1}, model=route.model,
+        )
+        error = ''
+    except LLMError as e:
+        error = str(e)
+    finally:
+        client.close()
+    return {
+        'url': backend.url, 'model': route.model, 'ok': not error, 'error': error,
+        'seconds': round(time.monotonic() - started, 2),
+    }
+
+
+def warm_up():
+    """Загружает модели маршрутов на серверах; возвращает список результатов по (сервер, модель)."""
+    with _lock:
+        if _status['state'] == RUNNING:
+            return []
+        _status.update(state=RUNNING, results=[])
+    results = []
+    try:
+        pool = get_pool()
+        routes = {route.model: route for route in active_routes()}
+        for route in routes.values():
+            for backend in pool.backends:
+                if not backend.serves(route.model):
+                    continue
+                result = _warm_backend(backend, route)
+                if result['ok']:
+                    logger.info(f"Warmed up {route.model} on {backend.url} in {result['seconds']}s")
+                else:
+                    logger.warning(f"Warm-up of {route.model} on {backend.url} failed: {result['error']}")
+                results.append(result)
+    finally:
+        with _lock:
+            ok = bool(results) and all(r['ok'] for r in results)
+            _status.update(state=DONE if ok else FAILED, results=results)
+    return results
+
+
+def is_server_process(argv, environ=os.environ):
+    """Серверы из SERVER_PROGRAMS и manage.py runserver (в рабочем процессе автоперезагрузки)."""
+    program = os.path.basename(argv[0]) if argv else ''
+    if program in SERVER_PROGRAMS:
+        return True
+    if program == 'manage.py' and argv[1:2] == ['runserver']:
+        return environ.get('RUN_MAIN') == 'true' or '--noreload' in argv
+    return False
+
+
+def start_background_warmup():
+    thread = threading.Thread(target=_run_warmup, name='llm-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def _run_warmup():
+    try:
+        warm_up()
+    except Exception as e:
+        logger.error(f"LLM warm-up crashed: {e}", exc_info=True)
+
+
+def check_readiness(timeout):
+    """Готов ли процесс обслуживать сны: каждая используемая модель загружена хотя бы на одном сервере."""
+    loaded = {}
+    backends = []
+    for backend in get_pool().backends:
+        try:
+            response = requests.get(f"{backend.url}/api/ps", timeout=timeout)
+            response.raise_for_status()
+            models = sorted(canonical_model_name(m['name']) for m in response.json().get('models', []))
+            reachable = True
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            models, reachable = [], False
+        backends.append({'url': backend.url, 'reachable': reachable, 'healthy': backend.healthy, 'loaded': models})
+        if reachable and backend.healthy:
+            for model in models:
+                loaded.setdefault(model, []).append(backend.url)
+    required = sorted({canonical_model_name(route.model) for route in active_routes()})
+    missing = [model for model in required if model not in loaded]
+    return {
+        'ready': not missing,
+        'models': {model: loaded.get(model, []) for model in required},
+        'missing': missing,
+        'backends': backends,
+        'warmup': warmup_status()['state'],
+    }
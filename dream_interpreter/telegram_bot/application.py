@@ -0,0 +1,60 @@
+# telegram_bot/application.py
+"""
+Сборка Application с полным набором обработчиков.
+Используется и для polling (bot.py), и для webhook внутри Django (webhook.py).
+
+user_data и состояние диалога /profile сохраняются в TELEGRAM_PERSISTENCE_FILE и
+переживают перезапуск. Файл рассчитан на один процесс бота: при нескольких
+ASGI-воркерах задайте пустое значение — пользователь всё равно определяется
+по telegram_id (telegram_bot/identity.py).
+"""
+from django.conf import settings
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ConversationHandler,
+    PersistenceInput, PicklePersistence,
+)
+
+from telegram_bot.handlers import *
+from telegram_bot.concurrency import PerChatUpdateProcessor
+from dreambot.instrumentation import traced_handler
+
+
+def build_application(updater=True, request=None):
+    """updater=False — без встроенного polling: апдейты приходят через webhook."""
+    builder = (
+        Application.builder()
+        .token(settings.TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(settings.TELEGRAM_MAX_CONCURRENT_UPDATES))
+    )
+    if not updater:
+        builder = builder.updater(None)
+    if request is not None:
+        builder = builder.request(request)
+    persistent = bool(settings.TELEGRAM_PERSISTENCE_FILE)
+    if persistent:
+        builder = builder.persistence(PicklePersistence(
+            settings.TELEGRAM_PERSISTENCE_FILE,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        ))
+    application = builder.build()
+    # Каждый обработчик — в своей трассе (dreambot/instrumentation.py), как HTTP-запрос
+
+    profile_conv = ConversationHandler(
+        entry_points=[CommandHandler("profile", traced_handler(profile_start))],
+        states={
+            ASK_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, traced_handler(handle_name))],
+            ASK_BIRTH_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, traced_handler(handle_birth_date))],
+        },
+        fallbacks=[CommandHandler("cancel", traced_handler(cancel))],
+        name="profile",
+        persistent=persistent,
+    )
+
+    application.add_handler(CommandHandler("start", traced_handler(start)))
+    application.add_handler(CommandHandler("help", traced_handler(help_command)))
+    application.add_handler(CommandHandler("search", traced_handler(search_command)))
+    application.add_handler(MessageHandler(filters.CONTACT, traced_handler(handle_contact)))
+    application.add_handler(CallbackQueryHandler(traced_handler(button_callback)))
+    application.add_handler(profile_conv)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(r'^\/'), traced_handler(handle_message)))
+    return application
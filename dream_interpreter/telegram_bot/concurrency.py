@@ -0,0 +1,61 @@
+# telegram_bot/concurrency.py
+"""
+Модель конкурентности бота.
+
+- Апдейты разных чатов обрабатываются одновременно (не больше
+  TELEGRAM_MAX_CONCURRENT_UPDATES), апдейты одного чата — строго по очереди.
+- Каждый апдейт выполняется в своём asgiref.ThreadSensitiveContext — так же,
+  как Django делает для ASGI-запросов. Поэтому sync_to_async-обёртки ORM в
+  handlers.py работают в отдельном потоке апдейта, а не в одном общем потоке
+  на весь бот.
+- Запросы к LLM идут через асинхронный клиент и ограничены LLMScheduler
+  (LLM_MAX_CONCURRENCY), поэтому медленный сон одного пользователя не
+  блокирует остальных.
+"""
+import asyncio
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.db import connections
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}
+
+    @staticmethod
+    def _chat_key(update):
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def _run(self, coroutine):
+        async with ThreadSensitiveContext():
+            try:
+                await coroutine
+            finally:
+                # Поток контекста завершится вместе с ним — закрываем его соединения с БД
+                await sync_to_async(connections.close_all)()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -4,15 +4,25 @@ from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboard
 from telegram.ext import ContextTypes, ConversationHandler
 from asgiref.sync import sync_to_async
 from dreambot.models import User, DreamSession, Message
-from dreambot.views import get_llm_response
+from dreambot.views import astream_llm_response, llm_error_reply
+from dreambot.scheduler import get_scheduler, priority_for, Overloaded
+from dreambot.routing import choose_route
+from dreambot.quota import QuotaExceeded, limit_reached, save_dream
+from dreambot.search import highlight, search_messages
+from dreambot.history import invalidate_history
+from dreambot.instrumentation import tag
+from dreambot.metrics import MESSAGES, QUEUE_REJECTIONS, QUOTA_REJECTIONS
+from django.conf import settings
+from telegram_bot.streaming import ProgressiveReply
+from telegram_bot.identity import resolve_telegram_user
 
 get_or_create_user = sync_to_async(User.objects.get_or_create)
 get_user_by_id = sync_to_async(User.objects.get)
 create_message = sync_to_async(Message.objects.create)
-get_llm_response_async = sync_to_async(get_llm_response)
 
 # Глобальные константы состояний
 ASK_NAME, ASK_BIRTH_DATE = range(2)
+LIMIT_TEXT = "💫 Лимит — {limit} снов в день.\nНапиши /premium или нажми кнопку «Премиум»."
 
 def get_main_menu():
     return InlineKeyboardMarkup([
@@ -23,18 +33,37 @@ def get_main_menu():
         [InlineKeyboardButton("🔓 Премиум", callback_data="premium")]
     ])
 
-async def get_or_create_active_session(user):
+async def get_current_user(update, context):
+    """
+    Пользователь сайта для апдейта или None, если номер ещё не отправлен.
+    Ищется по Telegram ID через кэш (переживает перезапуск бота и не ходит в БД
+    на горячем пути), иначе — по user_id из user_data.
+    """
+    user = None
+    if update.effective_user is not None:
+        user = await resolve_telegram_user(update.effective_user.id)
+    if user is not None:
+        context.user_data['user_id'] = user.id
+        return user
+    if 'user_id' not in context.user_data:
+        return None
+    try:
+        return await get_user_by_id(id=context.user_data['user_id'])
+    except User.DoesNotExist:
+        del context.user_data['user_id']
+        return None
+
+def active_session_for_today(user):
+    """Активная сессия, начатая сегодня; вчерашние закрываются — в боте каждый день новый разговор."""
     from django.utils import timezone
-    session = await sync_to_async(
-        lambda: DreamSession.objects.filter(user=user, is_active=True).order_by('-created_at').first()
-    )()
-    if not session:
-        session = await sync_to_async(DreamSession.objects.create)(user=user, is_active=True)
-    else:
-        if session.created_at.date() != timezone.now().date():
-            await sync_to_async(DreamSession.objects.filter(user=user, is_active=True).update)(is_active=False)
-            session = await sync_to_async(DreamSession.objects.create)(user=user, is_active=True)
-    return session
+    session = DreamSession.objects.filter(user=user, is_active=True).order_by('-created_at').first()
+    if session and session.created_at.date() == timezone.now().date():
+        return session
+    if session:
+        DreamSession.objects.filter(user=user, is_active=True).update(is_active=False)
+    return DreamSession.objects.create(user=user, is_active=True)
+
+save_user_dream = sync_to_async(lambda user, text: save_dream(user, text, get_session=active_session_for_today))
 
 # --- Основные команды ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -47,6 +76,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "💡 <i>Команды:</i>\n"
         "/start - начать заново\n"
         "/profile - редактировать профиль\n"
+        "/search слова - поиск по истории снов\n"
         "/help - помощь"
     )
     await update.message.reply_text(welcome_text, parse_mode="HTML", reply_markup=reply_markup)
@@ -61,6 +91,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📋 <b>Команды:</b>\n"
         "/start - начать заново\n"
         "/profile - редактировать профиль\n"
+        "/search слова - поиск по истории снов\n"
         "/help - эта справка\n\n"
         "💡 <b>Советы:</b>\n"
         "• Чем подробнее описание — тем глубже понимание\n"
@@ -85,7 +116,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['user_id'] = user.id
     if not user.telegram_id:
         user.telegram_id = str(update.effective_user.id)
-        await sync_to_async(user.save)()
+        await sync_to_async(user.save)(update_fields=['telegram_id'])
 
     if created:
         welcome_msg = (
@@ -94,9 +125,8 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "💡 <i>Начни с описания своего сна — чем подробнее, тем лучше!</i>"
         )
     else:
-        sessions_count = await sync_to_async(
-            lambda: DreamSession.objects.filter(user=user).count()
-        )()
+        # Пустые сессии (после «Очистить») не считаем
+        sessions_count = await DreamSession.objects.filter(user=user, message_count__gt=0).acount()
         if sessions_count > 0:
             welcome_msg = (
                 "✨ <b>С возвращением!</b>\n\n"
@@ -119,42 +149,61 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if text.startswith('/'):
         return
-    if 'user_id' not in context.user_data:
-        await update.message.reply_text("📱 Нажми «Отправить номер».")
-        return
-
     try:
-        user = await get_user_by_id(id=context.user_data['user_id'])
+        user = await get_current_user(update, context)
     except Exception:
         await update.message.reply_text("Ошибка. Пришли номер снова.")
         return
+    if user is None:
+        await update.message.reply_text("📱 Нажми «Отправить номер».")
+        return
 
-    from django.utils import timezone
-    today = timezone.now().date()
-    if user.last_message_date != today:
-        user.last_message_date = today
-        user.free_messages_today = 0
-        await sync_to_async(user.save)()
+    tag(user_id=user.id)
+    if limit_reached(user):
+        QUOTA_REJECTIONS.inc(channel='telegram')
+        await update.message.reply_text(LIMIT_TEXT.format(limit=settings.FREE_DREAMS_PER_DAY))
+        return
 
-    if not user.is_premium and user.free_messages_today >= 5:
-        await update.message.reply_text("💫 Лимит — 5 снов в день.\nНапиши /premium или нажми кнопку «Премиум».")
+    try:
+        ticket = get_scheduler().enqueue(priority_for(user))
+    except Overloaded as e:
+        QUEUE_REJECTIONS.inc(channel='telegram')
+        await update.message.reply_text(
+            f"🌙 Сейчас очень много снов в очереди. Попробуй ещё раз через {e.retry_after} сек.",
+            reply_markup=get_main_menu()
+        )
         return
 
     typing_message = await update.message.reply_text("🌙 Анализирую твой сон...")
     try:
-        session = await get_or_create_active_session(user)
-        await create_message(session=session, is_user=True, content=text)
-
-        if not user.is_premium:
-            user.free_messages_today += 1
-            await sync_to_async(user.save)()
+        try:
+            session, _ = await save_user_dream(user, text)
+        except QuotaExceeded:
+            # Последний сон дня успел уйти другим апдейтом или с сайта
+            QUOTA_REJECTIONS.inc(channel='telegram')
+            ticket.cancel()
+            await typing_message.edit_text(LIMIT_TEXT.format(limit=settings.FREE_DREAMS_PER_DAY))
+            return
+        MESSAGES.inc(channel='telegram')
 
-        bot_reply = await get_llm_response_async(user, text, session=session)
-        await create_message(session=session, is_user=False, content=bot_reply)
+        # Плейсхолдер правится по мере генерации, финальная правка — с меню
+        route = choose_route(user, text)
+        reply = ProgressiveReply(typing_message)
+        try:
+            async for token in astream_llm_response(user, text, session=session, ticket=ticket, route=route):
+                await reply.feed(token)
+            bot_reply = reply.text.strip()
+            if not bot_reply:
+                bot_reply = "Извини, произошла ошибка при генерации ответа. Попробуй ещё раз? 😊"
+        except Exception as e:
+            bot_reply = llm_error_reply(e)
+        finally:
+            ticket.release()
+        await create_message(session=session, is_user=False, content=bot_reply, route=route.name)
 
-        await typing_message.delete()
-        await update.message.reply_text(bot_reply, reply_markup=get_main_menu())
+        await reply.finish(bot_reply, reply_markup=get_main_menu())
     except Exception as e:
+        ticket.release()
         await typing_message.delete()
         await update.message.reply_text(
             "Извини, произошла ошибка. Попробуй ещё раз. 😊",
@@ -166,27 +215,27 @@ async def profile_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query is not None:
         query = update.callback_query
         await query.answer()
-        if 'user_id' not in context.user_data:
+        user = await get_current_user(update, context)
+        if user is None:
             await query.edit_message_text("📱 Сначала отправь номер телефона.", reply_markup=get_main_menu())
             return
         try:
-            user = await get_user_by_id(id=context.user_data['user_id'])
             profile_text = "👤 Твой профиль:\n\n"
             profile_text += f"📱 Телефон: {user.phone_number}\n"
             profile_text += f"👤 Имя: {user.name or 'не указано'}\n"
             profile_text += f"🎂 Дата рождения: {(user.birth_date.strftime('%d.%m.%Y') if user.birth_date else 'не указана')}\n"
             profile_text += f"\n{'✨ Премиум активен' if user.is_premium else '🔓 Обычный аккаунт'}\n"
-            profile_text += f"📊 Снов сегодня: {user.free_messages_today}/5\n"
+            profile_text += f"📊 Снов сегодня: {user.free_messages_today}/{settings.FREE_DREAMS_PER_DAY}\n"
             profile_text += "\n💡 Для редактирования используй команду /profile или веб-интерфейс."
             await query.edit_message_text(profile_text, reply_markup=get_main_menu())
         except Exception as e:
             await query.edit_message_text(f"Ошибка: {str(e)}", reply_markup=get_main_menu())
     else:
-        if 'user_id' not in context.user_data:
+        user = await get_current_user(update, context)
+        if user is None:
             await update.message.reply_text("📱 Сначала отправь номер телефона.")
             return
         try:
-            user = await get_user_by_id(id=context.user_data['user_id'])
             await update.message.reply_text(
                 "👤 Для редактирования профиля используй команду /profile\n"
                 "Или перейди на веб-интерфейс.",
@@ -199,22 +248,19 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query is not None:
         query = update.callback_query
         await query.answer()
-        if 'user_id' not in context.user_data:
+        user = await get_current_user(update, context)
+        if user is None:
             await query.edit_message_text("📱 Сначала отправь номер телефона.", reply_markup=get_main_menu())
             return
         try:
-            user = await get_user_by_id(id=context.user_data['user_id'])
             sessions = await sync_to_async(list)(DreamSession.objects.filter(user=user).order_by('-created_at')[:10])
             if not sessions:
                 await query.edit_message_text("📜 История пока пуста.", reply_markup=get_main_menu())
             else:
                 msg = "📜 История твоих снов:\n\n"
                 for s in sessions:
-                    first_dream = await sync_to_async(
-                        lambda s=s: Message.objects.filter(session=s, is_user=True).order_by('created_at').first()
-                    )()
-                    if first_dream:
-                        dream_preview = first_dream.content[:60] + "..." if len(first_dream.content) > 60 else first_dream.content
+                    if s.first_dream:
+                        dream_preview = s.first_dream[:60] + "..." if len(s.first_dream) > 60 else s.first_dream
                         msg += f"📅 {s.created_at.strftime('%d.%m.%Y')}\n"
                         msg += f"   {dream_preview}\n\n"
                     else:
@@ -224,6 +270,29 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             await query.edit_message_text(f"Ошибка: {str(e)}", reply_markup=get_main_menu())
 
+# Сколько найденных сообщений показывать в ответе на /search
+SEARCH_RESULTS = 5
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = await get_current_user(update, context)
+    if user is None:
+        await update.message.reply_text("📱 Сначала отправь номер телефона.")
+        return
+    query = " ".join(context.args or [])
+    if not query:
+        await update.message.reply_text("🔎 Напиши, что найти в истории снов, например: /search волки")
+        return
+    hits = await sync_to_async(search_messages)(user.id, query, limit=SEARCH_RESULTS)
+    if not hits:
+        await update.message.reply_text("🔎 В истории ничего не нашлось.", reply_markup=get_main_menu())
+        return
+    msg = "🔎 <b>Нашлось в истории:</b>\n\n"
+    for hit in hits:
+        kind = "🌙 Сон" if hit['is_user'] else "💬 Интерпретация"
+        msg += f"📅 {hit['created_at'].strftime('%d.%m.%Y')} · {kind}\n"
+        msg += f"{highlight(hit['snippet'], '<b>', '</b>')}\n\n"
+    await update.message.reply_text(msg, parse_mode="HTML", reply_markup=get_main_menu())
+
 async def guide_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query is not None:
         query = update.callback_query
@@ -242,13 +311,14 @@ async def clear_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query is not None:
         query = update.callback_query
         await query.answer()
-        if 'user_id' not in context.user_data:
+        user = await get_current_user(update, context)
+        if user is None:
             await query.edit_message_text("📱 Сначала отправь номер телефона.", reply_markup=get_main_menu())
             return
         try:
-            user = await get_user_by_id(id=context.user_data['user_id'])
             await sync_to_async(DreamSession.objects.filter(user=user, is_active=True).update)(is_active=False)
             await sync_to_async(DreamSession.objects.create)(user=user, is_active=True)
+            await sync_to_async(invalidate_history)(user.id)
             await query.edit_message_text(
                 "🧹 Чат очищен.\n\n💡 История всех твоих снов сохранена и будет учитываться при новых интерпретациях.",
                 reply_markup=get_main_menu()
@@ -260,13 +330,13 @@ async def activate_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query is not None:
         query = update.callback_query
         await query.answer()
-        if 'user_id' not in context.user_data:
+        user = await get_current_user(update, context)
+        if user is None:
             await query.edit_message_text("📱 Сначала отправь номер телефона.", reply_markup=get_main_menu())
             return
         try:
-            user = await get_user_by_id(id=context.user_data['user_id'])
             user.is_premium = True
-            await sync_to_async(user.save)()
+            await sync_to_async(user.save)(update_fields=['is_premium'])
             await query.edit_message_text(
                 "✨ Премиум активирован!\n\nТеперь у тебя неограниченный доступ к интерпретации снов! 🎉",
                 reply_markup=get_main_menu()
@@ -277,25 +347,25 @@ async def activate_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Командный обработчик для /profile (редактирование) ---
 async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.text.strip()
-    if 'user_id' in context.user_data:
-        try:
-            user = await get_user_by_id(id=context.user_data['user_id'])
+    try:
+        user = await get_current_user(update, context)
+        if user is not None:
             user.name = name
-            await sync_to_async(user.save)()
+            await sync_to_async(user.save)(update_fields=['name'])
             await update.message.reply_text(f"✅ Имя сохранено: {name}\nТеперь укажи дату рождения (ДД.ММ.ГГГГ):")
             return ASK_BIRTH_DATE
-        except Exception:
-            pass
+    except Exception:
+        pass
     return ConversationHandler.END
 
 async def handle_birth_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         date_str = update.message.text.strip()
         birth_date = datetime.strptime(date_str, '%d.%m.%Y').date()
-        if 'user_id' in context.user_data:
-            user = await get_user_by_id(id=context.user_data['user_id'])
+        user = await get_current_user(update, context)
+        if user is not None:
             user.birth_date = birth_date
-            await sync_to_async(user.save)()
+            await sync_to_async(user.save)(update_fields=['birth_date'])
             await update.message.reply_text("✅ Профиль сохранён!", reply_markup=get_main_menu())
             return ConversationHandler.END
     except ValueError:
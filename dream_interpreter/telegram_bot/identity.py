@@ -0,0 +1,141 @@
+# telegram_bot/identity.py
+"""
+Определение пользователя сайта по Telegram ID.
+
+Раньше бот знал пользователя только по context.user_data['user_id'] (в памяти),
+поэтому после перезапуска все получали «Нажми „Отправить номер“», а каждое
+сообщение делало запрос User по id. Теперь:
+- User ищется по уникальному User.telegram_id;
+- найденные записи лежат в ограниченном LRU-кэше с TTL (TELEGRAM_USER_CACHE_SIZE,
+  TELEGRAM_USER_CACHE_TTL), так что горячий путь не ходит в БД;
+- любое сохранение/удаление User (профиль, премиум, счётчик снов) сбрасывает
+  запись через сигналы post_save/post_delete.
+
+Сигналы работают внутри процесса: в webhook-режиме бот и сайт живут в одном
+процессе и кэш всегда свежий; при отдельном polling-процессе изменения с сайта
+видны не позже чем через TTL. QuerySet.update() сигналов не шлёт — после него
+нужно звать invalidate_user() (счётчик снов dreambot.quota сообщает о себе
+сигналом quota_changed).
+
+Запись из кэша может отставать от БД на TTL (другой процесс, другой воркер), поэтому
+хендлеры сохраняют её только с update_fields — полное save() вернуло бы в строку
+устаревшие is_premium и счётчик снов.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from dreambot.models import User
+from dreambot.quota import quota_changed
+
+
+class UserCache:
+    """Потокобезопасный LRU-кэш telegram_id → User с временем жизни записей."""
+
+    def __init__(self, maxsize=10000, ttl=300.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # telegram_id -> (expires_at, user)
+        self._keys = {}  # user.pk -> telegram_id, чтобы сбросить запись после смены telegram_id
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, telegram_id):
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    self._remove(telegram_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            # Копия: хендлеры меняют поля user, общий экземпляр портился бы между апдейтами
+            return copy.copy(entry[1])
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def set(self, telegram_id, user, generation=None):
+        """generation — значение self.generation до чтения из БД: если с тех пор был сброс, не кэшируем."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            old_key = self._keys.get(user.pk)
+            if old_key is not None and old_key != telegram_id:
+                self._remove(old_key)
+            self._entries[telegram_id] = (self.clock() + self.ttl, copy.copy(user))
+            self._entries.move_to_end(telegram_id)
+            self._keys[user.pk] = telegram_id
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user):
+        with self._lock:
+            self._generation += 1
+            for key in {self._keys.get(user.pk), user.telegram_id} - {None}:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys.clear()
+
+    def _remove(self, telegram_id):
+        entry = self._entries.pop(telegram_id, None)
+        if entry is not None and self._keys.get(entry[1].pk) == telegram_id:
+            del self._keys[entry[1].pk]
+
+
+user_cache = UserCache(
+    maxsize=settings.TELEGRAM_USER_CACHE_SIZE,
+    ttl=settings.TELEGRAM_USER_CACHE_TTL,
+)
+
+
+def invalidate_user(user):
+    user_cache.invalidate_user(user)
+
+
+def _invalidate_on_change(sender, instance, **kwargs):
+    invalidate_user(instance)
+
+
+post_save.connect(_invalidate_on_change, sender=User, dispatch_uid='telegram_user_cache_save')
+post_delete.connect(_invalidate_on_change, sender=User, dispatch_uid='telegram_user_cache_delete')
+
+
+def _invalidate_on_quota(sender, user, **kwargs):
+    invalidate_user(user)
+
+
+quota_changed.connect(_invalidate_on_quota, sender=User, dispatch_uid='telegram_user_cache_quota')
+
+
+def _find_by_telegram_id(telegram_id):
+    return User.objects.filter(telegram_id=telegram_id).first()
+
+
+async def resolve_telegram_user(telegram_id):
+    """User с данным telegram_id или None; из кэша, при промахе — один запрос в БД."""
+    telegram_id = str(telegram_id)
+    user = user_cache.get(telegram_id)
+    if user is None:
+        generation = user_cache.generation
+        user = await sync_to_async(_find_by_telegram_id)(telegram_id)
+        if user is not None:
+            user_cache.set(telegram_id, user, generation=generation)
+    return user
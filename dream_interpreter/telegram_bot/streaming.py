@@ -0,0 +1,88 @@
+# telegram_bot/streaming.py
+"""
+Постепенный ответ в Telegram: плейсхолдер «Анализирую твой сон...» редактируется
+по мере прихода токенов от LLM.
+
+Telegram ограничивает частоту правок в одном чате, поэтому правки склеиваются:
+не чаще раза в TELEGRAM_EDIT_INTERVAL секунд, а на RetryAfter следующая правка
+откладывается на указанное Telegram время. Промежуточные правки могут теряться —
+важна только финальная, она же прикрепляет клавиатуру.
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_TEXT_LIMIT = 4096
+CURSOR = " ▌"
+
+
+def split_text(text, limit=TELEGRAM_TEXT_LIMIT):
+    return [text[i:i + limit] for i in range(0, len(text), limit)] or [""]
+
+
+class ProgressiveReply:
+    def __init__(self, message, interval=None, clock=time.monotonic):
+        self.message = message
+        self.interval = settings.TELEGRAM_EDIT_INTERVAL if interval is None else interval
+        self.clock = clock
+        self.text = ""
+        self.edits = 0
+        self._shown = message.text
+        # Первая правка — сразу с первым токеном: это и есть выигрыш в воспринимаемой задержке
+        self._next_edit_at = 0.0
+
+    async def feed(self, token):
+        """Добавляет токен; ошибки промежуточных правок не прерывают генерацию."""
+        self.text += token
+        if self.clock() < self._next_edit_at:
+            return
+        try:
+            await self._edit(self.text.strip() + CURSOR)
+        except RetryAfter:
+            pass
+        except TelegramError as e:
+            # BadRequest, TimedOut, NetworkError — пропускаем правку, поток не прерываем
+            logger.warning(f"Intermediate edit failed: {e}")
+            self._next_edit_at = self.clock() + self.interval
+
+    async def _edit(self, text, reply_markup=None):
+        text = text[-TELEGRAM_TEXT_LIMIT:]
+        if text == self._shown and reply_markup is None:
+            return
+        try:
+            await self.message.edit_text(text, reply_markup=reply_markup)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.warning(f"Telegram edit rate limited, retry after {retry_after}s")
+            self._next_edit_at = self.clock() + retry_after
+            raise
+        self._shown = text
+        self.edits += 1
+        self._next_edit_at = self.clock() + self.interval
+
+    async def finish(self, text, reply_markup=None):
+        """Финальная правка с полным ответом; хвост длиннее лимита Telegram уходит отдельными сообщениями."""
+        chunks = split_text(text)
+        first_markup = reply_markup if len(chunks) == 1 else None
+        try:
+            try:
+                await self._edit(chunks[0], reply_markup=first_markup)
+            except RetryAfter:
+                await asyncio.sleep(max(0.0, self._next_edit_at - self.clock()))
+                await self._edit(chunks[0], reply_markup=first_markup)
+        except TelegramError as e:
+            # Плейсхолдер удалён или правка невозможна — отправляем ответ заново, как раньше
+            logger.error(f"Final edit failed, sending a new message: {e}")
+            try:
+                await self.message.delete()
+            except TelegramError:
+                pass
+            await self.message.reply_text(chunks[0], reply_markup=first_markup)
+        for i, chunk in enumerate(chunks[1:], start=2):
+            await self.message.reply_text(chunk, reply_markup=reply_markup if i == len(chunks) else None)
+
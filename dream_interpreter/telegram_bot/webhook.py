@@ -0,0 +1,70 @@
+# telegram_bot/webhook.py
+"""
+Webhook-режим бота внутри Django (ASGI): Telegram присылает апдейты на
+/telegram/webhook/, они попадают в тот же набор обработчиков, что и при polling,
+и делят с веб-приложением пул соединений с БД, LLM-клиент и очередь к LLM.
+
+Application создаётся лениво на event loop ASGI-сервера при первом апдейте;
+view только кладёт апдейт в очередь и сразу отвечает 200 — долгая генерация
+не задерживает ответ Telegram (иначе он повторит доставку).
+
+Регистрация webhook: python manage.py set_telegram_webhook https://<host>/telegram/webhook/
+"""
+import asyncio
+import hmac
+import json
+import logging
+import weakref
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from telegram import Update
+
+from telegram_bot.application import build_application
+
+logger = logging.getLogger(__name__)
+
+_applications = weakref.WeakKeyDictionary()
+
+
+async def get_webhook_application():
+    loop = asyncio.get_running_loop()
+    application = _applications.get(loop)
+    if application is None:
+        application = build_application(updater=False)
+        # Кладём в кэш до initialize: апдейты, пришедшие во время старта, подождут в update_queue
+        _applications[loop] = application
+        try:
+            await application.initialize()
+            await application.start()
+        except Exception:
+            del _applications[loop]
+            raise
+    return application
+
+
+@csrf_exempt
+@require_POST
+async def telegram_webhook(request):
+    secret = settings.TELEGRAM_WEBHOOK_SECRET
+    if not secret:
+        return HttpResponseNotFound()
+    # Байты, а не str: compare_digest бросает TypeError на не-ASCII строках
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode('latin-1', 'replace')
+    if not hmac.compare_digest(token, secret.encode()):
+        return HttpResponseForbidden()
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'bad json'}, status=400)
+
+    try:
+        application = await get_webhook_application()
+    except Exception as e:
+        logger.error(f"Telegram application failed to start: {e}", exc_info=True)
+        # 5xx — Telegram доставит апдейт повторно
+        return HttpResponse(status=503)
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return HttpResponse('ok')